@@ -0,0 +1,140 @@
+"""
+Precomputed alias resolution for WaifuHoarder
+
+(C) 2019-2020 by Jordan Aurora Kinsley
+
+Licensed under MIT License, see LICENSE
+"""
+
+from collections import deque
+from indexes import KEY_DELIMITER
+
+
+def normalize(name):
+    """Folds case and collapses runs of whitespace, so "sunset  SHIMMER" and "Sunset Shimmer" are the same name"""
+    return ' '.join(str(name).split()).casefold()
+
+
+def strip_server(target, server):
+    """Returns an alias target without a <server>\\ key prefix, should one have been stored as the target"""
+    prefix = str(server) + KEY_DELIMITER
+    return target[len(prefix):] if target.startswith(prefix) else target
+
+
+class AliasTable:
+    """Resolves one server's names to the characters they refer to with a single dict lookup. Every name is
+    normalized (see normalize()), and chains of aliases are followed ahead of time: if A is an alias of B and B an
+    alias of Character, both A and B resolve straight to Character. An alias takes precedence over a character of the
+    same name, as it always has.
+
+    Aliases that loop back on themselves (A -> B -> A) don't resolve to anything and are listed in cycles. An alias
+    whose chain ends at a name that is neither a character nor an alias resolves to that name.
+
+    Changes are applied as they happen: only the changed name and the aliases leading to it get resolved again."""
+
+    def __init__(self):
+        self.characters = {}  # normalized name -> character name as stored
+        self.aliases = {}  # normalized alias -> (alias as stored, target as stored)
+        self.referrers = {}  # normalized target -> set of normalized aliases pointing straight at it
+        self.resolved = {}  # normalized name -> the character it refers to
+        self.cycles = set()  # normalized aliases whose chain loops
+
+    def __len__(self):
+        return len(self.resolved)
+
+    @classmethod
+    def build(cls, characters, aliases):
+        """Builds a table from a server's character names and a dict of its aliases to the names they refer to"""
+        table = cls()
+        for character in characters:
+            table.characters[normalize(character)] = character
+        for alias, target in aliases.items():
+            table._link(alias, target)
+        for name in list(table.characters) + list(table.aliases):
+            table._resolve(name)
+        return table
+
+    def resolve(self, name):
+        """Returns the character name refers to, or None if it isn't a known character or alias"""
+        return self.resolved.get(normalize(name))
+
+    def character(self, name):
+        """Returns the character name as stored if name (ignoring aliases) is a known character, None otherwise"""
+        return self.characters.get(normalize(name))
+
+    def alias(self, name):
+        """Returns the (alias, target) pair as stored if name is a known alias, None otherwise"""
+        return self.aliases.get(normalize(name))
+
+    def referring_aliases(self, name):
+        """Returns the aliases, as stored, that point straight at name"""
+        return [self.aliases[alias][0] for alias in self.referrers.get(normalize(name), ())]
+
+    def add_character(self, character):
+        self.characters[normalize(character)] = character
+        self._refresh(normalize(character))
+
+    def remove_character(self, character):
+        if self.characters.pop(normalize(character), None) is not None:
+            self._refresh(normalize(character))
+
+    def set_alias(self, alias, target):
+        key = normalize(alias)
+        self._unlink(key)
+        self._link(alias, target)
+        self._refresh(key)
+
+    def remove_alias(self, alias):
+        key = normalize(alias)
+        if key in self.aliases:
+            self._unlink(key)
+            self._refresh(key)
+
+    def _link(self, alias, target):
+        key = normalize(alias)
+        self.aliases[key] = (alias, target)
+        self.referrers.setdefault(normalize(target), set()).add(key)
+
+    def _unlink(self, key):
+        entry = self.aliases.pop(key, None)
+        if entry is None:
+            return
+        target = normalize(entry[1])
+        referrers = self.referrers.get(target)
+        if referrers is not None:
+            referrers.discard(key)
+            if not referrers:
+                del self.referrers[target]
+
+    def _refresh(self, name):
+        """Resolves name again, then every alias that leads to it, since their answers go through name's"""
+        pending = deque([name])
+        seen = {name}
+        while pending:
+            current = pending.popleft()
+            self._resolve(current)
+            for alias in self.referrers.get(current, ()):
+                if alias not in seen:
+                    seen.add(alias)
+                    pending.append(alias)
+
+    def _resolve(self, name):
+        """Follows name's alias chain to its end and records where it leads"""
+        self.cycles.discard(name)
+        if name not in self.aliases:
+            if name in self.characters:
+                self.resolved[name] = self.characters[name]
+            else:
+                self.resolved.pop(name, None)
+            return
+        visited = {name}
+        target = self.aliases[name][1]
+        while normalize(target) in self.aliases:
+            following = normalize(target)
+            if following in visited:
+                self.cycles.add(name)
+                self.resolved.pop(name, None)
+                return
+            visited.add(following)
+            target = self.aliases[following][1]
+        self.resolved[name] = self.characters.get(normalize(target), target)
@@ -0,0 +1,129 @@
+"""
+Runs WaifuHoarder storage calls off the asyncio event loop
+
+(C) 2019-2020 by Jordan Aurora Kinsley
+
+Licensed under MIT License, see LICENSE
+"""
+
+import asyncio
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class KeyLocks:
+    """Hands out one asyncio.Lock per key, created on first use and dropped once nobody holds or waits on it. Concurrent
+    read-modify-write sequences on the same key run one after the other, while different keys never wait on each other.
+    Usage: async with key_locks(key_1, key_2, ...):"""
+
+    def __init__(self):
+        # key -> [lock, number of coroutines holding or waiting on it]
+        self.locks = {}
+
+    def __call__(self, *keys):
+        # always taking keys in sorted order means two multi-key holders can't deadlock each other
+        return _HeldKeys(self, sorted(set(keys)))
+
+    def _acquire_entry(self, key):
+        entry = self.locks.get(key)
+        if entry is None:
+            entry = [asyncio.Lock(), 0]
+            self.locks[key] = entry
+        entry[1] += 1
+        return entry
+
+    def _release_entry(self, key, held):
+        entry = self.locks[key]
+        if held:
+            entry[0].release()
+        entry[1] -= 1
+        if entry[1] == 0:
+            del self.locks[key]
+
+
+class _HeldKeys:
+    def __init__(self, key_locks, keys):
+        self.key_locks = key_locks
+        self.keys = keys
+        self.held = []
+
+    async def __aenter__(self):
+        for key in self.keys:
+            entry = self.key_locks._acquire_entry(key)
+            try:
+                await entry[0].acquire()
+            except BaseException:
+                # cancelled while waiting: give back this key and everything already held
+                self.key_locks._release_entry(key, False)
+                await self.__aexit__(None, None, None)
+                raise
+            self.held.append(key)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        while self.held:
+            self.key_locks._release_entry(self.held.pop(), True)
+
+
+class AsyncStorage:
+    """Wraps a storage engine (see storage.py) so every call runs on a worker thread and is awaited, keeping the event
+    loop, and with it the gateway heartbeat, free while the disk is busy. Engines aren't thread safe, so the executor has
+    a single worker and calls run in the order they were made. Any engine method can be awaited through this wrapper,
+    e.g. await storage.subscribers(server, character)"""
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='storage')
+        self.locks = KeyLocks()
+        # method name -> [calls, seconds spent on the storage thread], for metrics.py
+        self.calls = {}
+
+    async def run(self, function, *args):
+        """Runs function(*args) on the storage thread and returns its result"""
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(function, *args))
+
+    async def _timed(self, name, function, *args):
+        """Like run(), but counts the call and its time on the storage thread under name"""
+        def timed():
+            started = time.perf_counter()
+            try:
+                return function(*args)
+            finally:
+                # only the storage thread touches calls while it runs, the event loop only reads it
+                counted = self.calls.setdefault(name, [0, 0.0])
+                counted[0] += 1
+                counted[1] += time.perf_counter() - started
+        return await self.run(timed)
+
+    def __getattr__(self, name):
+        attribute = getattr(self.storage, name)
+        if not callable(attribute):
+            return attribute
+
+        async def call(*args):
+            return await self._timed(name, attribute, *args)
+        return call
+
+    # the engines yield these lazily, so they are collected on the storage thread rather than iterated on the event loop
+    async def all_notices(self):
+        return await self._timed('all_notices', lambda: list(self.storage.all_notices()))
+
+    async def all_aliases(self):
+        return await self._timed('all_aliases', lambda: list(self.storage.all_aliases()))
+
+    async def all_users(self):
+        return await self._timed('all_users', lambda: list(self.storage.all_users()))
+
+    def dirty_count(self):
+        # only reads a counter, so it is safe to call straight from the event loop
+        return self.storage.dirty_count()
+
+    def close(self, last=None):
+        """Waits for queued calls to finish, then closes the engine. If given, last(engine) runs just before it closes.
+        Blocking, for use while shutting down"""
+        self.executor.shutdown(wait=True)
+        if last is not None:
+            last(self.storage)
+        self.storage.close()
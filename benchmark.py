@@ -0,0 +1,321 @@
+"""
+Benchmarks for the hot paths of the Waifu cog, run against synthetic data without connecting to Discord
+
+(C) 2019-2020 by Jordan Aurora Kinsley
+
+Licensed under MIT License, see LICENSE
+
+Usage: python benchmark.py --sizes 10x50x20,100x100x50 --output results.json [--compare baseline.json]
+Each size is <guilds>x<characters per guild>x<subscribers per character>.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from discord.ext import tasks
+import storage
+import eventlog
+import waifu
+from sendqueue import FakeTransport
+from bothelper import chunk_messages, discord_split, mention
+
+
+class FakeUser:
+    def __init__(self, user_id):
+        self.id = user_id
+        self.mention = mention(user_id)
+
+
+class FakeGuild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+        self.name = "guild {0}".format(guild_id)
+
+    def __str__(self):
+        return self.name
+
+
+class FakeBot:
+    """Just enough of commands.Bot for the cog"""
+    command_prefix = ';'
+
+    async def is_owner(self, user):
+        return False
+
+
+class _Typing:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return False
+
+
+class FakeChannel:
+    def __init__(self, channel_id):
+        self.id = channel_id
+
+
+class FakeContext:
+    """Stands in for commands.Context. The cog sends through its queue to a FakeTransport, so nothing reaches Discord"""
+
+    def __init__(self, bot, guild, author):
+        self.bot = bot
+        self.guild = guild
+        self.author = author
+        self.channel = FakeChannel(guild.id)
+        self.sent = 0
+
+    async def send(self, content=None, **kwargs):
+        self.sent += 1
+
+    def typing(self):
+        return _Typing()
+
+
+def parse_size(size):
+    guilds, characters, subscribers = (int(part) for part in size.lower().split('x'))
+    return guilds, characters, subscribers
+
+
+def character_name(number):
+    return "Character {0}".format(number)
+
+
+def build_dataset(store, guilds, characters, subscribers, aliases, seed):
+    """Fills store with guilds x characters x subscribers notices and some aliases per guild. User IDs are drawn from a
+    pool ten times the subscriber count per guild, so users follow several characters the way real ones do"""
+    rng = random.Random(seed)
+    user_pool = max(subscribers * 10, 1)
+    for guild in range(1, guilds + 1):
+        guild_id = 100000000000000000 + guild
+        for number in range(characters):
+            for user in rng.sample(range(user_pool), min(subscribers, user_pool)):
+                store.add_subscriber(guild_id, character_name(number), 200000000000000000 + user)
+        for number in range(min(aliases, characters)):
+            store.set_alias(guild_id, "Alias {0}".format(number), character_name(number))
+    store.sync()
+    return user_pool
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+async def measure(operation, iterations, make_call):
+    """Times iterations calls of make_call(i), then repeats a smaller run under tracemalloc for peak memory"""
+    samples = []
+    start = time.perf_counter()
+    for i in range(iterations):
+        call_start = time.perf_counter()
+        await make_call(i)
+        samples.append(time.perf_counter() - call_start)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    for i in range(max(1, iterations // 10)):
+        await make_call(iterations + i)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {
+        "operation": operation,
+        "iterations": iterations,
+        "mean_ms": statistics.mean(samples) * 1000,
+        "p50_ms": percentile(samples, 0.50) * 1000,
+        "p95_ms": percentile(samples, 0.95) * 1000,
+        "p99_ms": percentile(samples, 0.99) * 1000,
+        "ops_per_sec": iterations / elapsed if elapsed else 0.0,
+        "peak_kb": peak / 1024,
+    }
+
+
+async def run_size(arguments, size, directory):
+    guilds, characters, subscribers = parse_size(size)
+    if arguments.backend == "sqlite":
+        store = storage.SqliteStorage(os.path.join(directory, "bench.sqlite3"))
+    elif arguments.backend == "eventlog":
+        store = eventlog.EventLogStorage(os.path.join(directory, "bench.events"))
+    else:
+        store = storage.ShelveStorage(os.path.join(directory, "userlist.db"), os.path.join(directory, "aliases.db"))
+    user_pool = build_dataset(store, guilds, characters, subscribers, arguments.aliases, arguments.seed)
+
+    cog_args = argparse.Namespace(verbose=False, log_file=None, flush_interval=arguments.flush_interval,
+                                  flush_threshold=100, flush_batch=50, cache_size=arguments.cache_size, cache_ttl=300,
+                                  # a budget this big never holds anything back, so only the cog itself gets timed
+                                  send_budget=10 ** 9, send_window=1.0, notice_debounce=0, metrics_port=None,
+                                  snapshot=None, profile_dir=tempfile.gettempdir(), role_budget=10, role_window=10.0,
+                                  role_reconcile_interval=3600.0, purge_grace=7 * 86400.0, purge_batch=100,
+                                  purge_sweep_interval=86400.0)
+    bot = FakeBot()
+    cog = waifu.Waifu(bot, store, cog_args, FakeTransport())
+    rng = random.Random(arguments.seed)
+    guild_objects = [FakeGuild(100000000000000000 + guild) for guild in range(1, guilds + 1)]
+    new_user = [300000000000000000]
+
+    def random_context():
+        user = FakeUser(200000000000000000 + rng.randrange(user_pool))
+        return FakeContext(bot, rng.choice(guild_objects), user)
+
+    def random_character():
+        return character_name(rng.randrange(characters))
+
+    async def itis(i):
+        await cog.itis(random_context(), random_character())
+
+    async def itsm(i):
+        await cog.itsm.callback(cog, random_context(), *(random_character() for _ in range(5)))
+
+    async def notify(i):
+        # always a new user, so every call is a real sign-up rather than "already signed up"
+        new_user[0] += 1
+        await cog.notify(FakeContext(bot, rng.choice(guild_objects), FakeUser(new_user[0])), random_character())
+
+    async def resolve_server_alias(i):
+        await cog.resolve_server_alias(random_context(), "Alias {0}".format(rng.randrange(max(arguments.aliases, 1))))
+
+    async def my_notices(i):
+        await cog.my_notices.callback(cog, random_context())
+
+    async def stop_all_notices(i):
+        ctx = random_context()
+        await cog.stop_all_notices.callback(cog, ctx)
+
+    async def known_waifus(i):
+        await cog.known_waifus.callback(cog, random_context())
+
+    mentions = [mention(200000000000000000 + user) for user in range(subscribers * 20)]
+    mention_list = 'Hey,' + ''.join(' ' + user for user in mentions)
+
+    async def split(i):
+        discord_split(mention_list)
+
+    async def chunk(i):
+        for _ in chunk_messages(mentions, ' ', header='Hey, ', footer=", it's " + character_name(0)):
+            pass
+
+    def delivered(command):
+        # the cog only queues its replies and notices, so a command is done once the queue has handed them to the
+        # FakeTransport. Otherwise rendering and sending them would never be timed
+        async def call(i):
+            await command(i)
+            await cog.send_queue.join()
+        return call
+
+    operations = [("itis", delivered(itis)), ("itsm", delivered(itsm)), ("notify", delivered(notify)),
+                  ("resolve_server_alias", delivered(resolve_server_alias)), ("my_notices", delivered(my_notices)),
+                  ("known_waifus", delivered(known_waifus)), ("discord_split", split), ("chunk_messages", chunk),
+                  # last, since it unsubscribes users and would thin out the data for everything after it
+                  ("stop_all_notices", delivered(stop_all_notices))]
+    results = []
+    try:
+        for name, call in operations:
+            if arguments.operations and name not in arguments.operations:
+                continue
+            result = await measure(name, arguments.iterations, call)
+            result.update({"dataset": size, "backend": arguments.backend})
+            results.append(result)
+            print(("{0:>12} {1:<22} p50 {2:8.3f} ms  p95 {3:8.3f} ms  p99 {4:8.3f} ms  {5:10.1f} ops/s  "
+                   "peak {6:9.1f} KiB").format(size, name, result["p50_ms"], result["p95_ms"], result["p99_ms"],
+                                               result["ops_per_sec"], result["peak_kb"]))
+    finally:
+        await unload(cog)
+    return results
+
+
+async def unload(cog):
+    """Unloads the cog the way the bot would, then waits for its cancelled tasks.loop tasks to finish. The loops belong
+    to the Waifu class, not the instance, so the next dataset's cog can't start them while they are still running, and
+    closing the event loop with them pending leaves "Task was destroyed but it is pending" warnings"""
+    running = [value.get_task() for value in vars(type(cog)).values() if isinstance(value, tasks.Loop)]
+    cog.cog_unload()
+    await asyncio.gather(*(task for task in running if task is not None), return_exceptions=True)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_location, threshold):
+    """Prints how each operation's p50 changed against a previous run and returns how many got slower than threshold"""
+    with open(baseline_location, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+    previous = {(r["operation"], r["dataset"], r["backend"]): r for r in baseline["results"]}
+    regressions = 0
+    print("\ncompared with {0} ({1}):".format(baseline_location, baseline.get("revision")))
+    for result in results:
+        old = previous.get((result["operation"], result["dataset"], result["backend"]))
+        if old is None or not old["p50_ms"]:
+            continue
+        ratio = result["p50_ms"] / old["p50_ms"]
+        flag = ""
+        if ratio > threshold:
+            flag = "  REGRESSION"
+            regressions += 1
+        print("{0:>12} {1:<22} p50 {2:8.3f} ms -> {3:8.3f} ms ({4:5.2f}x){5}".format(
+            result["dataset"], result["operation"], old["p50_ms"], result["p50_ms"], ratio, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the Waifu cog's hot paths on synthetic data")
+    parser.add_argument("--sizes", help="comma separated <guilds>x<characters>x<subscribers> datasets",
+                        default="10x50x20,100x100x50")
+    parser.add_argument("--aliases", help="aliases per guild", type=int, default=20)
+    parser.add_argument("--iterations", help="calls per operation", type=int, default=500)
+    parser.add_argument("--backend", choices=["shelve", "sqlite", "eventlog"], default="shelve")
+    parser.add_argument("--operations", help="only run these operations", nargs="*")
+    parser.add_argument("--cache-size", type=int, default=1024)
+    parser.add_argument("--flush-interval", type=float, default=60)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--threshold", help="p50 slowdown ratio reported as a regression", type=float, default=1.2)
+    arguments = parser.parse_args()
+
+    results = []
+    # the cog's tasks.loop loops were bound to the default event loop when waifu was imported, so run on that one: on a
+    # new loop they would never run, and nothing could wait for them once cancelled
+    loop = asyncio.get_event_loop()
+    try:
+        for size in arguments.sizes.split(','):
+            directory = tempfile.mkdtemp(prefix="waifu-bench-")
+            try:
+                results.extend(loop.run_until_complete(run_size(arguments, size, directory)))
+            finally:
+                shutil.rmtree(directory, ignore_errors=True)
+    finally:
+        loop.close()
+
+    if arguments.output:
+        report = {
+            "revision": git_revision(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "settings": {key: value for key, value in vars(arguments).items() if key not in ("output", "compare")},
+            "results": results,
+        }
+        with open(arguments.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    if arguments.compare:
+        if compare(results, arguments.compare, arguments.threshold):
+            quit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -6,53 +6,226 @@ Helper functions for WaifuHoarder
 Licensed under MIT License, see LICENSE
 """
 
+import atexit
 import datetime
 import argparse
+import os
+import queue
+import sys
+import threading
 
+# the most characters Discord accepts in one message
+DISCORD_MESSAGE_LIMIT = 2000
+# how many queued records the log writer takes per write
+LOG_BATCH_SIZE = 256
+_STOP = object()
+_writer = None
+_writer_lock = threading.Lock()
 
-def log(output: str, mode: str, arguments: argparse.Namespace):
-    """logs output to the locations indicated by mode: "s" for stdout, "v" for verbose output (includes date and time info), and "f" for logging to file"""
+
+class LogWriter(threading.Thread):
+    """Background thread that takes log records off a queue and writes them in batches, so logging never blocks the
+    event loop on the terminal or the disk. Rotates the log file once it grows past max_bytes, keeping backups old
+    copies as <log file>.1, <log file>.2, ..."""
+
+    def __init__(self, log_file, max_bytes, backups):
+        super().__init__(name="log-writer", daemon=True)
+        self.queue = queue.Queue()
+        self.log_file = log_file
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.file = None
+        if log_file:
+            self.open_file()
+
+    def open_file(self):
+        try:
+            # buffered, so a batch of records becomes one write to disk
+            self.file = open(self.log_file, "a", encoding="utf-8", buffering=65536)
+        except OSError:
+            print("log file at {0} not found".format(self.log_file))
+            self.file = None
+
+    def rotate(self):
+        self.file.close()
+        for number in range(self.backups - 1, 0, -1):
+            older = "{0}.{1}".format(self.log_file, number)
+            if os.path.exists(older):
+                os.replace(older, "{0}.{1}".format(self.log_file, number + 1))
+        if self.backups > 0:
+            os.replace(self.log_file, self.log_file + ".1")
+        else:
+            os.remove(self.log_file)
+        self.open_file()
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            batch = [self.queue.get()]
+            while len(batch) < LOG_BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stdout_lines = []
+            file_lines = []
+            for record in batch:
+                if record is _STOP:
+                    stopping = True
+                elif record[0] == 'f':
+                    file_lines.append(record[1])
+                else:
+                    stdout_lines.append(record[1])
+            if stdout_lines:
+                sys.stdout.write("\n".join(stdout_lines) + "\n")
+                sys.stdout.flush()
+            if file_lines and self.file:
+                try:
+                    self.file.write("\n".join(file_lines) + "\n")
+                    self.file.flush()
+                    if self.max_bytes and self.file.tell() >= self.max_bytes:
+                        self.rotate()
+                except OSError:
+                    print("log file at {0} could not be written".format(self.log_file))
+        if self.file:
+            self.file.close()
+
+    def stop(self):
+        """Writes out everything still queued, then stops the thread"""
+        self.queue.put(_STOP)
+        self.join(timeout=10)
+
+
+def _get_writer(arguments: argparse.Namespace):
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = LogWriter(arguments.log_file, getattr(arguments, "log_max_bytes", 10 * 1024 * 1024),
+                                    getattr(arguments, "log_backups", 3))
+                _writer.start()
+    return _writer
+
+
+def shutdown_logging():
+    """Flushes and closes the log writer. Safe to call more than once; also runs at interpreter exit"""
+    global _writer
+    with _writer_lock:
+        writer = _writer
+        _writer = None
+    if writer is not None:
+        writer.stop()
+
+
+atexit.register(shutdown_logging)
+
+
+def log(output, mode: str, arguments: argparse.Namespace, *format_args):
+    """logs output to the locations indicated by mode: "s" for stdout, "v" for verbose output (includes date and time info), and "f" for logging to file.
+    output is only formatted when one of those locations is enabled: either output.format(*format_args), or output() if
+    output is callable, so pass values as format_args rather than building the string yourself. Records are handed to a
+    background LogWriter rather than written here"""
     if not mode:
         mode = "s"
-        if arguments.verbose:
+        if arguments is not None and arguments.verbose:
             mode += "v"
-        if arguments.log_file:
+        if arguments is not None and arguments.log_file:
             mode += "f"
 
-    log_line = "@{0}: {1}".format(datetime.datetime.now().isoformat(" ", 'seconds'), output)
-    if 's' in mode:
+    # without arguments (a helper built without them) there is neither verbose output nor a log file to write to
+    to_stdout = 's' in mode
+    to_verbose = 'v' in mode and arguments is not None and arguments.verbose
+    to_file = 'f' in mode and arguments is not None and arguments.log_file
+    if not (to_stdout or to_verbose or to_file):
+        return
+
+    if callable(output):
+        output = output()
+    elif format_args:
+        output = output.format(*format_args)
+    else:
+        output = str(output)
+    if arguments is None:
+        # the writer is set up from the arguments, so don't start it with none
         print(output)
-    if 'v' in mode and arguments.verbose:
-        print(log_line)
-    if 'f' in mode and arguments.log_file:
-        try:
-            # 'with' will close the file, even if an exception occurs
-            with(open(arguments.log_file, "a", encoding="utf-8")) as lf:
-                lf.writelines(log_line)
-        except OSError:
-            print("log file at {0} not found".format(arguments.log_file))
+        return
+    log_line = "@{0}: {1}".format(datetime.datetime.now().isoformat(" ", 'seconds'), output)
+    writer = _get_writer(arguments)
+    if to_stdout:
+        writer.queue.put(('s', output))
+    if to_verbose:
+        writer.queue.put(('v', log_line))
+    if to_file:
+        writer.queue.put(('f', log_line))
+
+
+def cluster_mode(arguments: argparse.Namespace):
+    """Returns True if the bot runs as several worker processes (or shards) sharing one SQLite database, see cluster.py"""
+    return bool(getattr(arguments, "shards", None) or getattr(arguments, "processes", 1) > 1)
+
+
+def mention(user_id: int):
+    """Builds the mention for a Discord user ID, the same text as discord.User.mention"""
+    return "<@{0}>".format(user_id)
 
 
 def discord_split(message: str):
+    """Splits an already built message into Discord sized pieces, cutting just after a mention where it can. Each piece
+    is sliced out once, so this is linear in the message length. New code should use chunk_messages instead, which
+    never needs the whole message built first"""
     messages = []
-    if len(message) > 2000:
-        while len(message) > 2000:
-            begin_check = 1972  # user ids can be up to 23 characters based on observation, which we subtract from the below
-            end_check = 1995  # account for the ellipsis because 2000 chars is the max
-            end_index = message.find('>', begin_check, end_check)
-            if end_index == -1:
-                end_index = end_check
-            end_index += 1
-            short = message[:end_index] + "..."
-            message = message[end_index:]
-            messages.append(short)
-        else:
-            messages.append(message)
-    else:
-        messages.append(message)
+    start = 0
+    while len(message) - start > DISCORD_MESSAGE_LIMIT:
+        begin_check = start + 1972  # user ids can be up to 23 characters based on observation, which we subtract from the below
+        end_check = start + 1995  # account for the ellipsis because 2000 chars is the max
+        end_index = message.find('>', begin_check, end_check)
+        if end_index == -1:
+            end_index = end_check
+        end_index += 1
+        messages.append(message[start:end_index] + "...")
+        start = end_index
+    messages.append(message[start:])
     return messages
 
 
+def chunk_messages(items, separator: str = ", ", header: str = "", footer: str = "", limit: int = DISCORD_MESSAGE_LIMIT):
+    """Lazily packs items (mentions, names, alias lines, or whole messages) into messages of at most limit characters,
+    in a single pass over items. header starts the first message, footer ends the last one, and separator goes between
+    items in the same message. An item is never split across messages unless it is longer than limit on its own"""
+    parts = []
+    length = 0
+    has_items = False
+    if header:
+        parts.append(header)
+        length = len(header)
+    for item in items:
+        item = str(item)
+        needed = len(item) + (len(separator) if has_items else 0)
+        if parts and length + needed > limit:
+            yield "".join(parts)
+            parts = []
+            length = 0
+            has_items = False
+            needed = len(item)
+        while len(item) > limit:
+            # only an item that can't fit in a message by itself gets cut
+            yield item[:limit]
+            item = item[limit:]
+            needed = len(item)
+        if has_items:
+            parts.append(separator)
+        parts.append(item)
+        length += needed
+        has_items = True
+    if footer:
+        if parts and length + len(footer) > limit:
+            yield "".join(parts)
+            parts = []
+        parts.append(footer)
+    if parts:
+        yield "".join(parts)
+
+
 def read_token(location: str):
     try:
         with open(location, "r") as f:
@@ -0,0 +1,74 @@
+"""
+In-process caching for WaifuHoarder's hot lookups
+
+(C) 2019-2020 by Jordan Aurora Kinsley
+
+Licensed under MIT License, see LICENSE
+"""
+
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """A bounded least-recently-used cache whose entries also expire after ttl seconds. Counts hits and misses.
+
+    Lookups that miss are filled by the caller after reading storage, which takes a while on the storage thread. To keep
+    a slow read from putting back a value that a write invalidated in the meantime, take a token() before reading and
+    hand it to put(), which ignores the value if anything was invalidated since."""
+
+    def __init__(self, name, maxsize=1024, ttl=300):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (expiry time, value)
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        """Returns the cached value for key. Raises KeyError on a miss, including expired entries"""
+        try:
+            expires, value = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            raise
+        if expires < time.monotonic():
+            del self.entries[key]
+            self.misses += 1
+            raise KeyError(key)
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def token(self):
+        return self.invalidations
+
+    def put(self, key, value, token=None):
+        if token is not None and token != self.invalidations:
+            return
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, *keys):
+        self.invalidations += 1
+        for key in keys:
+            self.entries.pop(key, None)
+
+    def invalidate_prefix(self, prefix):
+        """Drops every key starting with prefix, e.g. a whole server's entries. Costs O(cache size), not O(storage)"""
+        self.invalidations += 1
+        for key in [key for key in self.entries if key.startswith(prefix)]:
+            del self.entries[key]
+
+    def clear(self):
+        self.invalidations += 1
+        self.entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups if lookups else 0.0
+        return "{0}: {1}/{2} entries, {3} hits, {4} misses ({5:.1%} hit rate)".format(
+            self.name, len(self.entries), self.maxsize, self.hits, self.misses, hit_rate)
@@ -0,0 +1,145 @@
+"""
+Cluster mode for WaifuHoarder: runs the bot's gateway shards across several worker processes
+
+(C) 2019-2020 by Jordan Aurora Kinsley
+
+Licensed under MIT License, see LICENSE
+"""
+
+import copy
+import multiprocessing
+import signal
+import time
+import wfbot
+from bothelper import log
+from bothelper import shutdown_logging
+
+# a worker that crashes again within this many seconds of starting waits longer before each restart, up to MAX_BACKOFF
+STABLE_SECONDS = 300
+MAX_BACKOFF = 60
+
+
+def shard_assignment(shard_count, processes):
+    """Splits shards 0..shard_count-1 between processes round robin and returns a list of shard ID lists, one per
+    process. Discord sends a guild's events to shard (guild_id >> 22) % shard_count, so this also splits the guilds"""
+    processes = max(1, min(processes, shard_count))
+    return [list(range(number, shard_count, processes)) for number in range(processes)]
+
+
+def run_worker(args, discord_api_token, shard_ids, shard_count):
+    """Entry point of a worker process: runs one AutoShardedBot for shard_ids over the shared SQLite database"""
+    if args.log_file:
+        # LogWriter rotates its file, which only works if each process has a file of its own
+        args.log_file = "{0}.shard{1}".format(args.log_file, shard_ids[0])
+    # each guild belongs to exactly one shard, and so to one process, so a change a command makes to its own guild
+    # only needs to reach that process' caches. Commands changing every guild at once (dropall, droptable*, importall,
+    # compact) would leave the other processes' caches stale, so the cog refuses them in cluster mode. What the
+    # processes share is the database, which wfbot.open_storage opens shared: every write is committed right away
+    # instead of holding the write lock (and the other processes) until the next flush
+    if args.snapshot:
+        # each process only keeps the servers on its own shards, so each has its own snapshot too
+        args.snapshot = "{0}.shard{1}".format(args.snapshot, shard_ids[0])
+    if args.metrics_port:
+        # one metrics endpoint per worker, since they can't all listen on the same port
+        args.metrics_port += shard_ids[0]
+    try:
+        bot = wfbot.create_bot(args, wfbot.open_storage(args), shard_ids, shard_count)
+        bot.run(discord_api_token)
+    finally:
+        shutdown_logging()
+
+
+class Supervisor:
+    """Starts one worker process per shard group and restarts any that crash, backing off if a worker keeps crashing.
+    A worker that exits cleanly (the owner used the off command) stops the whole cluster"""
+
+    def __init__(self, args, discord_api_token, shard_groups, shard_count):
+        self.args = args
+        self.discord_api_token = discord_api_token
+        self.shard_groups = shard_groups
+        self.shard_count = shard_count
+        # spawned rather than forked, so no worker inherits the parent's threads or open database handles
+        self.context = multiprocessing.get_context("spawn")
+        self.workers = [None] * len(shard_groups)
+        self.started = [0.0] * len(shard_groups)
+        self.backoff = [0.0] * len(shard_groups)
+        self.restart_at = [0.0] * len(shard_groups)
+        self.restarts = 0
+        self.stopping = False
+        self.target = run_worker
+
+    def start_worker(self, number):
+        process = self.context.Process(target=self.target, name="waifu-shards-{0}".format(number),
+                                       args=(copy.copy(self.args), self.discord_api_token, self.shard_groups[number],
+                                             self.shard_count))
+        process.start()
+        self.workers[number] = process
+        self.started[number] = time.monotonic()
+        log("cluster: started worker {0} (pid {1}) for shards {2}", 'sf', self.args, number, process.pid,
+            self.shard_groups[number])
+
+    def stop(self, *_):
+        self.stopping = True
+
+    def check_workers(self):
+        """Restarts crashed workers whose backoff is over. Returns False once the cluster should stop"""
+        now = time.monotonic()
+        for number, process in enumerate(self.workers):
+            if process is None:
+                if now >= self.restart_at[number]:
+                    self.start_worker(number)
+                continue
+            if process.is_alive():
+                continue
+            process.join()
+            if process.exitcode == 0:
+                log("cluster: worker {0} shut down cleanly, stopping the cluster", 'sf', self.args, number)
+                return False
+            if now - self.started[number] >= STABLE_SECONDS:
+                self.backoff[number] = 0.0
+            self.backoff[number] = min(MAX_BACKOFF, self.backoff[number] * 2 or 1.0)
+            self.restart_at[number] = now + self.backoff[number]
+            self.workers[number] = None
+            self.restarts += 1
+            log("cluster: worker {0} for shards {1} exited with {2}, restarting in {3}s", 'sf', self.args, number,
+                self.shard_groups[number], process.exitcode, self.backoff[number])
+        return True
+
+    def run(self):
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+        for number in range(len(self.shard_groups)):
+            self.start_worker(number)
+        while not self.stopping and self.check_workers():
+            time.sleep(1)
+        self.terminate()
+        return 0
+
+    def terminate(self):
+        for process in self.workers:
+            if process is not None and process.is_alive():
+                process.terminate()
+        for process in self.workers:
+            if process is not None:
+                process.join(timeout=30)
+                if process.is_alive():
+                    process.kill()
+
+
+def run_cluster(args, discord_api_token):
+    """Runs the bot as --processes worker processes sharing --shards gateway shards between them. Returns the exit
+    status for the launcher"""
+    if args.backend != "sqlite":
+        # dbm files behind the shelves can't take writes from several processes at once, and the event log lives in
+        # one process's memory; SQLite in WAL mode can
+        print("cluster mode needs the SQLite backend (-b sqlite)")
+        return 1
+    shard_count = args.shards or args.processes
+    shard_groups = shard_assignment(shard_count, args.processes)
+    # create the schema (and run any migration) once, before the workers all try at the same time
+    wfbot.open_storage(args).close()
+    args.migrate = False
+    log("cluster: {0} shards over {1} processes", 'sf', args, shard_count, len(shard_groups))
+    status = Supervisor(args, discord_api_token, shard_groups, shard_count).run()
+    shutdown_logging()
+    return status
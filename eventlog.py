@@ -0,0 +1,598 @@
+"""
+Append-only event log storage engine for WaifuHoarder
+
+Every notice, alias and setting is kept in memory. Each change is also written down as a small event (a sign up, a
+stop, an alias...) and appended to a log file, instead of rewriting the whole notice list the way a shelf does. Events
+wait in memory until the next flush, which appends all of them with a single write and fsync (a group commit), so a
+burst of sign ups costs one sequential write.
+
+Once the logs grow past compact_bytes, the whole state is written to a checkpoint file on a thread of its own and the
+logs it covers are deleted. On start up the checkpoint is loaded and the logs written after it are replayed in order.
+
+Files, for a location L:
+    L               checkpoint: framed like snapshot.py's files (header, CRC32, pickled state), under its own magic
+    L.<n>.log       log generation n: records of (payload length, CRC32 of the payload, pickled event)
+Every start opens a new generation, and so does every checkpoint, which covers every generation before its own. A
+record cut short or failing its checksum (the end of a log being written when the process died) ends that log's replay.
+
+(C) 2019-2020 by Jordan Aurora Kinsley
+
+Licensed under MIT License, see LICENSE
+"""
+
+import os
+import pickle
+import struct
+import uuid
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+import maintenance
+import snapshot
+from indexes import make_key
+from storage import Storage
+from subscribers import SubscriberSet
+
+CHECKPOINT_MAGIC = b'WAIFULOG'
+LOG_SUFFIX = '.log'
+RECORD = struct.Struct('>II')
+# log bytes written since the last checkpoint that start a new one
+COMPACT_BYTES = 16 * 1024 * 1024
+
+# event types, the first item of every event. They are written to the logs as numbers, so never renumber them; new
+# ones go at the end
+(SUBSCRIBE,  # (server, character, users): creates character if needed and signs up users, which may be empty
+ UNSUBSCRIBE,  # (server, character, user)
+ REMOVE_USER,  # (server, user): from every notice on server
+ REMOVE_CHARACTER,  # (server, character)
+ RENAME_CHARACTER,  # (server, character, new name)
+ DROP_NOTICES,  # (server,)
+ CLEAR_NOTICES,  # (new epoch,)
+ SET_ALIAS,  # (server, alias, character)
+ REMOVE_ALIAS,  # (server, alias)
+ DROP_ALIASES,  # (server,)
+ CLEAR_ALIASES,  # (new epoch,)
+ WATCH,  # (server, channel)
+ UNWATCH,  # (server, channel)
+ ROLE_MODE,  # (server, enabled)
+ NEW_EPOCH,  # (epoch,): written once, when the store is created
+ BOT_ROLE,  # (server, role, made): made is False once the role is gone
+ ) = range(16)
+
+
+def encode(event):
+    """Returns event as a log record"""
+    payload = pickle.dumps(event, pickle.HIGHEST_PROTOCOL)
+    return RECORD.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def decode(data):
+    """Reads the events out of the contents of a log, stopping at the first record that is cut short or fails its
+    checksum. Returns an (events, end) tuple, end being the offset the last whole record ends at"""
+    events = []
+    offset = 0
+    view = memoryview(data)
+    while offset + RECORD.size <= len(data):
+        length, checksum = RECORD.unpack_from(data, offset)
+        payload = view[offset + RECORD.size:offset + RECORD.size + length]
+        if len(payload) != length or zlib.crc32(payload) != checksum:
+            break
+        try:
+            events.append(pickle.loads(payload))
+        except Exception:
+            break
+        offset += RECORD.size + length
+    return events, offset
+
+
+class EventLogStorage(Storage):
+    """Storage engine keeping everything in memory, backed by an append-only log of changes and a checkpoint of the
+    whole state taken whenever the log has grown past compact_bytes"""
+
+    def __init__(self, location, compact_bytes=COMPACT_BYTES):
+        self.location = location
+        self.compact_bytes = compact_bytes
+        # checkpoints are written on a thread of their own, so the storage thread only pays for pickling the state
+        self.checkpointer = ThreadPoolExecutor(max_workers=1)
+        self.checkpointing = None  # Future of the checkpoint being written
+        self.checkpoint_error = None  # the exception the last checkpoint failed with, if it did
+        self.checkpoints = 0
+        self.log = None
+        self._open()
+
+    def _open(self):
+        # server -> {character: SubscriberSet}
+        self.notices = {}
+        # server -> {user ID: set of characters}, so per-user commands don't look at every notice
+        self.users = {}
+        # server -> {alias: character}
+        self.guild_aliases = {}
+        # server -> set of channel IDs with automatic notices on
+        self.channels = {}
+        self.role_guilds = set()
+        # server -> set of IDs of the roles the bot made there
+        self.role_ids = {}
+        # server -> name version, see Storage.name_versions. Kept for servers that are gone too, so one coming back
+        # can't reuse a version an old snapshot has
+        self.versions = {}
+        self.epoch = None
+        self.pending = []  # records waiting for the next flush
+        self.replayed = 0  # events read back from the logs on start up
+        self.discarded = 0  # bytes at the end of logs that weren't whole records
+        try:
+            covered = self._load(snapshot.read(self.location, CHECKPOINT_MAGIC))
+        except FileNotFoundError:
+            covered = 0
+        self.generation = covered
+        self.log_bytes = 0
+        for generation, path in self._logs():
+            with open(path, 'rb') as log_file:
+                data = log_file.read()
+            if generation <= covered or not data:
+                # covered by a checkpoint written just before we stopped, or opened by a start that wrote nothing
+                os.remove(path)
+                continue
+            events, end = decode(data)
+            for event in events:
+                self._apply(event)
+            self.replayed += len(events)
+            self.discarded += len(data) - end
+            self.generation = max(self.generation, generation)
+            self.log_bytes += len(data)
+        self._open_log(self.generation + 1)
+        if self.epoch is None:
+            self._record(NEW_EPOCH, uuid.uuid4().hex)
+
+    def _logs(self):
+        """Returns a (generation, path) tuple for every log next to the checkpoint, oldest first"""
+        directory, name = os.path.split(self.location)
+        logs = []
+        for entry in os.listdir(directory or '.'):
+            generation = entry[len(name) + 1:-len(LOG_SUFFIX)]
+            if entry.startswith(name + '.') and entry.endswith(LOG_SUFFIX) and generation.isdigit():
+                logs.append((int(generation), os.path.join(directory, entry)))
+        return sorted(logs)
+
+    def _open_log(self, generation):
+        if self.log is not None:
+            self.log.close()
+        self.generation = generation
+        self.log = open("{0}.{1}{2}".format(self.location, generation, LOG_SUFFIX), 'ab', buffering=0)
+
+    def _state(self, generation):
+        """The whole state as a checkpoint covering every log up to generation"""
+        return {"generation": generation, "epoch": self.epoch, "versions": dict(self.versions),
+                "notices": {server: {character: subscribers.to_bytes() for character, subscribers in notices.items()}
+                            for server, notices in self.notices.items()},
+                "aliases": {server: dict(aliases) for server, aliases in self.guild_aliases.items()},
+                "channels": {server: set(channels) for server, channels in self.channels.items()},
+                "roles": set(self.role_guilds),
+                "role_ids": {server: set(roles) for server, roles in self.role_ids.items()}}
+
+    def _load(self, state):
+        """Takes over the state of a checkpoint and returns the generation it covers"""
+        self.epoch = state["epoch"]
+        self.versions = state["versions"]
+        self.guild_aliases = state["aliases"]
+        self.channels = state["channels"]
+        self.role_guilds = state["roles"]
+        # checkpoints from before role IDs were kept don't have any
+        self.role_ids = state.get("role_ids", {})
+        for server, notices in state["notices"].items():
+            self.notices[server] = {}
+            for character, packed in notices.items():
+                subscribers = self.notices[server][character] = SubscriberSet.from_bytes(packed)
+                for user in subscribers:
+                    self.users.setdefault(server, {}).setdefault(user, set()).add(character)
+        return state["generation"]
+
+    def _files_size(self):
+        paths = [self.location] + [path for _, path in self._logs()]
+        return sum(os.path.getsize(path) for path in paths if os.path.isfile(path))
+
+    def _record(self, *event):
+        """Applies event to the state in memory and queues it for the log"""
+        self._apply(event)
+        self.pending.append(encode(event))
+
+    def _bump(self, server):
+        self.versions[server] = self.versions.get(server, 0) + 1
+
+    def _apply(self, event):
+        """Makes the change event stands for. Used both for new changes and for replaying the logs, so it must take
+        the state to the same place either way"""
+        kind = event[0]
+        if kind == SUBSCRIBE:
+            _, server, character, users = event
+            notices = self.notices.setdefault(server, {})
+            if character not in notices:
+                notices[character] = SubscriberSet()
+                self._bump(server)
+            for user in users:
+                if notices[character].add(user):
+                    self.users.setdefault(server, {}).setdefault(user, set()).add(character)
+        elif kind == UNSUBSCRIBE:
+            _, server, character, user = event
+            if self.notices.get(server, {}).get(character, SubscriberSet()).remove(user):
+                self._forget_user(server, user, character)
+        elif kind == REMOVE_USER:
+            _, server, user = event
+            for character in self.users.get(server, {}).pop(user, set()):
+                self.notices[server][character].remove(user)
+            self._prune(self.users, server)
+        elif kind == REMOVE_CHARACTER:
+            _, server, character = event
+            removed = self.notices.get(server, {}).pop(character, None)
+            if removed is not None:
+                for user in removed:
+                    self._forget_user(server, user, character)
+                self._prune(self.notices, server)
+                self._bump(server)
+        elif kind == RENAME_CHARACTER:
+            _, server, character, new_name = event
+            renamed = self.notices.get(server, {}).pop(character, None)
+            if renamed is not None:
+                for user in renamed:
+                    self._forget_user(server, user, character)
+                self._apply((SUBSCRIBE, server, new_name, tuple(renamed)))
+                self._bump(server)
+        elif kind == DROP_NOTICES:
+            _, server = event
+            if self.notices.pop(server, None) is not None:
+                self._bump(server)
+            self.users.pop(server, None)
+        elif kind == CLEAR_NOTICES:
+            # every server may have changed, which a new epoch says more cheaply than bumping each one
+            self.notices.clear()
+            self.users.clear()
+            self.epoch = event[1]
+        elif kind == SET_ALIAS:
+            _, server, alias, character = event
+            self.guild_aliases.setdefault(server, {})[alias] = character
+            self._bump(server)
+        elif kind == REMOVE_ALIAS:
+            _, server, alias = event
+            if self.guild_aliases.get(server, {}).pop(alias, None) is not None:
+                self._prune(self.guild_aliases, server)
+                self._bump(server)
+        elif kind == DROP_ALIASES:
+            _, server = event
+            if self.guild_aliases.pop(server, None) is not None:
+                self._bump(server)
+        elif kind == CLEAR_ALIASES:
+            self.guild_aliases.clear()
+            self.epoch = event[1]
+        elif kind == WATCH:
+            _, server, channel = event
+            self.channels.setdefault(server, set()).add(channel)
+            self._bump(server)
+        elif kind == UNWATCH:
+            _, server, channel = event
+            self.channels.get(server, set()).discard(channel)
+            self._prune(self.channels, server)
+            self._bump(server)
+        elif kind == ROLE_MODE:
+            _, server, enabled = event
+            if enabled:
+                self.role_guilds.add(server)
+            else:
+                self.role_guilds.discard(server)
+        elif kind == NEW_EPOCH:
+            self.epoch = event[1]
+        elif kind == BOT_ROLE:
+            _, server, role, made = event
+            if made:
+                self.role_ids.setdefault(server, set()).add(role)
+            else:
+                self.role_ids.get(server, set()).discard(role)
+                self._prune(self.role_ids, server)
+        else:
+            raise ValueError("unknown event {0!r}".format(event))
+
+    def _forget_user(self, server, user, character):
+        """Takes character off user's entry in the user index"""
+        characters = self.users.get(server, {}).get(user)
+        if characters is not None:
+            characters.discard(character)
+            if not characters:
+                del self.users[server][user]
+                self._prune(self.users, server)
+
+    @staticmethod
+    def _prune(table, server):
+        """Drops server from table once it has nothing left in it"""
+        if server in table and not table[server]:
+            del table[server]
+
+    def close(self):
+        self.flush()
+        self._finish_checkpoint()
+        self.checkpointer.shutdown()
+        self.log.close()
+
+    def sync(self):
+        # flush() already waits for the disk
+        self.flush()
+
+    def dirty_count(self):
+        return len(self.pending)
+
+    def flush(self, limit=None):
+        if not self.pending:
+            return 0
+        records = self.pending[:limit]
+        data = b''.join(records)
+        start = self.log.tell()
+        try:
+            self._write(data)
+            os.fsync(self.log.fileno())
+        except Exception:
+            # the records stay pending for the next flush; anything that did reach the file is cut off again, since
+            # replay stops at the first torn record and would leave out every record appended after it
+            self._rewind(start)
+            raise
+        del self.pending[:len(records)]
+        self.bytes_written += len(data)
+        self.log_bytes += len(data)
+        if self.checkpointing is not None and self.checkpointing.done():
+            self._finish_checkpoint()
+        # a checkpoint has to match the logs before it exactly, so none is started while events are still waiting
+        if self.log_bytes >= self.compact_bytes and self.checkpointing is None and not self.pending:
+            self._start_checkpoint()
+        return len(records)
+
+    def _rewind(self, offset):
+        """Cuts the log back to offset after a failed write. If even that fails, moves on to a new generation, so the
+        next records don't land after a torn one"""
+        try:
+            self.log.truncate(offset)
+            self.log.seek(offset)
+        except OSError:
+            self._open_log(self.generation + 1)
+
+    def _write(self, data):
+        """Writes all of data to the log, which is unbuffered, so nothing of a failed write is left to go out later"""
+        view = memoryview(data)
+        while view:
+            view = view[self.log.write(view):]
+
+    def _start_checkpoint(self):
+        """Moves on to a new log and starts writing a checkpoint of everything before it on the checkpointer thread.
+        The state is pickled here, on the storage thread, so it can't change while it is read"""
+        covered = self.generation
+        payload = pickle.dumps(self._state(covered), pickle.HIGHEST_PROTOCOL)
+        self._open_log(covered + 1)
+        self.log_bytes = 0
+        self.checkpointing = self.checkpointer.submit(self._write_checkpoint, payload, covered)
+        return self.checkpointing
+
+    def _write_checkpoint(self, payload, covered):
+        snapshot.write_payload(self.location, payload, CHECKPOINT_MAGIC)
+        for generation, path in self._logs():
+            if generation <= covered:
+                os.remove(path)
+
+    def _finish_checkpoint(self):
+        """Waits for the checkpoint being written, if there is one. Returns the exception it failed with, or None"""
+        if self.checkpointing is None:
+            return None
+        # a failed checkpoint leaves its logs in place, so nothing is lost; the next one is tried once the log has
+        # grown past compact_bytes again, and compact() reports the error meanwhile
+        self.checkpoint_error = self.checkpointing.exception()
+        if self.checkpoint_error is None:
+            self.checkpoints += 1
+        self.checkpointing = None
+        return self.checkpoint_error
+
+    def compact(self, drop_dangling=False):
+        report = maintenance.CompactionReport()
+        self.flush()
+        self._finish_checkpoint()
+        report.size_before = self._files_size()
+        if self.checkpoint_error is not None:
+            report.problems.append("the last background checkpoint failed: {0}".format(self.checkpoint_error))
+        if self.discarded:
+            report.problems.append("{0} bytes at the end of the logs weren't whole records and were left out on "
+                                   "start up".format(self.discarded))
+        targets, report.dangling_aliases = maintenance.check_aliases(
+            {server: list(notices) for server, notices in self.notices.items()},
+            {server: dict(aliases) for server, aliases in self.guild_aliases.items()})
+        if drop_dangling:
+            for server, alias, _ in report.dangling_aliases:
+                self._record(REMOVE_ALIAS, server, alias)
+                report.dropped_aliases += 1
+        for server, notices in list(self.notices.items()):
+            for character in [character for character, users in notices.items() if not users]:
+                if character not in targets.get(server, ()):
+                    self._record(REMOVE_CHARACTER, server, character)
+                    report.dropped_notices += 1
+        # the checkpoint is written right away instead of in the background, so the size after is the real one
+        self.flush()
+        self._finish_checkpoint()
+        self._start_checkpoint()
+        failed = self._finish_checkpoint()
+        if failed is not None:
+            raise failed
+        report.size_after = self._files_size()
+        return report
+
+    def is_empty(self):
+        return not (self.notices or self.guild_aliases or self.channels or self.role_guilds or self.role_ids)
+
+    def has_character(self, server, character):
+        return character in self.notices.get(str(server), {})
+
+    def add_character(self, server, character):
+        if not self.has_character(server, character):
+            self._record(SUBSCRIBE, str(server), character, ())
+
+    def subscribers(self, server, character):
+        try:
+            packed = self.notices[str(server)][character].to_bytes()
+        except KeyError:
+            raise KeyError(make_key(server, character))
+        # a copy, since the cog reads it on the event loop while the storage thread may be changing the original
+        self.bytes_read += len(packed)
+        return SubscriberSet.from_bytes(packed)
+
+    def add_subscriber(self, server, character, user):
+        current = self.notices.get(str(server), {}).get(character)
+        if current is not None and user in current:
+            return False, False
+        self._record(SUBSCRIBE, str(server), character, (user,))
+        return True, current is None
+
+    def add_subscribers(self, server, character, users):
+        # one event for the whole batch
+        current = self.notices.get(str(server), {}).get(character, SubscriberSet())
+        added = tuple(user for user in dict.fromkeys(users) if user not in current)
+        if added or not self.has_character(server, character):
+            self._record(SUBSCRIBE, str(server), character, added)
+        return len(added)
+
+    def remove_subscriber(self, server, character, user):
+        try:
+            current = self.notices[str(server)][character]
+        except KeyError:
+            raise KeyError(make_key(server, character))
+        if user not in current:
+            return False
+        self._record(UNSUBSCRIBE, str(server), character, user)
+        return True
+
+    def remove_user(self, server, user):
+        removed = self.user_characters(server, user)
+        if removed:
+            self._record(REMOVE_USER, str(server), user)
+        return removed
+
+    def user_characters(self, server, user):
+        return set(self.users.get(str(server), {}).get(user, ()))
+
+    def characters(self, server):
+        return set(self.notices.get(str(server), ()))
+
+    def remove_character(self, server, character):
+        if not self.has_character(server, character):
+            raise KeyError(make_key(server, character))
+        self._record(REMOVE_CHARACTER, str(server), character)
+
+    def rename_character(self, server, character, new_name):
+        if not self.has_character(server, character):
+            raise KeyError(make_key(server, character))
+        self._record(RENAME_CHARACTER, str(server), character, new_name)
+
+    def drop_server_notices(self, server):
+        if str(server) in self.notices:
+            self._record(DROP_NOTICES, str(server))
+
+    def clear_notices(self):
+        self._record(CLEAR_NOTICES, uuid.uuid4().hex)
+
+    def all_notices(self):
+        # listed up front, so changes made while the caller goes through them can't break the iteration
+        for server, character in [(server, character) for server, notices in self.notices.items()
+                                  for character in notices]:
+            try:
+                yield server, character, self.subscribers(server, character)
+            except KeyError:
+                pass
+
+    def get_alias(self, server, alias):
+        try:
+            return self.guild_aliases[str(server)][alias]
+        except KeyError:
+            raise KeyError(make_key(server, alias))
+
+    def get_aliases(self, server, aliases):
+        server_aliases = self.guild_aliases.get(str(server), {})
+        return {alias: server_aliases[alias] for alias in aliases if alias in server_aliases}
+
+    def set_alias(self, server, alias, character):
+        self._record(SET_ALIAS, str(server), alias, character)
+
+    def remove_alias(self, server, alias):
+        self.get_alias(server, alias)
+        self._record(REMOVE_ALIAS, str(server), alias)
+
+    def aliases(self, server):
+        return dict(self.guild_aliases.get(str(server), {}))
+
+    def drop_server_aliases(self, server):
+        if str(server) in self.guild_aliases:
+            self._record(DROP_ALIASES, str(server))
+
+    def clear_aliases(self):
+        self._record(CLEAR_ALIASES, uuid.uuid4().hex)
+
+    def all_aliases(self):
+        return iter([(server, alias, character) for server, aliases in self.guild_aliases.items()
+                     for alias, character in aliases.items()])
+
+    def watched_channels(self, server):
+        return set(self.channels.get(str(server), ()))
+
+    def watch_channel(self, server, channel):
+        if channel in self.channels.get(str(server), ()):
+            return False
+        self._record(WATCH, str(server), channel)
+        return True
+
+    def unwatch_channel(self, server, channel):
+        if channel not in self.channels.get(str(server), ()):
+            return False
+        self._record(UNWATCH, str(server), channel)
+        return True
+
+    def all_watched_channels(self):
+        return iter([(server, channel) for server, channels in self.channels.items() for channel in channels])
+
+    def role_servers(self):
+        return set(self.role_guilds)
+
+    def set_role_mode(self, server, enabled):
+        if (str(server) in self.role_guilds) == enabled:
+            return False
+        self._record(ROLE_MODE, str(server), enabled)
+        return True
+
+    def bot_roles(self, server):
+        return set(self.role_ids.get(str(server), ()))
+
+    def add_bot_role(self, server, role):
+        if role not in self.role_ids.get(str(server), ()):
+            self._record(BOT_ROLE, str(server), role, True)
+
+    def remove_bot_role(self, server, role):
+        if role in self.role_ids.get(str(server), ()):
+            self._record(BOT_ROLE, str(server), role, False)
+
+    def servers(self):
+        return set(self.notices) | set(self.guild_aliases) | set(self.channels) | self.role_guilds | set(self.role_ids)
+
+    def all_users(self):
+        return iter([(server, user) for server, users in self.users.items() for user in users])
+
+    def purge_server(self, server, limit=None):
+        server = str(server)
+        removed = 0
+        for kind, names in ((REMOVE_CHARACTER, self.notices.get(server, {})),
+                            (REMOVE_ALIAS, self.guild_aliases.get(server, {}))):
+            for name in sorted(names)[:None if limit is None else limit - removed]:
+                self._record(kind, server, name)
+                removed += 1
+            if limit is not None and removed >= limit:
+                return removed
+        if server in self.channels:
+            for channel in self.watched_channels(server):
+                self._record(UNWATCH, server, channel)
+            removed += 1
+        if self.set_role_mode(server, False):
+            removed += 1
+        # the roles went with the server
+        for role in self.bot_roles(server):
+            self._record(BOT_ROLE, server, role, False)
+        return removed
+
+    def name_versions(self):
+        servers = set(self.notices) | set(self.guild_aliases) | set(self.channels)
+        return self.epoch, {server: self.versions.get(server, 0) for server in servers}
@@ -0,0 +1,216 @@
+"""
+Secondary indexes over the WaifuHoarder shelves
+
+(C) 2019-2020 by Jordan Aurora Kinsley
+
+Licensed under MIT License, see LICENSE
+"""
+
+import uuid
+from subscribers import SubscriberSet
+from writebehind import open_shelf
+
+# shelf keys are stored as <server>\<name>, see Waifu.do_you_know for why the delimiter is a backslash
+KEY_DELIMITER = '\\'
+# the index shelf only holds keys of the form <kind>\<server>, so these can never collide with a real entry
+BUILT_KEY = '__built__'
+EPOCH_KEY = '__epoch__'
+
+
+def make_key(server, name):
+    """Builds a shelf key from a server ID and a character or alias name"""
+    return str(server) + KEY_DELIMITER + str(name)
+
+
+def split_key(key):
+    """Splits a shelf key into a (server, name) tuple"""
+    key_t = key.partition(KEY_DELIMITER)
+    return key_t[0], key_t[2]
+
+
+class GuildIndex:
+    """Persistent secondary index from a server ID to the character and alias names stored for that server.
+    Lets per-server listings and drops touch only that server's keys instead of every key in the shelves.
+    Also keeps a version per server, bumped whenever its names or watched channels change, and an epoch that changes
+    whenever the whole index is rebuilt or cleared, so a snapshot (see snapshot.py) can tell which servers it is
+    still right about."""
+    CHARACTERS = 'c'
+    ALIASES = 'a'
+    VERSIONS = 'v'
+
+    def __init__(self, location):
+        self.location = location
+        self.index = open_shelf(location)
+
+    def close(self):
+        self.index.close()
+
+    def is_built(self):
+        return BUILT_KEY in self.index
+
+    def mark_built(self, built):
+        """Sets or clears the built marker on disk right away, so an interrupted flush forces a rebuild on next start"""
+        if built:
+            self.index.write_through(BUILT_KEY, True)
+        else:
+            self.index.delete_through(BUILT_KEY)
+
+    def rebuild(self, notify_user_list, character_aliases):
+        """Rebuilds the index with a single pass over both shelves. Only needed if the index file is missing"""
+        self.index.clear()
+        grouped = {}
+        for kind, shelf in ((self.CHARACTERS, notify_user_list), (self.ALIASES, character_aliases)):
+            for key in shelf.keys():
+                server, name = split_key(key)
+                grouped.setdefault(make_key(kind, server), set()).add(name)
+        for index_key, names in grouped.items():
+            self.index[index_key] = names
+        self.index[EPOCH_KEY] = uuid.uuid4().hex
+        self.index[BUILT_KEY] = True
+
+    def epoch(self):
+        """Returns the epoch of the index, None for one built before epochs were kept"""
+        return self.index.get(EPOCH_KEY)
+
+    def bump(self, server):
+        """Marks <server>'s names or watched channels as changed"""
+        version_key = make_key(self.VERSIONS, server)
+        self.index[version_key] = self.index.get(version_key, 0) + 1
+
+    def versions(self, servers=()):
+        """Returns a dict of every server with names in the index, plus <servers>, to its version (0 if never bumped)"""
+        versions = dict.fromkeys((str(server) for server in servers), 0)
+        for index_key in self.index.keys():
+            kind, server = split_key(index_key)
+            if kind == self.VERSIONS:
+                versions[server] = self.index[index_key]
+            elif kind in (self.CHARACTERS, self.ALIASES):
+                versions.setdefault(server, 0)
+        return versions
+
+    def servers(self):
+        """Returns the set of servers with characters or aliases in the index"""
+        servers = set()
+        for index_key in self.index.keys():
+            kind, server = split_key(index_key)
+            if kind in (self.CHARACTERS, self.ALIASES):
+                servers.add(server)
+        return servers
+
+    def names(self, kind, server):
+        """Returns a copy of the set of names of the given kind stored for server"""
+        # a copy, since the stored set may be sitting in the write-behind queue, where add() and discard() on the
+        # storage thread would change it under a caller iterating it on the event loop
+        try:
+            return set(self.index[make_key(kind, server)])
+        except KeyError:
+            return set()
+
+    def add(self, kind, server, name):
+        names = self.names(kind, server)
+        if name not in names:
+            names.add(name)
+            self.index[make_key(kind, server)] = names
+            self.bump(server)
+
+    def discard(self, kind, server, name):
+        names = self.names(kind, server)
+        if name in names:
+            names.discard(name)
+            if names:
+                self.index[make_key(kind, server)] = names
+            else:
+                del self.index[make_key(kind, server)]
+            self.bump(server)
+
+    def drop(self, kind, server):
+        """Removes every name of the given kind for server from the index and returns them"""
+        names = self.names(kind, server)
+        if names:
+            del self.index[make_key(kind, server)]
+            self.bump(server)
+        return names
+
+    def clear(self, kind):
+        """Removes every entry of the given kind, for all servers"""
+        for index_key in list(self.index.keys()):
+            if index_key != BUILT_KEY and split_key(index_key)[0] == kind:
+                del self.index[index_key]
+        # every server may have changed, which a new epoch says more cheaply than bumping each one
+        self.index[EPOCH_KEY] = uuid.uuid4().hex
+
+
+class UserIndex:
+    """Persistent reverse index from a (server, user ID) pair to the characters that user gets notices for on that server.
+    Lets per-user commands touch only that user's own entries instead of every notice list on every server."""
+    # bumped whenever what the index is keyed by changes, so older indexes get rebuilt. 2: keyed by user ID, not mention
+    VERSION = 2
+
+    def __init__(self, location):
+        self.location = location
+        self.index = open_shelf(location)
+
+    def close(self):
+        self.index.close()
+
+    def is_built(self):
+        return self.index.get(BUILT_KEY) == self.VERSION
+
+    def mark_built(self, built):
+        """Sets or clears the built marker on disk right away, so an interrupted flush forces a rebuild on next start"""
+        if built:
+            self.index.write_through(BUILT_KEY, self.VERSION)
+        else:
+            self.index.delete_through(BUILT_KEY)
+
+    def rebuild(self, notify_user_list):
+        """Rebuilds the index with a single pass over the notice shelf. Only needed if the index file is missing"""
+        self.index.clear()
+        grouped = {}
+        for key in notify_user_list.keys():
+            server, character = split_key(key)
+            for user in SubscriberSet.load(notify_user_list[key]):
+                grouped.setdefault(make_key(server, user), set()).add(character)
+        for index_key, characters in grouped.items():
+            self.index[index_key] = characters
+        self.index[BUILT_KEY] = self.VERSION
+
+    def users(self):
+        """Yields a (server, user ID) tuple for every user signed up for anything"""
+        for index_key in self.index.keys():
+            if index_key != BUILT_KEY:
+                server, user = split_key(index_key)
+                yield server, int(user)
+
+    def characters(self, server, user):
+        """Returns a copy of the set of characters user is signed up for on server, see GuildIndex.names"""
+        try:
+            return set(self.index[make_key(server, user)])
+        except KeyError:
+            return set()
+
+    def add(self, server, user, character):
+        characters = self.characters(server, user)
+        if character not in characters:
+            characters.add(character)
+            self.index[make_key(server, user)] = characters
+
+    def discard(self, server, user, character):
+        characters = self.characters(server, user)
+        if character in characters:
+            characters.discard(character)
+            if characters:
+                self.index[make_key(server, user)] = characters
+            else:
+                del self.index[make_key(server, user)]
+
+    def drop(self, server, user):
+        """Removes every character for user on server from the index and returns them"""
+        characters = self.characters(server, user)
+        if characters:
+            del self.index[make_key(server, user)]
+        return characters
+
+    def clear(self):
+        self.index.clear()
+        self.index[BUILT_KEY] = self.VERSION
@@ -0,0 +1,421 @@
+"""
+Load test for WaifuHoarder: runs the real bot from wfbot.py against a stand-in Discord gateway and HTTP API
+
+benchmark.py calls the cog's methods directly. Here every command arrives as a message event, the way the gateway
+delivers it, and goes through commands.Bot's parsing, checks, error handlers, ctx.typing() and ctx.send before reaching
+a fake HTTP API that answers like Discord would. Nothing connects to Discord, and no token is needed.
+
+Usage: python loadtest.py --guilds 200 --users 5000 --rate 100 --duration 60 --mix its=30,itsm=10,notifyme=15
+Options loadtest.py doesn't know are passed on to the bot, e.g. --cache-size 4096 or -b sqlite. With --role-mode every
+guild has role notices on (see roles.py), and the fake API also takes the bot's role changes.
+
+(C) 2019-2020 by Jordan Aurora Kinsley
+
+Licensed under MIT License, see LICENSE
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+import discord
+import wfbot
+from benchmark import character_name, percentile
+
+# the share of commands each one gets unless --mix says otherwise. removewaifu is always refused, since the simulated
+# users don't have Manage Server, so it covers the permission check and error handler path
+DEFAULT_MIX = ("its=30,itsm=10,notifyme=15,stopnotify=5,mynotices=10,knownwaifus=10,knownaliases=5,doyouknow=5,"
+               "alias=5,removewaifu=5")
+# ID ranges of the simulated objects, far enough apart that they never overlap
+FIRST_GUILD = 100000000000000000
+FIRST_USER = 200000000000000000
+FIRST_CHANNEL = 300000000000000000
+FIRST_MESSAGE = 400000000000000000
+BOT_USER = 500000000000000000
+OWNER = 500000000000000001
+
+
+def user_payload(user_id, bot=False):
+    return {"id": str(user_id), "username": "user {0}".format(user_id), "discriminator": "0001", "avatar": None,
+            "bot": bot}
+
+
+def message_payload(message_id, channel_id, author, content):
+    """A MESSAGE_CREATE payload, as the gateway sends it and the HTTP API returns it"""
+    return {"id": str(message_id), "channel_id": str(channel_id), "author": author, "content": content or "",
+            "attachments": [], "embeds": [], "mentions": [], "mention_roles": [], "mention_everyone": False,
+            "pinned": False, "tts": False, "type": 0, "edited_timestamp": None}
+
+
+class FakeHTTP:
+    """Stands in for discord.py's HTTPClient. Answers what ctx.send, ctx.typing() and the role notices call after a
+    simulated round trip and counts it, instead of making requests. Role and member changes are echoed back to the
+    connection state as the gateway events Discord would send, so the bot's cache follows them"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.bot_user = user_payload(BOT_USER, bot=True)
+        self.next_id = FIRST_MESSAGE + 10 ** 15
+        self.messages = 0
+        self.files = 0
+        self.typing = 0
+        self.role_mentions = 0  # messages mentioning a role
+        self.role_calls = 0  # roles created and deleted, and roles given to or taken from members
+        # (guild ID, member ID) -> the IDs of the roles the member holds, once the bot has changed them
+        self.member_roles = {}
+        self.sent_at = []  # time.monotonic() of every message and file sent
+        # the connection state the gateway events go to, set by FakeGateway
+        self.state = None
+
+    async def _round_trip(self):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    def _echo(self, event, data):
+        """Delivers the gateway event that follows a change, just after the request's answer"""
+        asyncio.get_event_loop().call_soon(getattr(self.state, 'parse_' + event), data)
+
+    async def _message(self, channel_id, content):
+        await self._round_trip()
+        self.next_id += 1
+        self.sent_at.append(time.monotonic())
+        return message_payload(self.next_id, channel_id, self.bot_user, content)
+
+    async def send_message(self, channel_id, content, *, tts=False, embed=None, nonce=None):
+        self.messages += 1
+        if content and '<@&' in content:
+            self.role_mentions += 1
+        return await self._message(channel_id, content)
+
+    async def send_files(self, channel_id, *, files, content=None, tts=False, embed=None, nonce=None):
+        self.files += 1
+        return await self._message(channel_id, content)
+
+    async def send_typing(self, channel_id):
+        self.typing += 1
+
+    async def delete_message(self, channel_id, message_id, *, reason=None):
+        pass
+
+    async def create_role(self, guild_id, *, reason=None, **fields):
+        await self._round_trip()
+        self.role_calls += 1
+        self.next_id += 1
+        role = {"id": str(self.next_id), "name": fields.get("name", "new role"), "position": 1, "managed": False,
+                "permissions": fields.get("permissions", 0), "color": fields.get("color", 0),
+                "hoist": fields.get("hoist", False), "mentionable": fields.get("mentionable", False)}
+        self._echo('guild_role_create', {"guild_id": str(guild_id), "role": role})
+        return role
+
+    async def delete_role(self, guild_id, role_id, *, reason=None):
+        await self._round_trip()
+        self.role_calls += 1
+        self._echo('guild_role_delete', {"guild_id": str(guild_id), "role_id": str(role_id)})
+
+    async def add_role(self, guild_id, user_id, role_id, *, reason=None):
+        await self._member_roles(guild_id, user_id, lambda roles: roles | {role_id})
+
+    async def remove_role(self, guild_id, user_id, role_id, *, reason=None):
+        await self._member_roles(guild_id, user_id, lambda roles: roles - {role_id})
+
+    async def _member_roles(self, guild_id, user_id, change):
+        """Changes a member's roles, kept here rather than read from the cache, which only catches up once the echo
+        has been delivered"""
+        await self._round_trip()
+        self.role_calls += 1
+        key = (int(guild_id), int(user_id))
+        if key not in self.member_roles:
+            member = self.state._get_guild(key[0]).get_member(key[1])
+            self.member_roles[key] = {role.id for role in member.roles if not role.is_default()}
+        roles = self.member_roles[key] = change(self.member_roles[key])
+        self._echo('guild_member_update', {"guild_id": str(guild_id), "user": user_payload(user_id),
+                                           "roles": [str(role) for role in roles]})
+
+    async def close(self):
+        pass
+
+
+class FakeGateway:
+    """Stands in for the gateway: fills the bot's connection state with guilds, channels and members the way the
+    GUILD_CREATE events would, then delivers messages to it as MESSAGE_CREATE events"""
+
+    def __init__(self, bot, http):
+        self.bot = bot
+        self.state = bot._connection
+        # the bot never logs in, so its HTTP client is swapped out before anything can use it
+        self.state.http = bot.http = http
+        http.state = self.state
+        self.state.user = discord.ClientUser(state=self.state, data=http.bot_user)
+        self.next_id = FIRST_MESSAGE
+
+    def add_guild(self, guild_id, members):
+        """Adds a guild with one text channel and <members>, where @everyone has the usual text permissions but not
+        Manage Server. Returns the guild's channel"""
+        channel_id = FIRST_CHANNEL + guild_id - FIRST_GUILD
+        data = {"id": str(guild_id), "name": "guild {0}".format(guild_id), "owner_id": str(OWNER),
+                "roles": [{"id": str(guild_id), "name": "@everyone", "permissions": discord.Permissions.text().value,
+                           "position": 0}],
+                "channels": [{"id": str(channel_id), "type": 0, "name": "general", "position": 0}],
+                "members": [{"user": user_payload(member), "roles": []} for member in members],
+                "member_count": len(members)}
+        guild = discord.Guild(data=data, state=self.state)
+        self.state._add_guild(guild)
+        return guild.get_channel(channel_id)
+
+    def message(self, channel, author, content):
+        """Builds the message <author> posting <content> to <channel> would arrive as"""
+        self.next_id += 1
+        return discord.Message(state=self.state, channel=channel,
+                               data=message_payload(self.next_id, channel.id, user_payload(author), content))
+
+    def deliver(self, message):
+        self.bot.dispatch('message', message)
+
+
+def parse_mix(mix):
+    """Turns "its=30,itsm=10" into a pair of lists, command names and their weights"""
+    commands, weights = [], []
+    for part in mix.split(','):
+        name, _, weight = part.partition('=')
+        if name.strip() not in COMMANDS:
+            raise ValueError("unknown command {0!r}, expected one of {1}".format(name, ", ".join(sorted(COMMANDS))))
+        commands.append(name.strip())
+        weights.append(float(weight or 1))
+    return commands, weights
+
+
+def random_name(rng, arguments):
+    """A character, or now and then an alias of one, as a user would type it"""
+    if arguments.aliases and rng.random() < 0.2:
+        return "Alias {0}".format(rng.randrange(min(arguments.aliases, arguments.characters)))
+    return character_name(rng.randrange(arguments.characters))
+
+
+# command name -> function(rng, arguments) returning what follows the prefix
+COMMANDS = {
+    "its": lambda rng, arguments: "its " + random_name(rng, arguments),
+    "itsm": lambda rng, arguments: "itsm " + " ".join('"{0}"'.format(random_name(rng, arguments)) for _ in range(3)),
+    "notifyme": lambda rng, arguments: "notifyme " + random_name(rng, arguments),
+    "stopnotify": lambda rng, arguments: "stopnotify " + random_name(rng, arguments),
+    "mynotices": lambda rng, arguments: "mynotices",
+    "knownwaifus": lambda rng, arguments: rng.choice(("knownwaifus", "knownwaifus next", "knownwaifus Character 1")),
+    "knownaliases": lambda rng, arguments: "knownaliases",
+    "doyouknow": lambda rng, arguments: "doyouknow " + random_name(rng, arguments),
+    "alias": lambda rng, arguments: 'alias "Nick {0}" "{1}"'.format(
+        rng.randrange(1000), character_name(rng.randrange(arguments.characters))),
+    "removewaifu": lambda rng, arguments: "removewaifu " + random_name(rng, arguments),
+}
+
+
+def build_guilds(store, arguments, rng):
+    """Fills store with every guild's characters, subscribers and aliases. Each guild gets --members users drawn from
+    a pool of --users, so users are in several guilds the way real ones are. Returns {guild ID: member IDs}"""
+    users = [FIRST_USER + number for number in range(arguments.users)]
+    guilds = {}
+    for number in range(arguments.guilds):
+        guild_id = FIRST_GUILD + number
+        members = rng.sample(users, min(arguments.members, len(users)))
+        for character in range(arguments.characters):
+            store.add_subscribers(guild_id, character_name(character),
+                                  rng.sample(members, min(arguments.subscribers, len(members))))
+        for alias in range(min(arguments.aliases, arguments.characters)):
+            store.set_alias(guild_id, "Alias {0}".format(alias), character_name(alias))
+        guilds[guild_id] = members
+    store.sync()
+    return guilds
+
+
+class LoadTest:
+    """Sends commands at --rate through a FakeGateway and times each one from delivery until the bot reports it
+    finished (on_command_completion or on_command_error), error handler included"""
+
+    def __init__(self, bot, gateway, http, channels, arguments):
+        self.bot = bot
+        self.gateway = gateway
+        self.http = http
+        self.channels = channels  # list of (channel, member IDs)
+        self.arguments = arguments
+        self.rng = random.Random(arguments.seed)
+        self.commands, self.weights = parse_mix(arguments.mix)
+        self.started = {}  # message ID -> (command, time.monotonic() it was delivered)
+        self.latencies = {}  # command -> list of seconds
+        self.errors = {}  # (command, error type) -> count
+        self.sent = 0
+        self.sending = 0.0  # seconds spent delivering commands
+        self.elapsed = 0.0  # the same, plus waiting for the last ones and their replies
+        bot.add_listener(self.on_command_completion)
+        bot.add_listener(self.on_command_error)
+
+    async def on_command_completion(self, ctx):
+        self.finish(ctx, None)
+
+    async def on_command_error(self, ctx, error):
+        # listening for this also keeps Bot.on_command_error from printing every refused removewaifu
+        self.finish(ctx, error)
+
+    def finish(self, ctx, error):
+        entry = self.started.pop(ctx.message.id, None)
+        if entry is None:
+            return
+        command, delivered = entry
+        self.latencies.setdefault(command, []).append(time.monotonic() - delivered)
+        if error is not None:
+            key = (command, type(getattr(error, 'original', error)).__name__)
+            self.errors[key] = self.errors.get(key, 0) + 1
+
+    async def run(self):
+        """Delivers --rate commands a second for --duration seconds on a fixed schedule, so a bot that falls behind
+        shows up as latency rather than as a lower rate, then waits up to --drain seconds for the stragglers"""
+        total = int(self.arguments.rate * self.arguments.duration)
+        prefix = self.bot.command_prefix
+        start = time.monotonic()
+        for number in range(total):
+            delay = start + number / self.arguments.rate - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            channel, members = self.rng.choice(self.channels)
+            command = self.rng.choices(self.commands, self.weights)[0]
+            message = self.gateway.message(channel, self.rng.choice(members),
+                                           prefix + COMMANDS[command](self.rng, self.arguments))
+            self.started[message.id] = (command, time.monotonic())
+            self.gateway.deliver(message)
+            self.sent += 1
+        self.sending = time.monotonic() - start
+        deadline = time.monotonic() + self.arguments.drain
+        cog = self.bot.get_cog("Waifu")
+        while (self.started or cog.send_queue.depth()) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        self.elapsed = time.monotonic() - start
+
+    def results(self):
+        cog = self.bot.get_cog("Waifu")
+        commands = {}
+        for command, samples in sorted(self.latencies.items()):
+            commands[command] = {"count": len(samples), "p50_ms": percentile(samples, 0.50) * 1000,
+                                 "p95_ms": percentile(samples, 0.95) * 1000, "p99_ms": percentile(samples, 0.99) * 1000,
+                                 "max_ms": max(samples) * 1000}
+        every = [sample for samples in self.latencies.values() for sample in samples]
+        # the busiest second of outbound traffic, next to the average
+        per_second = {}
+        for sent_at in self.http.sent_at:
+            per_second[int(sent_at)] = per_second.get(int(sent_at), 0) + 1
+        queue = cog.send_queue
+        return {
+            "sent": self.sent,
+            "target_rate": self.arguments.rate,
+            "achieved_rate": self.sent / self.sending if self.sending else 0.0,
+            "completed": len(every),
+            "unfinished": len(self.started),
+            "p50_ms": percentile(every, 0.50) * 1000 if every else 0.0,
+            "p95_ms": percentile(every, 0.95) * 1000 if every else 0.0,
+            "p99_ms": percentile(every, 0.99) * 1000 if every else 0.0,
+            "commands": commands,
+            "errors": {"{0} {1}".format(*key): count for key, count in sorted(self.errors.items())},
+            "loop_lag_p95_ms": cog.metrics.loop_lag.quantile(0.95) * 1000,
+            "loop_lag_max_ms": cog.metrics.loop_lag.max * 1000,
+            "messages": self.http.messages,
+            "files": self.http.files,
+            "typing": self.http.typing,
+            "role_mentions": self.http.role_mentions,
+            "role_calls": self.http.role_calls,
+            "role_queue": cog.role_queue.depth(),
+            "messages_per_sec": len(self.http.sent_at) / self.elapsed if self.elapsed else 0.0,
+            "peak_messages_per_sec": max(per_second.values(), default=0),
+            "send_queue_delay_ms": queue.total_delay / queue.sent * 1000 if queue.sent else 0.0,
+            "elapsed": self.elapsed,
+        }
+
+
+def report(results):
+    print("commands: {0} sent at {1:.1f}/s (target {2}/s), {3} finished, {4} unfinished".format(
+        results["sent"], results["achieved_rate"], results["target_rate"], results["completed"], results["unfinished"]))
+    print("latency (delivered to finished): p50 {0:.2f} ms  p95 {1:.2f} ms  p99 {2:.2f} ms".format(
+        results["p50_ms"], results["p95_ms"], results["p99_ms"]))
+    for command, stats in results["commands"].items():
+        print("  {0:<14} {1:>7}  p50 {2:8.2f} ms  p95 {3:8.2f} ms  p99 {4:8.2f} ms  max {5:8.2f} ms".format(
+            command, stats["count"], stats["p50_ms"], stats["p95_ms"], stats["p99_ms"], stats["max_ms"]))
+    for error, count in results["errors"].items():
+        print("  error: {0}: {1}".format(error, count))
+    print("event loop lag: p95 {0:.1f} ms, max {1:.1f} ms".format(results["loop_lag_p95_ms"],
+                                                                   results["loop_lag_max_ms"]))
+    print("outbound: {0} messages and {1} files ({2:.1f}/s, peak {3}/s), {4} typing, {5:.1f} ms mean send queue delay"
+          .format(results["messages"], results["files"], results["messages_per_sec"],
+                  results["peak_messages_per_sec"], results["typing"], results["send_queue_delay_ms"]))
+    if results["role_calls"] or results["role_mentions"]:
+        print("roles: {0} messages mentioning a role, {1} role API calls, {2} role changes still queued".format(
+            results["role_mentions"], results["role_calls"], results["role_queue"]))
+
+
+async def run_load_test(arguments, bot_options, directory):
+    args = wfbot.parser.parse_args(["-u", os.path.join(directory, "userlist.db"),
+                                    "-c", os.path.join(directory, "aliases.db"),
+                                    "-d", os.path.join(directory, "waifu.sqlite3"),
+                                    "-e", os.path.join(directory, "waifu.events"), "--no-snapshot"] + bot_options)
+    wfbot.resolve_locations(args)
+    rng = random.Random(arguments.seed)
+    store = wfbot.open_storage(args)
+    start = time.monotonic()
+    guilds = build_guilds(store, arguments, rng)
+    if arguments.role_mode:
+        for guild_id in guilds:
+            store.set_role_mode(guild_id, True)
+        store.sync()
+    print("built {0} guilds in {1:.1f}s".format(len(guilds), time.monotonic() - start))
+
+    bot = wfbot.create_bot(args, store)
+    # is_owner would otherwise ask the HTTP API for the application's owner
+    bot.owner_id = OWNER
+    http = FakeHTTP(arguments.http_latency)
+    gateway = FakeGateway(bot, http)
+    channels = [(gateway.add_guild(guild_id, members), members) for guild_id, members in guilds.items()]
+    bot.dispatch('ready')
+    test = LoadTest(bot, gateway, http, channels, arguments)
+    try:
+        await test.run()
+        return test.results()
+    finally:
+        # unloads the cog, which flushes and closes the storage
+        await bot.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load tests the bot through a stand-in Discord gateway and HTTP API")
+    parser.add_argument("--guilds", type=int, default=100)
+    parser.add_argument("--users", help="simulated users, spread over the guilds", type=int, default=2000)
+    parser.add_argument("--members", help="users in each guild", type=int, default=100)
+    parser.add_argument("--characters", help="characters per guild", type=int, default=50)
+    parser.add_argument("--subscribers", help="users signed up for each character", type=int, default=10)
+    parser.add_argument("--aliases", help="aliases per guild", type=int, default=10)
+    parser.add_argument("--rate", help="commands per second", type=float, default=50.0)
+    parser.add_argument("--duration", help="seconds to send commands for", type=float, default=30.0)
+    parser.add_argument("--drain", help="seconds to wait for unfinished commands afterwards", type=float, default=30.0)
+    parser.add_argument("--mix", help="comma separated command=weight pairs", default=DEFAULT_MIX)
+    parser.add_argument("--http-latency", help="simulated seconds each message takes to send", type=float,
+                        default=0.05)
+    parser.add_argument("--role-mode", help="turn role notices on in every guild; the bot hands out the roles as the "
+                                            "test runs", action="store_true")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write results as JSON to this file")
+    arguments, bot_options = parser.parse_known_args()
+    try:
+        parse_mix(arguments.mix)
+    except ValueError as error:
+        parser.error(str(error))
+
+    directory = tempfile.mkdtemp(prefix="waifu-loadtest-")
+    try:
+        results = asyncio.get_event_loop().run_until_complete(run_load_test(arguments, bot_options, directory))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    report(results)
+    if arguments.output:
+        with open(arguments.output, "w") as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
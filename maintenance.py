@@ -0,0 +1,291 @@
+"""
+Compaction and integrity checks for WaifuHoarder storage
+
+The dbm files behind the shelves never give back the space of rewritten or deleted keys, so they only ever grow. This
+rewrites every shelf into fresh files, dropping what is no longer needed on the way, and swaps them in. SQLite databases
+get the same clean up followed by a VACUUM, and event logs (see eventlog.py) are folded into a fresh checkpoint.
+
+The fresh shelves are all written in full before any of them is swapped in. A marker file listing them is then written,
+and from the moment it exists the swap is finished whatever happens: if we stop part way, the next start (or the next
+compaction) sees the marker and moves the rest of the fresh files into place. Without the marker, fresh files lying
+around are from a compaction that never got that far and are deleted, leaving the old shelves as they were.
+
+Usage: python maintenance.py -b shelve|sqlite|eventlog -u USERLIST -c CHARACTER -d DATABASE -e EVENTLOG --drop-dangling
+Run it while the bot is stopped, or use the owner-only compact command while it runs.
+
+(C) 2019-2020 by Jordan Aurora Kinsley
+
+Licensed under MIT License, see LICENSE
+"""
+
+import argparse
+import dbm
+import importlib
+import json
+import os
+import shelve
+from aliastable import AliasTable, normalize, strip_server
+from indexes import GuildIndex, UserIndex, make_key, split_key
+from subscribers import SubscriberSet
+from writebehind import open_shelf
+
+# every file name a dbm module may add to a shelf's location: gnu and dumb (.dat, .dir, .bak), ndbm (.db, .pag, .dir)
+SHELF_SUFFIXES = ('', '.db', '.dat', '.dir', '.bak', '.pag')
+# how many dangling aliases a report lists by name
+REPORT_ALIASES = 10
+# what the fresh shelves are written as next to the old ones, and the marker saying they are all complete
+COMPACT_SUFFIX = '.compact'
+MARKER_SUFFIX = '.compacting'
+
+
+def shelf_files(location):
+    """Returns the files that make up the shelf at location"""
+    return [location + suffix for suffix in SHELF_SUFFIXES if os.path.isfile(location + suffix)]
+
+
+def shelf_size(location):
+    return sum(os.path.getsize(path) for path in shelf_files(location))
+
+
+def remove_shelf(location):
+    for path in shelf_files(location):
+        os.remove(path)
+
+
+class CompactionReport:
+    """What a compaction found and changed. str() gives a summary fit for a Discord message or a terminal"""
+
+    def __init__(self):
+        self.size_before = 0
+        self.size_after = 0
+        self.dropped_notices = 0  # characters with nobody signed up and no alias pointing at them
+        self.converted_notices = 0  # legacy lists of mention strings packed into user IDs
+        self.unreadable = []  # keys whose value couldn't be unpickled, dropped
+        self.dangling_aliases = []  # (server, alias, character) tuples that don't lead to a character that exists
+        self.dropped_aliases = 0
+        self.problems = []  # anything an integrity check reported
+
+    def __str__(self):
+        lines = ["size: {0} bytes before, {1} bytes after".format(self.size_before, self.size_after),
+                 "dropped {0} empty notices, converted {1} legacy notices, dropped {2} unreadable entries".format(
+                     self.dropped_notices, self.converted_notices, len(self.unreadable))]
+        if self.dangling_aliases:
+            lines.append("{0} aliases point at characters that don't exist{1}:".format(
+                len(self.dangling_aliases), " (dropped)" if self.dropped_aliases else ""))
+            lines.extend("  {0}: {1} -> {2}".format(server, alias, character)
+                         for server, alias, character in self.dangling_aliases[:REPORT_ALIASES])
+            if len(self.dangling_aliases) > REPORT_ALIASES:
+                lines.append("  ...and {0} more".format(len(self.dangling_aliases) - REPORT_ALIASES))
+        else:
+            lines.append("no dangling aliases")
+        lines.extend("integrity: {0}".format(problem) for problem in self.problems)
+        return "\n".join(lines)
+
+
+def check_aliases(characters, aliases):
+    """Resolves every alias the way the bot does, through an AliasTable per server, so aliases whose target is
+    capitalized differently from the character or is another alias count as pointing at it. characters is a dict of
+    each server to its character names, aliases a dict of each server to a dict of its aliases and their targets.
+    Returns a (targets, dangling) tuple: targets is a dict of each server to the set of characters, as stored, its
+    aliases lead to, and dangling a list of (server, alias, target) tuples for the aliases that lead to no character or
+    loop"""
+    targets = {}
+    dangling = []
+    for server in sorted(set(characters) | set(aliases)):
+        server_aliases = aliases.get(server, {})
+        table = AliasTable.build(characters.get(server, ()),
+                                 {alias: strip_server(target, server) for alias, target in server_aliases.items()})
+        for alias, target in sorted(server_aliases.items()):
+            character = table.resolve(alias)
+            if normalize(alias) in table.cycles or character is None or table.character(character) is None:
+                dangling.append((server, alias, target))
+            else:
+                targets.setdefault(server, set()).add(character)
+    return targets, dangling
+
+
+def _write_compacted(location, report, keep=lambda key, value: (key, value)):
+    """Copies the shelf at location into a fresh one next to it, leaving the old one as it is. keep(key, value) returns
+    the (key, value) pair to write, or None to leave the entry out. The new shelf uses the same dbm module as the old
+    one. Returns the suffixes of the files it is made of"""
+    kind = dbm.whichdb(location)
+    module = importlib.import_module(kind) if kind else dbm
+    temporary = location + COMPACT_SUFFIX
+    remove_shelf(temporary)
+    fresh = shelve.Shelf(module.open(temporary, 'n'))
+    try:
+        with shelve.open(location, flag='c') as old:
+            for key, value in _read_entries(old, report):
+                entry = keep(key, value)
+                if entry is not None:
+                    fresh[entry[0]] = entry[1]
+    except BaseException:
+        fresh.close()
+        remove_shelf(temporary)
+        raise
+    fresh.close()
+    suffixes = [suffix for suffix in SHELF_SUFFIXES if os.path.isfile(temporary + suffix)]
+    for suffix in suffixes:
+        _fsync(temporary + suffix)
+    return suffixes
+
+
+def _fsync(path):
+    with open(path, 'rb') as written:
+        os.fsync(written.fileno())
+
+
+def _swap_shelves(marker, fresh):
+    """Swaps in the fresh shelves written by _write_compacted, fresh being a dict of each location to the suffixes of
+    its fresh files. Writing the marker is the one step that decides whether the swap happens (see the module
+    docstring)"""
+    with open(marker + '.tmp', 'w') as marker_file:
+        json.dump(fresh, marker_file)
+        marker_file.flush()
+        os.fsync(marker_file.fileno())
+    os.replace(marker + '.tmp', marker)
+    _finish_swap(marker, fresh)
+
+
+def _finish_swap(marker, fresh):
+    """Moves every fresh file still waiting over the old one and removes old files the fresh shelf doesn't have. Safe to
+    run again after stopping part way"""
+    for location, suffixes in fresh.items():
+        for suffix in suffixes:
+            if os.path.isfile(location + COMPACT_SUFFIX + suffix):
+                os.replace(location + COMPACT_SUFFIX + suffix, location + suffix)
+        for suffix in SHELF_SUFFIXES:
+            if suffix not in suffixes and os.path.isfile(location + suffix):
+                os.remove(location + suffix)
+    os.remove(marker)
+
+
+def recover_compaction(user_list_location, character_alias_location):
+    """Finishes a shelf compaction that stopped after deciding to swap the fresh shelves in, or clears away the fresh
+    files of one that stopped before. Must run before the shelves are opened"""
+    marker = user_list_location + MARKER_SUFFIX
+    if os.path.isfile(marker):
+        with open(marker) as marker_file:
+            fresh = json.load(marker_file)
+        _finish_swap(marker, fresh)
+        return
+    for location in _compacted_locations(user_list_location, character_alias_location):
+        remove_shelf(location + COMPACT_SUFFIX)
+    if os.path.isfile(marker + '.tmp'):
+        os.remove(marker + '.tmp')
+
+
+def _compacted_locations(user_list_location, character_alias_location):
+    """The shelves compact_shelves rewrites"""
+    return user_list_location, character_alias_location, user_list_location + '.channels'
+
+
+def _read_entries(shelf, report):
+    """Yields the (key, value) pairs of shelf, reporting and skipping values that can't be unpickled"""
+    for key in shelf.keys():
+        try:
+            yield key, shelf[key]
+        except Exception as error:
+            report.unreadable.append(key)
+            report.problems.append("{0}: {1}".format(key, error))
+
+
+def compact_shelves(user_list_location, character_alias_location, drop_dangling=False):
+    """Rewrites the notice, alias and channel shelves into fresh files and rebuilds the indexes from them. On the way:
+    - notices with nobody signed up are dropped, unless an alias leads to the character
+    - notices still stored as lists of mention strings (including the [None] placeholder) are packed into user IDs
+    - aliases that lead to no character (see check_aliases) are reported, and dropped if drop_dangling is set
+    The shelves must not be open anywhere else. Returns a CompactionReport"""
+    report = CompactionReport()
+    recover_compaction(user_list_location, character_alias_location)
+    index_locations = (user_list_location + '.index', user_list_location + '.users')
+    channel_location = user_list_location + '.channels'
+    locations = (user_list_location, character_alias_location, channel_location) + index_locations
+    report.size_before = sum(shelf_size(location) for location in locations)
+
+    # the indexes go first: if we stop part way, the next start finds them missing and rebuilds them from the shelves
+    for location in index_locations:
+        remove_shelf(location)
+
+    # unreadable aliases get reported when the alias shelf itself is rewritten below
+    characters = {}
+    with shelve.open(user_list_location, flag='c') as notices:
+        for key in notices.keys():
+            server, character = split_key(key)
+            characters.setdefault(server, []).append(character)
+    aliases = {}
+    with shelve.open(character_alias_location, flag='c') as alias_shelf:
+        for key, target in _read_entries(alias_shelf, CompactionReport()):
+            server, alias = split_key(key)
+            aliases.setdefault(server, {})[alias] = target
+    targets, report.dangling_aliases = check_aliases(characters, aliases)
+    dangling = {make_key(server, alias) for server, alias, _ in report.dangling_aliases}
+
+    def keep_notice(key, value):
+        subscribers = SubscriberSet.load(value)
+        server, character = split_key(key)
+        if not subscribers and character not in targets.get(server, ()):
+            report.dropped_notices += 1
+            return None
+        if not isinstance(value, (bytes, bytearray)):
+            report.converted_notices += 1
+        return key, subscribers.to_bytes()
+    fresh = {user_list_location: _write_compacted(user_list_location, report, keep_notice)}
+
+    def keep_alias(key, character):
+        if drop_dangling and key in dangling:
+            report.dropped_aliases += 1
+            return None
+        return key, character
+    try:
+        fresh[character_alias_location] = _write_compacted(character_alias_location, report, keep_alias)
+        fresh[channel_location] = _write_compacted(channel_location, report,
+                                                   lambda key, channels: (key, channels) if channels else None)
+    except BaseException:
+        for location in fresh:
+            remove_shelf(location + COMPACT_SUFFIX)
+        raise
+    _swap_shelves(user_list_location + MARKER_SUFFIX, fresh)
+
+    notify_user_list = open_shelf(user_list_location)
+    character_aliases = open_shelf(character_alias_location)
+    guild_index = GuildIndex(index_locations[0])
+    guild_index.rebuild(notify_user_list, character_aliases)
+    user_index = UserIndex(index_locations[1])
+    user_index.rebuild(notify_user_list)
+    for shelf in (guild_index, user_index, notify_user_list, character_aliases):
+        shelf.close()
+    report.size_after = sum(shelf_size(location) for location in locations)
+    return report
+
+
+def main():
+    # the storage engines import this module for their compact(), so they are only imported once it has loaded
+    import storage
+    import eventlog
+    parser = argparse.ArgumentParser(description="Compact WaifuHoarder storage and check it for dangling aliases")
+    parser.add_argument("-b", "--backend", choices=["shelve", "sqlite", "eventlog"], default="shelve")
+    parser.add_argument("-c", "--character", help="file location for character alias shelf", default='aliases.test.db')
+    parser.add_argument("-u", "--userlist", help="file location for user list shelf", default='userlist.test.db')
+    parser.add_argument("-d", "--database", help="file location for the SQLite database",
+                        default='waifu.test.sqlite3')
+    parser.add_argument("-e", "--eventlog", help="file location for the event log checkpoint",
+                        default='waifu.test.events')
+    parser.add_argument("--drop-dangling", help="remove aliases that point at characters that don't exist",
+                        action="store_true")
+    args = parser.parse_args()
+
+    if args.backend == "sqlite":
+        store = storage.SqliteStorage(args.database)
+    elif args.backend == "eventlog":
+        store = eventlog.EventLogStorage(args.eventlog)
+    else:
+        store = storage.ShelveStorage(args.userlist, args.character)
+    try:
+        print(store.compact(args.drop_dangling))
+    finally:
+        store.close()
+
+
+if __name__ == '__main__':
+    main()
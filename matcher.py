@@ -0,0 +1,173 @@
+"""
+Multi-pattern character name matching for WaifuHoarder's automatic notices
+
+(C) 2019-2020 by Jordan Aurora Kinsley
+
+Licensed under MIT License, see LICENSE
+"""
+
+from collections import deque
+
+
+def _fold(text):
+    """Lower cases text one character at a time, the same way find() does, so patterns and text fold identically"""
+    return ''.join(character.lower() for character in text)
+
+
+def _is_word_character(character):
+    return character.isalnum()
+
+
+class CharacterMatcher:
+    """An Aho-Corasick automaton over one server's character names and aliases. find() makes a single pass over the
+    text, so its cost grows with the length of the message and the number of matches, not with how many names the
+    server tracks. Matching ignores case and only counts whole words, so "Rarity" matches "rarity!" but not "rarityfan".
+
+    Names can be added and removed as the server's characters and aliases change. Adding inserts into the trie and marks
+    the failure links stale; they are recomputed with one pass over the trie, which costs as much as every name
+    together, so changes should come in batches through update(), which recomputes them once for the whole batch. A
+    lone add() leaves that to the next search. Removing only clears the name's output, so it costs as much as the name
+    is long."""
+    CHARACTER = 'c'
+    ALIAS = 'a'
+
+    def __init__(self):
+        # the trie, one entry per node in each list. Node 0 is the root
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [None]  # the folded name ending at this node, if any
+        self.output_link = [0]  # the nearest node down the failure chain with an output, 0 if there is none
+        # folded name -> {(kind, name): character it stands for}. Several names can fold to the same text
+        self.targets = {}
+        self.nodes_by_name = {}
+        self.stale = False
+
+    def __len__(self):
+        return len(self.targets)
+
+    @classmethod
+    def build(cls, characters, aliases):
+        """Builds a matcher from a server's character names and a dict of its aliases to the characters they refer to"""
+        matcher = cls()
+        matcher.update(added=[(cls.CHARACTER, character, character) for character in characters] +
+                       [(cls.ALIAS, alias, character) for alias, character in aliases.items()])
+        return matcher
+
+    def update(self, added=(), removed=()):
+        """Applies a batch of changes: <removed> holds (kind, name) pairs to remove, <added> (kind, name, character)
+        tuples to add (see add()). The failure links are recomputed once for the whole batch, and only if it added a
+        name the trie didn't have"""
+        for kind, name in removed:
+            self.remove(kind, name)
+        for kind, name, character in added:
+            self.add(kind, name, character)
+        if self.stale:
+            self._link()
+
+    def add(self, kind, name, character):
+        """Makes name (a character name when kind is CHARACTER, an alias when it is ALIAS) match as character"""
+        folded = _fold(name).strip()
+        if not folded:
+            return
+        self.targets.setdefault(folded, {})[(kind, name)] = character
+        if folded in self.nodes_by_name:
+            return
+        node = 0
+        for letter in folded:
+            child = self.goto[node].get(letter)
+            if child is None:
+                child = len(self.goto)
+                self.goto[node][letter] = child
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append(None)
+                self.output_link.append(0)
+            node = child
+        self.output[node] = folded
+        self.nodes_by_name[folded] = node
+        self.stale = True
+
+    def remove(self, kind, name):
+        folded = _fold(name).strip()
+        targets = self.targets.get(folded)
+        if not targets or targets.pop((kind, name), None) is None:
+            return
+        if not targets:
+            # the trie nodes stay, since other names may run through them; the name just stops being an output
+            del self.targets[folded]
+            self.output[self.nodes_by_name.pop(folded)] = None
+
+    def _link(self):
+        """Recomputes the failure and output links with a breadth first pass over the trie"""
+        queue = deque()
+        for child in self.goto[0].values():
+            self.fail[child] = 0
+            self.output_link[child] = 0
+            queue.append(child)
+        while queue:
+            node = queue.popleft()
+            for character, child in self.goto[node].items():
+                fallback = self.fail[node]
+                while fallback and character not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                fallback = self.goto[fallback].get(character, 0)
+                self.fail[child] = fallback
+                if self.output[fallback] is not None:
+                    self.output_link[child] = fallback
+                else:
+                    self.output_link[child] = self.output_link[fallback]
+                queue.append(child)
+        self.stale = False
+
+    def _character_for(self, folded):
+        targets = self.targets[folded]
+        # a character's own name wins over an alias that happens to be spelled the same
+        for (kind, name), character in targets.items():
+            if kind == self.CHARACTER:
+                return character
+        return next(iter(targets.values()))
+
+    def find(self, text):
+        """Returns the characters named in text, each once, in the order they first appear. Where names overlap, the
+        leftmost and then longest one wins, so "Twilight Sparkle" doesn't also count as "Twilight" """
+        if not self.targets or not text:
+            return []
+        if self.stale:
+            self._link()
+        goto = self.goto
+        fail = self.fail
+        output = self.output
+        output_link = self.output_link
+        # folded text can be longer than the original, so remember which original character each folded one came from
+        origin = []
+        matches = []
+        node = 0
+        for index, original in enumerate(text):
+            for character in original.lower():
+                origin.append(index)
+                while node and character not in goto[node]:
+                    node = fail[node]
+                node = goto[node].get(character, 0)
+                hit = node
+                while hit:
+                    folded = output[hit]
+                    if folded is not None:
+                        start = origin[len(origin) - len(folded)]
+                        # only whole words: the name can't be glued to letters or digits on either side
+                        if (start == 0 or not _is_word_character(text[start - 1])) and \
+                                (index + 1 == len(text) or not _is_word_character(text[index + 1])):
+                            matches.append((start, index, folded))
+                    hit = output_link[hit]
+        matches.sort(key=lambda match: (match[0], -match[1]))
+        found = []
+        seen = set()
+        covered = -1
+        for start, end, folded in matches:
+            if start <= covered:
+                continue
+            covered = end
+            character = self._character_for(folded)
+            if character not in seen:
+                seen.add(character)
+                found.append(character)
+        return found
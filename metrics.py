@@ -0,0 +1,219 @@
+"""
+Metrics for WaifuHoarder: command latency, storage calls, event loop lag, caches and the send queue
+
+(C) 2019-2020 by Jordan Aurora Kinsley
+
+Licensed under MIT License, see LICENSE
+"""
+
+import asyncio
+from bisect import bisect_left
+from bothelper import log
+
+# upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# storage engine methods (see storage.py) by what they do to the disk. Anything not listed counts as a write
+STORAGE_READS = {'has_character', 'subscribers', 'subscribers_many', 'user_characters', 'characters', 'get_alias',
+                 'get_aliases', 'aliases', 'watched_channels', 'name_versions',
+                 'role_servers', 'servers'}
+STORAGE_SCANS = {'all_notices', 'all_aliases', 'all_watched_channels', 'all_users'}
+
+
+def storage_kind(method):
+    if method in STORAGE_SCANS:
+        return 'scan'
+    if method in STORAGE_READS:
+        return 'read'
+    return 'write'
+
+
+class Histogram:
+    """Counts observations into fixed buckets, the way a Prometheus histogram does, and keeps their sum and maximum"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, fraction):
+        """Returns the upper bound of the bucket holding the given quantile, capped at the largest value observed"""
+        if not self.count:
+            return 0.0
+        target = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return min(self.buckets[index], self.max) if index < len(self.buckets) else self.max
+        return self.max
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(**labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(name, _escape(value)) for name, value in sorted(labels.items())) + '}'
+
+
+class Metrics:
+    """Collects the cog's metrics and renders them as Prometheus text (render()) or as a short summary (summary()).
+    Commands and event loop lag are recorded as they happen; storage, cache and send queue numbers are read from those
+    objects' own counters when rendering, so collecting them costs nothing on the hot paths"""
+
+    def __init__(self, storage, caches, send_queue, args=None):
+        self.storage = storage
+        self.caches = caches
+        self.send_queue = send_queue
+        self.args = args
+        self.commands = {}  # command name -> Histogram of latencies
+        self.errors = {}  # (command name, error type) -> count
+        self.loop_lag = Histogram()
+        self.server = None
+
+    def observe_command(self, command, seconds):
+        histogram = self.commands.get(command)
+        if histogram is None:
+            histogram = self.commands[command] = Histogram()
+        histogram.observe(seconds)
+
+    def count_error(self, command, error):
+        # CommandInvokeError just wraps whatever the command itself raised, which is the more useful type to count
+        error = getattr(error, 'original', error)
+        key = (command, type(error).__name__)
+        self.errors[key] = self.errors.get(key, 0) + 1
+
+    def observe_loop_lag(self, seconds):
+        self.loop_lag.observe(max(0.0, seconds))
+
+    def _histogram_lines(self, name, histogram, **labels):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(histogram.buckets + (float('inf'),), histogram.counts):
+            cumulative += count
+            lines.append("{0}_bucket{1} {2}".format(name, _labels(le='+Inf' if bound == float('inf') else bound,
+                                                                   **labels), cumulative))
+        lines.append("{0}_sum{1} {2}".format(name, _labels(**labels), histogram.sum))
+        lines.append("{0}_count{1} {2}".format(name, _labels(**labels), histogram.count))
+        return lines
+
+    def render(self):
+        """Returns every metric in the Prometheus text exposition format"""
+        lines = ["# HELP waifu_command_seconds Time taken by each command of the Waifu cog",
+                 "# TYPE waifu_command_seconds histogram"]
+        for command, histogram in sorted(self.commands.items()):
+            lines.extend(self._histogram_lines("waifu_command_seconds", histogram, command=command))
+        lines += ["# HELP waifu_command_errors_total Command errors by command and error type",
+                  "# TYPE waifu_command_errors_total counter"]
+        for (command, error), count in sorted(self.errors.items()):
+            lines.append("waifu_command_errors_total{0} {1}".format(_labels(command=command, error=error), count))
+
+        lines += ["# HELP waifu_storage_calls_total Storage engine calls by method and kind (read, write or scan)",
+                  "# TYPE waifu_storage_calls_total counter"]
+        for method, (calls, seconds) in sorted(self.storage.calls.items()):
+            lines.append("waifu_storage_calls_total{0} {1}".format(
+                _labels(method=method, kind=storage_kind(method)), calls))
+        lines += ["# HELP waifu_storage_seconds_total Time spent on the storage thread by method",
+                  "# TYPE waifu_storage_seconds_total counter"]
+        for method, (calls, seconds) in sorted(self.storage.calls.items()):
+            lines.append("waifu_storage_seconds_total{0} {1}".format(_labels(method=method), seconds))
+        lines += ["# HELP waifu_storage_bytes_total Subscriber list bytes read from and written to storage",
+                  "# TYPE waifu_storage_bytes_total counter",
+                  "waifu_storage_bytes_total{0} {1}".format(_labels(direction='read'), self.storage.storage.bytes_read),
+                  "waifu_storage_bytes_total{0} {1}".format(_labels(direction='written'),
+                                                            self.storage.storage.bytes_written),
+                  "# HELP waifu_storage_dirty Changes held in memory waiting to be flushed",
+                  "# TYPE waifu_storage_dirty gauge",
+                  "waifu_storage_dirty {0}".format(self.storage.dirty_count())]
+
+        lines += ["# HELP waifu_event_loop_lag_seconds How late the event loop ran a timer that should have fired",
+                  "# TYPE waifu_event_loop_lag_seconds histogram"]
+        lines.extend(self._histogram_lines("waifu_event_loop_lag_seconds", self.loop_lag))
+
+        lines += ["# HELP waifu_cache_lookups_total Cache lookups by cache and result",
+                  "# TYPE waifu_cache_lookups_total counter"]
+        for cache in self.caches:
+            lines.append("waifu_cache_lookups_total{0} {1}".format(_labels(cache=cache.name, result='hit'),
+                                                                     cache.hits))
+            lines.append("waifu_cache_lookups_total{0} {1}".format(_labels(cache=cache.name, result='miss'),
+                                                                     cache.misses))
+        lines += ["# HELP waifu_cache_entries Entries held by each cache", "# TYPE waifu_cache_entries gauge"]
+        for cache in self.caches:
+            lines.append("waifu_cache_entries{0} {1}".format(_labels(cache=cache.name), len(cache.entries)))
+
+        queue = self.send_queue
+        lines += ["# HELP waifu_send_queue_depth Messages and notices waiting to be sent",
+                  "# TYPE waifu_send_queue_depth gauge",
+                  "waifu_send_queue_depth {0}".format(queue.depth()),
+                  "# HELP waifu_send_queue_messages_total Messages by what the send queue did with them",
+                  "# TYPE waifu_send_queue_messages_total counter"]
+        for outcome, count in (('sent', queue.sent), ('merged', queue.merged), ('coalesced', queue.coalesced),
+                               ('failed', queue.failed)):
+            lines.append("waifu_send_queue_messages_total{0} {1}".format(_labels(outcome=outcome), count))
+        lines += ["# HELP waifu_send_queue_delay_seconds_total Time sent messages spent waiting in the queue",
+                  "# TYPE waifu_send_queue_delay_seconds_total counter",
+                  "waifu_send_queue_delay_seconds_total {0}".format(queue.total_delay)]
+        return "\n".join(lines) + "\n"
+
+    def summary(self, top=10):
+        """Returns a short plain text summary for the stats command: the busiest commands, then everything else"""
+        lines = ["command: calls, errors, p50 / p95 / max ms"]
+        busiest = sorted(self.commands.items(), key=lambda item: item[1].count, reverse=True)[:top]
+        for command, histogram in busiest:
+            errors = sum(count for (name, _), count in self.errors.items() if name == command)
+            lines.append("{0}: {1}, {2}, {3:.1f} / {4:.1f} / {5:.1f}".format(
+                command, histogram.count, errors, histogram.quantile(0.5) * 1000, histogram.quantile(0.95) * 1000,
+                histogram.max * 1000))
+        calls = {'read': 0, 'write': 0, 'scan': 0}
+        for method, (count, _) in self.storage.calls.items():
+            calls[storage_kind(method)] += count
+        lines.append("storage: {0} reads, {1} writes, {2} scans, {3} bytes read, {4} bytes written, {5} dirty".format(
+            calls['read'], calls['write'], calls['scan'], self.storage.storage.bytes_read,
+            self.storage.storage.bytes_written, self.storage.dirty_count()))
+        lines.append("event loop lag: p95 {0:.1f} ms, max {1:.1f} ms".format(self.loop_lag.quantile(0.95) * 1000,
+                                                                            self.loop_lag.max * 1000))
+        lines.extend(cache.stats() for cache in self.caches)
+        lines.append(self.send_queue.stats())
+        return "\n".join(lines)
+
+    async def _handle(self, reader, writer):
+        try:
+            request = await reader.readline()
+            # the headers aren't needed, but reading them keeps clients from seeing a reset connection
+            while (await reader.readline()).strip():
+                pass
+            parts = request.split()
+            if len(parts) >= 2 and parts[0] == b'GET' and parts[1] in (b'/', b'/metrics'):
+                status, body = "200 OK", self.render()
+            else:
+                status, body = "404 Not Found", "not found\n"
+            payload = body.encode("utf-8")
+            writer.write("HTTP/1.0 {0}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                         "Content-Length: {1}\r\nConnection: close\r\n\r\n".format(status, len(payload)).encode())
+            writer.write(payload)
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, port, host="127.0.0.1"):
+        """Starts answering GET /metrics on host:port. Only listens locally unless told otherwise"""
+        self.server = await asyncio.start_server(self._handle, host, port)
+        log("metrics: serving on http://{0}:{1}/metrics", 'sf', self.args, host, port)
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+            self.server = None
@@ -0,0 +1,171 @@
+"""
+Owner-controlled profiling of WaifuHoarder commands: cProfile per command, and tracemalloc for memory growth
+
+(C) 2019-2020 by Jordan Aurora Kinsley
+
+Licensed under MIT License, see LICENSE
+"""
+
+import cProfile
+import pstats
+import time
+import tracemalloc
+
+# how many frames tracemalloc keeps per allocation while profiling
+TRACE_FRAMES = 10
+# how many functions and allocation sites each part of a written report lists
+REPORT_LINES = 25
+
+
+class CommandProfile:
+    """What the profiler gathered for one command name over every run it profiled"""
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.memory = 0  # bytes allocated during the runs and still held at their end
+        self.stats = None  # pstats.Stats summed over the runs
+
+    def add(self, profile, seconds, memory):
+        self.count += 1
+        self.seconds += seconds
+        self.memory += memory
+        stats = pstats.Stats(profile)
+        if self.stats is None:
+            self.stats = stats
+        else:
+            self.stats.add(stats)
+
+
+class Profiler:
+    """Profiles the next <commands> commands, or every command for <seconds>, and traces memory growth meanwhile.
+
+    cProfile can only follow one thing at a time, and commands interleave on the event loop, so only one command is
+    profiled at once: one starting while another is profiled runs unprofiled and is counted in skipped. Whatever else
+    the event loop gets to run while a profiled command awaits (other commands, the send queue) shows up in that
+    command's profile, and so does the event loop waiting, as select or poll; storage calls run on their own thread and
+    don't.
+
+    While it isn't running, the cog only checks the active attribute, so it costs nothing"""
+
+    def __init__(self):
+        self.active = False
+        self.remaining = None  # commands left to profile, or None when profiling for a time
+        self.deadline = None  # time.monotonic() to stop at, or None when profiling a number of commands
+        self.commands = {}  # command name -> CommandProfile
+        self.current = None  # (context, cProfile.Profile, traced memory, time.perf_counter()) of the profiled command
+        self.skipped = 0
+        self.started_at = None
+        self.start_snapshot = None
+        self.was_tracing = False
+
+    def start(self, commands=None, seconds=None):
+        self.remaining = commands
+        self.deadline = None if seconds is None else time.monotonic() + seconds
+        self.commands = {}
+        self.current = None
+        self.skipped = 0
+        self.started_at = time.monotonic()
+        # someone (python -X tracemalloc, say) may already be tracing, in which case it is left running afterwards
+        self.was_tracing = tracemalloc.is_tracing()
+        if not self.was_tracing:
+            tracemalloc.start(TRACE_FRAMES)
+        self.start_snapshot = tracemalloc.take_snapshot()
+        self.active = True
+
+    def expired(self):
+        if self.remaining is not None and self.remaining <= 0:
+            return True
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def begin(self, ctx):
+        """Starts profiling ctx's command, unless another one is being profiled"""
+        if self.current is not None:
+            self.skipped += 1
+            return
+        profile = cProfile.Profile()
+        self.current = (ctx, profile, tracemalloc.get_traced_memory()[0], time.perf_counter())
+        profile.enable()
+
+    def end(self, ctx):
+        """Stops profiling ctx's command, if it is the one being profiled, and adds it to its command's totals"""
+        if self.current is None or self.current[0] is not ctx:
+            return
+        _, profile, memory, started = self.current
+        profile.disable()
+        seconds = time.perf_counter() - started
+        self.current = None
+        entry = self.commands.setdefault(ctx.command.qualified_name, CommandProfile())
+        entry.add(profile, seconds, tracemalloc.get_traced_memory()[0] - memory)
+        if self.remaining is not None:
+            self.remaining -= 1
+
+    def stop(self):
+        """Stops profiling and tracing and returns a ProfileReport of everything gathered"""
+        if self.current is not None:
+            self.current[1].disable()
+            self.current = None
+        # leaves out what the profiling itself allocated
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, module.__file__) for module in (tracemalloc, cProfile, pstats)] +
+            [tracemalloc.Filter(False, __file__)])
+        growth = snapshot.compare_to(self.start_snapshot, 'lineno')
+        if not self.was_tracing:
+            tracemalloc.stop()
+        self.active = False
+        self.start_snapshot = None
+        return ProfileReport(self.commands, [stat for stat in growth if stat.size_diff > 0], self.skipped,
+                             time.monotonic() - self.started_at)
+
+
+class ProfileReport:
+    """The results of one profiling run: summary() for chat, write() for the full report"""
+
+    def __init__(self, commands, growth, skipped, seconds):
+        self.commands = commands
+        self.growth = growth  # tracemalloc.StatisticDiffs of the lines whose allocations grew, largest first
+        self.skipped = skipped
+        self.seconds = seconds
+
+    def slowest_functions(self, top):
+        """Returns (function, seconds) pairs of the functions that took the most time of their own, over every
+        command"""
+        totals = {}
+        for entry in self.commands.values():
+            for function, (_, _, own_time, _, _) in entry.stats.stats.items():
+                totals[function] = totals.get(function, 0.0) + own_time
+        return sorted(totals.items(), key=lambda item: item[1], reverse=True)[:top]
+
+    def summary(self, top=5):
+        """Returns a few lines: the commands that took longest in total, the functions that took longest of their own
+        and the lines whose allocations grew the most"""
+        runs = sum(entry.count for entry in self.commands.values())
+        lines = ["profiled {0} commands over {1:.1f}s, {2} skipped while another was profiled".format(
+            runs, self.seconds, self.skipped), "command: runs, total / mean ms, memory growth KiB"]
+        busiest = sorted(self.commands.items(), key=lambda item: item[1].seconds, reverse=True)[:top]
+        for name, entry in busiest:
+            lines.append("{0}: {1}, {2:.1f} / {3:.1f}, {4:+.1f}".format(
+                name, entry.count, entry.seconds * 1000, entry.seconds * 1000 / entry.count, entry.memory / 1024))
+        if self.commands:
+            lines.append("slowest functions (own time):")
+            lines.extend("  {0:.1f} ms {1}".format(seconds * 1000, pstats.func_std_string(function))
+                         for function, seconds in self.slowest_functions(top))
+        if self.growth:
+            lines.append("memory growth:")
+            lines.extend("  {0:+.1f} KiB {1}".format(stat.size_diff / 1024, stat.traceback[0])
+                         for stat in self.growth[:top])
+        return "\n".join(lines)
+
+    def write(self, path):
+        """Writes the full report to path: a longer summary, then each command's profile sorted by own and by
+        cumulative time, then every line whose allocations grew"""
+        with open(path, 'w', encoding='utf-8') as output:
+            output.write(self.summary(REPORT_LINES) + "\n")
+            for name, entry in sorted(self.commands.items()):
+                output.write("\n== {0}: {1} runs ==\n".format(name, entry.count))
+                entry.stats.stream = output
+                entry.stats.sort_stats('tottime').print_stats(REPORT_LINES)
+                entry.stats.sort_stats('cumulative').print_stats(REPORT_LINES)
+            output.write("\n== memory growth ==\n")
+            for stat in self.growth:
+                output.write("{0}\n".format(stat))
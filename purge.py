@@ -0,0 +1,64 @@
+"""
+Clean up after servers WaifuHoarder left and members who left them
+
+(C) 2019-2020 by Jordan Aurora Kinsley
+
+Licensed under MIT License, see LICENSE
+"""
+
+import time
+
+
+class PurgeQueue:
+    """Servers and members waiting out a grace period before what is stored for them is removed (see
+    Waifu.purge_departed). Coming back in the meantime takes them off the queue, so a bot kicked by mistake or a member
+    who rejoins keeps their notices"""
+
+    def __init__(self, grace, clock=time.monotonic):
+        self.grace = grace
+        self.clock = clock
+        # (server, None) for a whole server or (server, user ID) for a member -> clock() once the grace period is over
+        self.pending = {}
+        # totals of what has been purged so far
+        self.servers = 0
+        self.entries = 0
+        self.users = 0
+        self.notices = 0
+
+    def schedule(self, server, user=None):
+        """Queues server, or user's notices on it, to be purged once the grace period is over. Returns False if they
+        were already queued, in which case the grace period still runs from the first time"""
+        key = (str(server), user)
+        if key in self.pending:
+            return False
+        self.pending[key] = self.clock() + self.grace
+        return True
+
+    def cancel(self, server, user=None):
+        """Takes server, or user on it, off the queue. Returns False if they weren't on it"""
+        return self.pending.pop((str(server), user), None) is not None
+
+    def due(self):
+        """Takes everything whose grace period is over off the queue and returns it as (server, user) tuples, user being
+        None for a whole server. Servers come first, since purging one takes its members' notices with it"""
+        now = self.clock()
+        due = sorted((key for key, due_at in self.pending.items() if due_at <= now), key=lambda key: key[1] is not None)
+        for key in due:
+            del self.pending[key]
+        return due
+
+    def retry(self, server, user=None):
+        """Puts server, or user on it, back on the queue after a purge that failed, due straight away"""
+        self.pending.setdefault((str(server), user), self.clock())
+
+    def record(self, servers=0, entries=0, users=0, notices=0):
+        self.servers += servers
+        self.entries += entries
+        self.users += users
+        self.notices += notices
+
+    def stats(self):
+        waiting_servers = sum(1 for _, user in self.pending if user is None)
+        return ("purge queue: {0} servers and {1} members waiting, {2} servers ({3} characters, aliases and settings) "
+                "and {4} members ({5} notices) purged").format(waiting_servers, len(self.pending) - waiting_servers,
+                                                               self.servers, self.entries, self.users, self.notices)
@@ -0,0 +1,345 @@
+"""
+Discord roles standing in for notice lists in WaifuHoarder
+
+On servers in role mode (see the rolenotify command) every character with subscribers gets a role of its own, named
+ROLE_PREFIX + the character, held by exactly its subscribers, so its pings one role instead of every subscriber. The
+subscribers in storage stay the source of truth: the roles follow them through a RoleQueue, and reconcile() puts right
+whatever the two disagree on. The IDs of the roles the bot makes are stored too, and no other role is ever edited or
+deleted, whatever its name.
+
+(C) 2019-2020 by Jordan Aurora Kinsley
+
+Licensed under MIT License, see LICENSE
+"""
+
+import asyncio
+import time
+import discord
+from bothelper import log
+
+# every role the bot makes is named like this. A role of the server's own named the same way is left alone, since its ID
+# isn't among those stored in Storage.bot_roles
+ROLE_PREFIX = "notify: "
+# Discord's limit on the length of a role name. Characters whose names only differ past it share a role
+ROLE_NAME_LIMIT = 100
+REASON = "WaifuHoarder role notices"
+
+
+def role_name(character):
+    return (ROLE_PREFIX + str(character))[:ROLE_NAME_LIMIT]
+
+
+class DiscordRoleAPI:
+    """Carries out a RoleQueue's calls through a discord.py client. Guilds, roles and members are read from the client's
+    cache, which the gateway keeps up to date as the changes go through"""
+
+    def __init__(self, client):
+        self.client = client
+
+    def _guild(self, guild):
+        found = self.client.get_guild(int(guild))
+        if found is None:
+            raise KeyError(guild)
+        return found
+
+    async def roles(self, guild):
+        """Returns a dict of the ID of every role on guild named like ours mapped to its name. IDs, since a server's own
+        role can have the same name as one of ours"""
+        found = self.client.get_guild(int(guild))
+        if found is None:
+            return {}
+        return {role.id: role.name for role in found.roles if role.name.startswith(ROLE_PREFIX)}
+
+    async def role_members(self, guild, role):
+        """Returns the IDs of the members holding role"""
+        found = self._guild(guild).get_role(role)
+        return set() if found is None else {member.id for member in found.members}
+
+    async def create_role(self, guild, name):
+        """Creates a role anyone can mention and returns its ID"""
+        role = await self._guild(guild).create_role(name=name, mentionable=True, reason=REASON)
+        return role.id
+
+    async def delete_role(self, guild, role):
+        """Deletes role. Returns False if it was already gone"""
+        found = self._guild(guild).get_role(role)
+        if found is None:
+            return False
+        await found.delete(reason=REASON)
+        return True
+
+    async def edit_member(self, guild, member, give, take):
+        """Gives member the roles in give and takes those in take, one request per role. Returns False if member left.
+        Only those roles are touched: the member's other roles, which other bots or moderators may be changing at the
+        same time, aren't sent along with them"""
+        found = self._guild(guild).get_member(member)
+        if found is None:
+            return False
+        if give:
+            await found.add_roles(*[discord.Object(id=role) for role in give], reason=REASON)
+        if take:
+            await found.remove_roles(*[discord.Object(id=role) for role in take], reason=REASON)
+        return True
+
+
+class _Guild:
+    """Pending changes and API budget for a single guild"""
+
+    def __init__(self, budget, now):
+        # member ID -> {character: True to give its role, False to take it away}, oldest first
+        self.members = {}
+        # (member ID, changes) of the edit being sent
+        self.in_flight = None
+        # names of roles to delete
+        self.deletes = set()
+        # roles created or deleted that the API may not show yet: name -> ID, and IDs
+        self.created = {}
+        self.deleted = set()
+        # IDs of the roles the bot made on the guild, loaded from storage on first use
+        self.owned = None
+        self.tokens = float(budget)
+        self.refilled_at = now
+        self.used_at = now
+        self.worker = None
+        # the timer that drops the guild's state once it has been idle long enough, see RoleQueue._expire
+        self.expiry = None
+
+
+class RoleQueue:
+    """Per-guild queue of role changes. Every guild gets a token bucket of budget API calls per window seconds and a
+    worker that makes its changes in order without going over it, so a burst of sign ups waits here instead of running
+    into Discord's rate limits.
+
+    While changes wait they are merged per member: everything a member signed up for or stopped in the meantime goes out
+    as one member edit, and a sign up followed by a stop cancels out. A member edit costs one call per role it gives or
+    takes, since that is how many requests it makes. A character's role is created when the first
+    member is given it; if that fails (Discord allows 250 roles per guild), its notices keep pinging users instead. The
+    IDs of the roles it makes are written to storage (an asyncstorage.AsyncStorage), so that only those are ever given,
+    taken or deleted"""
+
+    def __init__(self, api, storage, budget=10, window=10.0, args=None, clock=time.monotonic):
+        self.api = api
+        self.storage = storage
+        self.budget = budget
+        self.window = window
+        self.args = args
+        self.clock = clock
+        self.guilds = {}
+        self.edits = 0
+        self.created = 0
+        self.deleted = 0
+        self.merged = 0
+        self.failed = 0
+
+    def _guild(self, guild):
+        state = self.guilds.get(guild)
+        if state is None:
+            state = _Guild(self.budget, self.clock())
+            self.guilds[guild] = state
+        elif state.expiry is not None:
+            # kept while in use, possibly across awaits; whoever asked for it calls _wake when done
+            state.expiry.cancel()
+            state.expiry = None
+        state.used_at = self.clock()
+        return state
+
+    def give(self, guild, member, characters):
+        """Queues giving member the roles of characters"""
+        self._change(guild, member, characters, True)
+
+    def take(self, guild, member, characters):
+        """Queues taking the roles of characters away from member"""
+        self._change(guild, member, characters, False)
+
+    def _change(self, guild, member, characters, wanted, replace=True):
+        state = self._guild(guild)
+        changes = state.members.setdefault(member, {})
+        for character in characters:
+            if character in changes and not replace:
+                continue
+            if changes:
+                self.merged += 1
+            changes[character] = wanted
+            if wanted:
+                state.deletes.discard(role_name(character))
+        if not changes:
+            del state.members[member]
+        self._wake(guild, state)
+
+    def waiting(self, guild, character):
+        """Returns the members on guild still waiting to be given character's role"""
+        state = self.guilds.get(guild)
+        if state is None:
+            return set()
+        waiting = {member for member, changes in state.members.items() if changes.get(character)}
+        if state.in_flight is not None and state.in_flight[1].get(character):
+            waiting.add(state.in_flight[0])
+        return waiting
+
+    async def character_roles(self, guild, characters):
+        """Returns a dict of each of characters that has a role on guild mapped to the role's ID"""
+        state = self._guild(guild)
+        roles = await self._roles(guild, state)
+        self._wake(guild, state)
+        return {character: roles[role_name(character)] for character in characters if role_name(character) in roles}
+
+    async def reconcile(self, guild, subscribers):
+        """Queues whatever it takes for guild's roles to match subscribers, a dict of every character on guild mapped to
+        its subscribers: a role for each character that has any, held by exactly those, and no other roles of ours.
+        Changes already waiting are left alone, since they are newer than subscribers. Returns a (given, taken,
+        deleted) tuple of how many changes were queued"""
+        state = self._guild(guild)
+        roles = await self._roles(guild, state)
+        wanted = {role_name(character): character for character, users in subscribers.items() if users}
+        given = taken = deleted = 0
+        for name in roles:
+            if name not in wanted:
+                state.deletes.add(name)
+                deleted += 1
+        for name, character in wanted.items():
+            users = set(subscribers[character])
+            holders = await self.api.role_members(guild, roles[name]) if name in roles else set()
+            for member in users - holders:
+                self._change(guild, member, [character], True, replace=False)
+                given += 1
+            for member in holders - users:
+                self._change(guild, member, [character], False, replace=False)
+                taken += 1
+        self._wake(guild, state)
+        return given, taken, deleted
+
+    async def clear(self, guild):
+        """Drops every change waiting for guild and queues deleting all of the roles the bot made on it. Returns how many
+        roles are to be deleted"""
+        state = self._guild(guild)
+        state.members.clear()
+        state.deletes.update(await self._roles(guild, state))
+        self._wake(guild, state)
+        return len(state.deletes)
+
+    async def _roles(self, guild, state):
+        """The roles the bot made on guild as a dict of name to ID, corrected for the changes we made that the API may
+        not show yet"""
+        if state.owned is None:
+            state.owned = await self.storage.bot_roles(guild)
+        found = await self.api.roles(guild)
+        for name in [name for name, role in state.created.items() if role in found]:
+            del state.created[name]
+        state.deleted &= set(found)
+        roles = {name: role for role, name in found.items() if role in state.owned}
+        roles.update(state.created)
+        return {name: role for name, role in roles.items() if role not in state.deleted}
+
+    def _wake(self, guild, state):
+        if state.expiry is not None:
+            state.expiry.cancel()
+            state.expiry = None
+        if state.worker is None or state.worker.done():
+            if state.members or state.deletes:
+                state.worker = asyncio.ensure_future(self._drain(guild, state))
+            else:
+                self._expire(guild, state)
+
+    def _idle_for(self, state):
+        """Returns how long until the guild's budget is full again, after which dropping its state changes nothing, and
+        it has gone a window without being used, so a busy guild doesn't read its roles from storage on every its"""
+        now = self.clock()
+        tokens = state.tokens + (now - state.refilled_at) * self.budget / self.window
+        return max((self.budget - tokens) * self.window / self.budget, state.used_at + self.window - now, 0.0)
+
+    def _expire(self, guild, state):
+        """Drops the state of a guild with nothing left to change, so every guild that ever had role notices isn't
+        kept forever. Checks again later if it isn't idle long enough yet"""
+        state.expiry = None
+        if state.members or state.deletes or (state.worker is not None and not state.worker.done()):
+            # busy again; its worker schedules this once more when it is done
+            return
+        idle_for = self._idle_for(state)
+        if idle_for > 0:
+            state.expiry = asyncio.get_event_loop().call_later(idle_for, self._expire, guild, state)
+        elif self.guilds.get(guild) is state:
+            del self.guilds[guild]
+
+    async def _take_token(self, state):
+        """Waits until the guild's budget allows another call, then spends it"""
+        rate = self.budget / self.window
+        while True:
+            now = self.clock()
+            state.tokens = min(float(self.budget), state.tokens + (now - state.refilled_at) * rate)
+            state.refilled_at = now
+            if state.tokens >= 1:
+                state.tokens -= 1
+                return
+            await asyncio.sleep((1 - state.tokens) / rate)
+
+    async def _call(self, guild, state, function, *args, cost=1):
+        """Makes one API call, which takes cost requests, inside the guild's budget. Returns its result, or None if it
+        failed"""
+        for _ in range(cost):
+            await self._take_token(state)
+        try:
+            return await function(guild, *args)
+        except Exception as error:
+            # a failed change (missing Manage Roles, too many roles...) shouldn't hold up the rest of the guild
+            self.failed += 1
+            log("def RoleQueue._call: {0} on {1} failed: {2}", 'vf', self.args, function.__name__, guild, error)
+            return None
+
+    async def _drain(self, guild, state):
+        while state.deletes or state.members:
+            roles = await self._roles(guild, state)
+            if state.deletes:
+                role = roles.get(state.deletes.pop())
+                if role is None:
+                    continue
+                deleted = await self._call(guild, state, self.api.delete_role, role)
+                if deleted is not None:
+                    # deleted now or already gone, either way not ours to keep track of any more
+                    state.owned.discard(role)
+                    await self.storage.remove_bot_role(guild, role)
+                if deleted:
+                    state.deleted.add(role)
+                    self.deleted += 1
+                continue
+            member = next(iter(state.members))
+            changes = state.members.pop(member)
+            state.in_flight = (member, changes)
+            try:
+                give, take = set(), set()
+                for character, wanted in changes.items():
+                    name = role_name(character)
+                    if wanted and name not in roles:
+                        role = await self._call(guild, state, self.api.create_role, name)
+                        if role is None:
+                            continue
+                        roles[name] = state.created[name] = role
+                        state.owned.add(role)
+                        await self.storage.add_bot_role(guild, role)
+                        self.created += 1
+                    if name in roles:
+                        (give if wanted else take).add(roles[name])
+                if give or take:
+                    if await self._call(guild, state, self.api.edit_member, member, give, take,
+                                        cost=len(give) + len(take)):
+                        self.edits += 1
+            finally:
+                state.in_flight = None
+        state.expiry = asyncio.get_event_loop().call_later(self._idle_for(state), self._expire, guild, state)
+
+    def depth(self):
+        """Returns how many member edits and role deletions are waiting, over all guilds"""
+        return sum(len(state.members) + len(state.deletes) for state in self.guilds.values())
+
+    def stats(self):
+        return ("role queue: {0} waiting in {1} guilds, {2} member edits, {3} changes merged into others, {4} roles "
+                "created, {5} deleted, {6} failed").format(self.depth(), len(self.guilds), self.edits, self.merged,
+                                                           self.created, self.deleted, self.failed)
+
+    def close(self):
+        """Stops every guild's worker. Whatever is still queued is dropped, for the next reconcile to pick up"""
+        for state in self.guilds.values():
+            if state.worker is not None:
+                state.worker.cancel()
+            if state.expiry is not None:
+                state.expiry.cancel()
+        self.guilds.clear()
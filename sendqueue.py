@@ -0,0 +1,256 @@
+"""
+Rate limited outbound messages for WaifuHoarder
+
+(C) 2019-2020 by Jordan Aurora Kinsley
+
+Licensed under MIT License, see LICENSE
+"""
+
+import asyncio
+import time
+from collections import deque
+from bothelper import log, DISCORD_MESSAGE_LIMIT
+
+
+async def discord_transport(channel, content, **kwargs):
+    """Sends content to a discord.py channel (or anything else with an async send, like a Context)"""
+    return await channel.send(content, **kwargs)
+
+
+class FakeTransport:
+    """Stands in for Discord when testing or benchmarking the queue: records a (time, channel, content, kwargs) tuple for
+    every message instead of sending it, optionally after a simulated network delay"""
+
+    def __init__(self, latency=0.0, clock=time.monotonic):
+        self.latency = latency
+        self.clock = clock
+        self.sent = []
+
+    async def __call__(self, channel, content, **kwargs):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.sent.append((self.clock(), channel, content, kwargs))
+
+
+class _Outgoing:
+    """One queued message, or one queued notice that gets rendered into messages when its turn comes"""
+    __slots__ = ('content', 'kwargs', 'key', 'users', 'render', 'queued_at')
+
+    def __init__(self, queued_at, content=None, kwargs=None, key=None, users=None, render=None):
+        self.queued_at = queued_at
+        self.content = content
+        self.kwargs = kwargs or {}
+        self.key = key
+        self.users = users
+        self.render = render
+
+
+class _Channel:
+    """Queue and send budget for a single channel"""
+
+    def __init__(self, budget, now):
+        self.entries = deque()
+        self.tokens = float(budget)
+        self.refilled_at = now
+        # notice key -> the _Outgoing still waiting in entries
+        self.pending_notices = {}
+        # notice key -> (time it stops counting as recent, users it pinged)
+        self.recent_notices = {}
+        self.worker = None
+        # the timer that drops the channel's state once it has been idle long enough, see SendQueue._expire
+        self.expiry = None
+
+
+class SendQueue:
+    """Per-channel outbound message scheduler. Every channel gets a token bucket of budget messages per window seconds,
+    the same shape as Discord's own per-channel limit, and a worker that sends the channel's messages in order without
+    going over it, so bursts wait here instead of piling up behind 429 responses.
+
+    While messages wait, the queue saves budget two ways: consecutive plain messages with the same options are merged
+    whenever they fit in one Discord message, and notices (see notice()) for the same key are merged into one."""
+
+    def __init__(self, transport=discord_transport, budget=5, window=5.0, debounce=10.0, args=None,
+                 limit=DISCORD_MESSAGE_LIMIT, clock=time.monotonic):
+        self.transport = transport
+        self.budget = budget
+        self.window = window
+        self.debounce = debounce
+        self.args = args
+        self.limit = limit
+        self.clock = clock
+        self.channels = {}
+        self.sent = 0
+        self.merged = 0
+        self.coalesced = 0
+        self.failed = 0
+        self.total_delay = 0.0
+        self.max_delay = 0.0
+
+    def _channel(self, channel):
+        key = getattr(channel, 'id', channel)
+        state = self.channels.get(key)
+        if state is None:
+            state = _Channel(self.budget, self.clock())
+            self.channels[key] = state
+        return state
+
+    def send(self, channel, content, **kwargs):
+        """Queues content to be sent to channel with the given send() keyword arguments, e.g. delete_after"""
+        state = self._channel(channel)
+        state.entries.append(_Outgoing(self.clock(), content=content, kwargs=kwargs))
+        self._wake(channel, state)
+
+    def notice(self, channel, key, users, render):
+        """Queues a notice pinging users about key (e.g. a tuple of characters). render(users, key) returns the messages
+        to send and is only called when the notice's turn comes, so:
+        - while a notice for the same key is still waiting, users are merged into it instead of queueing another
+        - for debounce seconds after one goes out, users it already pinged are left out of repeats, and a repeat with
+          nobody new in it is dropped"""
+        state = self._channel(channel)
+        now = self.clock()
+        waiting = state.pending_notices.get(key)
+        if waiting is not None:
+            waiting.users.update(users)
+            self.coalesced += 1
+            return
+        users = set(users)
+        recent = state.recent_notices.get(key)
+        if recent is not None:
+            if recent[0] < now:
+                del state.recent_notices[key]
+            else:
+                users -= recent[1]
+                if not users:
+                    self.coalesced += 1
+                    return
+        entry = _Outgoing(now, key=key, users=users, render=render)
+        state.pending_notices[key] = entry
+        state.entries.append(entry)
+        self._wake(channel, state)
+
+    def _wake(self, channel, state):
+        if state.expiry is not None:
+            state.expiry.cancel()
+            state.expiry = None
+        if state.worker is None or state.worker.done():
+            state.worker = asyncio.ensure_future(self._drain(channel, state))
+
+    def _idle_for(self, state):
+        """Returns how long until dropping the channel's state changes nothing: its budget is full again and no notice
+        sent from it still counts as recent"""
+        now = self.clock()
+        tokens = state.tokens + (now - state.refilled_at) * self.budget / self.window
+        refilled = (self.budget - tokens) * self.window / self.budget
+        recent = max((until for until, _ in state.recent_notices.values()), default=now)
+        return max(refilled, recent - now, 0.0)
+
+    def _expire(self, key, state):
+        """Drops the state of a channel with nothing left to send, so every channel the bot ever replied in isn't kept
+        forever. Checks again later if it isn't idle long enough yet"""
+        state.expiry = None
+        if state.entries or (state.worker is not None and not state.worker.done()):
+            # busy again; its worker schedules this once more when it is done
+            return
+        idle_for = self._idle_for(state)
+        if idle_for > 0:
+            state.expiry = asyncio.get_event_loop().call_later(idle_for, self._expire, key, state)
+        elif self.channels.get(key) is state:
+            del self.channels[key]
+
+    async def _take_token(self, state):
+        """Waits until the channel's budget allows another message, then spends it"""
+        rate = self.budget / self.window
+        while True:
+            now = self.clock()
+            state.tokens = min(float(self.budget), state.tokens + (now - state.refilled_at) * rate)
+            state.refilled_at = now
+            if state.tokens >= 1:
+                state.tokens -= 1
+                return
+            await asyncio.sleep((1 - state.tokens) / rate)
+
+    def _render(self, state, entry):
+        """Turns a notice into plain messages at the front of the queue, remembering who it pinged"""
+        del state.pending_notices[entry.key]
+        now = self.clock()
+        users = entry.users
+        pinged = set(users)
+        recent = state.recent_notices.get(entry.key)
+        if recent is not None and recent[0] >= now:
+            # users merged in while this waited may have been pinged by the notice that went out just before it
+            users = users - recent[1]
+            pinged |= recent[1]
+            if not users:
+                self.coalesced += 1
+                return
+        state.recent_notices[entry.key] = (now + self.debounce, pinged)
+        if len(state.recent_notices) > 64:
+            state.recent_notices = {key: recent for key, recent in state.recent_notices.items() if recent[0] >= now}
+        for content in reversed(list(entry.render(sorted(users), entry.key))):
+            state.entries.appendleft(_Outgoing(entry.queued_at, content=content))
+
+    def _merge(self, state, entry):
+        """Folds the plain messages queued right behind entry into it for as long as they fit in one message"""
+        while state.entries:
+            following = state.entries[0]
+            if following.render is not None or following.kwargs != entry.kwargs:
+                break
+            separator = '' if entry.content.endswith('\n') else '\n'
+            if len(entry.content) + len(separator) + len(following.content) > self.limit:
+                break
+            state.entries.popleft()
+            entry.content = entry.content + separator + following.content
+            self.merged += 1
+
+    async def _drain(self, channel, state):
+        while state.entries:
+            if state.entries[0].render is not None:
+                # rendering doesn't send anything, so it doesn't spend any budget
+                self._render(state, state.entries.popleft())
+                continue
+            await self._take_token(state)
+            entry = state.entries.popleft()
+            self._merge(state, entry)
+            delay = self.clock() - entry.queued_at
+            self.total_delay += delay
+            self.max_delay = max(self.max_delay, delay)
+            try:
+                await self.transport(channel, entry.content, **entry.kwargs)
+                self.sent += 1
+            except Exception as error:
+                # one failed message (missing permissions, deleted channel...) shouldn't stop the rest of the channel
+                self.failed += 1
+                log("def SendQueue._drain: send to {0} failed: {1}", 'vf', self.args, getattr(channel, 'id', channel),
+                    error)
+        state.expiry = asyncio.get_event_loop().call_later(self._idle_for(state), self._expire,
+                                                           getattr(channel, 'id', channel), state)
+
+    async def join(self):
+        """Waits until everything queued so far, and anything queued while waiting, has been sent"""
+        while True:
+            workers = [state.worker for state in self.channels.values()
+                       if state.worker is not None and not state.worker.done()]
+            if not workers:
+                return
+            await asyncio.gather(*workers, return_exceptions=True)
+
+    def depth(self):
+        """Returns how many messages and notices are waiting, over all channels"""
+        return sum(len(state.entries) for state in self.channels.values())
+
+    def stats(self):
+        busiest = max((len(state.entries) for state in self.channels.values()), default=0)
+        average = self.total_delay / self.sent if self.sent else 0.0
+        return ("send queue: {0} waiting in {1} channels (busiest {2}), {3} sent, {4} merged, {5} notices coalesced, "
+                "{6} failed, delay {7:.2f}s average / {8:.2f}s max").format(
+            self.depth(), len(self.channels), busiest, self.sent, self.merged, self.coalesced, self.failed, average,
+            self.max_delay)
+
+    def close(self):
+        """Stops every channel's worker. Whatever is still queued is dropped"""
+        for state in self.channels.values():
+            if state.worker is not None:
+                state.worker.cancel()
+            if state.expiry is not None:
+                state.expiry.cancel()
+        self.channels.clear()
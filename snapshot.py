@@ -0,0 +1,99 @@
+"""
+Snapshots of WaifuHoarder's per-server names, for a fast cold start
+
+A snapshot holds every server's characters, aliases and watched channels as the storage engine had them, together with
+the engine's name versions (see Storage.name_versions). On start up the cog builds its alias tables and matchers from
+the snapshot for every server whose version hasn't moved since, and only reads the servers that changed back from
+storage.
+
+File layout: a fixed header (magic, format version, payload length, CRC32 of the payload) followed by the payload, a
+pickled dict. Anything that doesn't match is treated as no snapshot at all.
+
+(C) 2019-2020 by Jordan Aurora Kinsley
+
+Licensed under MIT License, see LICENSE
+"""
+
+import os
+import pickle
+import struct
+import zlib
+
+MAGIC = b'WAIFUSNP'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('>8sHQI')
+
+
+def capture(store, keep=None):
+    """Reads a snapshot of every server out of a storage engine, leaving out those keep(server) is False for. Runs on
+    the storage thread, since it reads every server's names"""
+    epoch, versions = store.name_versions()
+    servers = {}
+    for server, version in versions.items():
+        if keep is not None and not keep(server):
+            continue
+        servers[server] = (version, sorted(store.characters(server)), store.aliases(server),
+                           sorted(store.watched_channels(server)))
+    return {"epoch": epoch, "servers": servers}
+
+
+def write(path, snapshot, magic=MAGIC):
+    """Writes snapshot to path. The file is written next to it first and moved over it, so a crash part way through
+    leaves the previous snapshot in place"""
+    return write_payload(path, pickle.dumps(snapshot, pickle.HIGHEST_PROTOCOL), magic)
+
+
+def write_payload(path, payload, magic=MAGIC):
+    """Writes an already pickled payload to path the way write() does. Other files framed like snapshots (see
+    eventlog.py) pass a magic of their own, so one is never mistaken for the other"""
+    temporary = path + '.tmp'
+    with open(temporary, 'wb') as output:
+        output.write(HEADER.pack(magic, FORMAT_VERSION, len(payload), zlib.crc32(payload)))
+        output.write(payload)
+        output.flush()
+        os.fsync(output.fileno())
+    os.replace(temporary, path)
+    return len(payload) + HEADER.size
+
+
+def read(path, magic=MAGIC):
+    """Reads the snapshot at path in one go. Raises OSError if it can't be read and ValueError if it isn't a snapshot
+    this version understands or fails its checksum"""
+    with open(path, 'rb') as snapshot_file:
+        data = snapshot_file.read()
+    if len(data) < HEADER.size:
+        raise ValueError("too short to be a snapshot")
+    found_magic, version, length, checksum = HEADER.unpack_from(data)
+    if found_magic != magic or version != FORMAT_VERSION:
+        raise ValueError("not a version {0} snapshot".format(FORMAT_VERSION))
+    payload = memoryview(data)[HEADER.size:]
+    if len(payload) != length or zlib.crc32(payload) != checksum:
+        raise ValueError("truncated or corrupt")
+    try:
+        return pickle.loads(payload)
+    except Exception as error:
+        raise ValueError("couldn't be unpickled: {0}".format(error))
+
+
+def save(store, path, keep=None):
+    """Captures store and writes it to path. Returns the (epoch, versions) it was captured at and its size in bytes"""
+    snapshot = capture(store, keep)
+    size = write(path, snapshot)
+    return (snapshot["epoch"], {server: entry[0] for server, entry in snapshot["servers"].items()}), size
+
+
+def split(snapshot, epoch, versions):
+    """Sorts the servers in versions (as returned by Storage.name_versions) into those the snapshot is still right
+    about and those that changed since it was taken. Returns a (fresh, stale) tuple: fresh maps a server to its
+    (characters, aliases, channels) entry, stale is a list of servers to read from storage"""
+    if snapshot is None or snapshot.get("epoch") != epoch:
+        return {}, list(versions)
+    fresh = {}
+    stale = []
+    for server, version in versions.items():
+        entry = snapshot["servers"].get(server)
+        if entry is not None and entry[0] == version:
+            fresh[server] = entry[1:]
+        else:
+            stale.append(server)
+    return fresh, stale
@@ -0,0 +1,1046 @@
+"""
+Storage engines for WaifuHoarder notices and aliases
+
+(C) 2019-2020 by Jordan Aurora Kinsley
+
+Licensed under MIT License, see LICENSE
+"""
+
+import functools
+import os
+import sqlite3
+import uuid
+import maintenance
+from indexes import GuildIndex, UserIndex, make_key, split_key
+from subscribers import SubscriberSet, parse_user
+from writebehind import open_shelf
+
+
+class Storage:
+    """Interface between the Waifu cog and wherever notices and aliases are kept. Notices map a character on a server
+    to the users who want to hear about it; aliases map an alternate name on a server to a character. Users are integer
+    Discord user IDs; mentions are only built when a notice gets sent."""
+    # subscriber list bytes read and written so far, for metrics.py. Engines count them however suits their format
+    bytes_read = 0
+    bytes_written = 0
+
+    def close(self):
+        raise NotImplementedError
+
+    def sync(self):
+        """Makes sure everything written so far is on disk"""
+        raise NotImplementedError
+
+    def dirty_count(self):
+        """Returns how many changes are held in memory waiting to be flushed"""
+        return 0
+
+    def flush(self, limit=None):
+        """Writes up to limit pending changes (all of them if limit is None) and returns how many were written"""
+        return 0
+
+    def compact(self, drop_dangling=False):
+        """Gives space left by deleted and rewritten entries back to the file system, drops notices nobody is signed up
+        for (unless an alias leads to them) and finds aliases that lead to no character (see maintenance.check_aliases),
+        dropping them too if drop_dangling is set. Returns a maintenance.CompactionReport"""
+        raise NotImplementedError
+
+    # notices
+    def has_character(self, server, character):
+        raise NotImplementedError
+
+    def add_character(self, server, character):
+        """Makes character known on server without signing anyone up for it"""
+        raise NotImplementedError
+
+    def subscribers(self, server, character):
+        """Returns a SubscriberSet of the users signed up for character on server. Raises KeyError if the character is
+        unknown"""
+        raise NotImplementedError
+
+    def add_subscriber(self, server, character, user):
+        """Signs user up for character, creating the character if needed. Returns an (added, created) tuple: added is
+        False if user was already signed up, created is True if the character didn't exist before"""
+        raise NotImplementedError
+
+    def subscribers_many(self, server, characters):
+        """Returns a dict of each known character in characters mapped to its SubscriberSet. Unknown characters are left
+        out. Engines that can fetch several characters in one query override this"""
+        found = {}
+        for character in characters:
+            try:
+                found[character] = self.subscribers(server, character)
+            except KeyError:
+                pass
+        return found
+
+    def add_subscriber_many(self, server, characters, user):
+        """Signs user up for every character in characters as one batch of writes. Returns an (added, created) tuple:
+        added is a dict of each character mapped to False if user was already signed up for it, True otherwise, and
+        created is the set of characters that didn't exist before"""
+        added = {}
+        created = set()
+        for character in characters:
+            added[character], new = self.add_subscriber(server, character, user)
+            if new:
+                created.add(character)
+        return added, created
+
+    def add_subscribers(self, server, character, users):
+        """Signs every user in users up for character, creating the character if needed, as one batch of writes.
+        Returns how many of them weren't signed up already"""
+        self.add_character(server, character)
+        return sum(1 for user in users if self.add_subscriber(server, character, user)[0])
+
+    def remove_subscriber(self, server, character, user):
+        """Returns False if user wasn't signed up for character. Raises KeyError if the character is unknown"""
+        raise NotImplementedError
+
+    def remove_user(self, server, user):
+        """Removes user from every notice on server and returns the characters they were removed from"""
+        raise NotImplementedError
+
+    def user_characters(self, server, user):
+        """Returns the set of characters user is signed up for on server"""
+        raise NotImplementedError
+
+    def characters(self, server):
+        """Returns the set of characters known on server"""
+        raise NotImplementedError
+
+    def remove_character(self, server, character):
+        """Raises KeyError if the character is unknown"""
+        raise NotImplementedError
+
+    def rename_character(self, server, character, new_name):
+        """Moves every notice for character to new_name. If new_name is a character already, the two are merged: its
+        subscribers keep their notices and character's are added to them. Raises KeyError if the character is
+        unknown"""
+        raise NotImplementedError
+
+    def drop_server_notices(self, server):
+        raise NotImplementedError
+
+    def clear_notices(self):
+        raise NotImplementedError
+
+    def all_notices(self):
+        """Yields a (server, character, SubscriberSet) tuple for every character on every server"""
+        raise NotImplementedError
+
+    # aliases
+    def get_alias(self, server, alias):
+        """Returns the character alias refers to on server. Raises KeyError if there is no such alias"""
+        raise NotImplementedError
+
+    def get_aliases(self, server, aliases):
+        """Returns a dict of each alias in aliases that exists on server mapped to the character it refers to"""
+        found = {}
+        for alias in aliases:
+            try:
+                found[alias] = self.get_alias(server, alias)
+            except KeyError:
+                pass
+        return found
+
+    def set_alias(self, server, alias, character):
+        raise NotImplementedError
+
+    def remove_alias(self, server, alias):
+        """Raises KeyError if there is no such alias"""
+        raise NotImplementedError
+
+    def aliases(self, server):
+        """Returns a dict of every alias on server mapped to the character it refers to"""
+        raise NotImplementedError
+
+    def drop_server_aliases(self, server):
+        raise NotImplementedError
+
+    def clear_aliases(self):
+        raise NotImplementedError
+
+    def all_aliases(self):
+        """Yields a (server, alias, character) tuple for every alias on every server"""
+        raise NotImplementedError
+
+    # channels where posted messages are scanned for character names
+    def watched_channels(self, server):
+        """Returns the set of channel IDs on server where automatic notices are turned on"""
+        raise NotImplementedError
+
+    def watch_channel(self, server, channel):
+        """Returns False if automatic notices were already on for channel"""
+        raise NotImplementedError
+
+    def unwatch_channel(self, server, channel):
+        """Returns False if automatic notices weren't on for channel"""
+        raise NotImplementedError
+
+    def all_watched_channels(self):
+        """Yields a (server, channel) tuple for every channel with automatic notices on"""
+        raise NotImplementedError
+
+    # servers whose notices go out as role mentions (see roles.py)
+    def role_servers(self):
+        """Returns the set of servers with role notices turned on"""
+        raise NotImplementedError
+
+    def set_role_mode(self, server, enabled):
+        """Turns role notices on or off for server. Returns False if they already were"""
+        raise NotImplementedError
+
+    def bot_roles(self, server):
+        """Returns the set of IDs of the roles the bot made on server, the only ones it edits or deletes. Kept apart from
+        the role mode, since turning that off leaves the roles to be deleted"""
+        raise NotImplementedError
+
+    def add_bot_role(self, server, role):
+        raise NotImplementedError
+
+    def remove_bot_role(self, server, role):
+        raise NotImplementedError
+
+    # servers the bot left and members who left them, see purge.py
+    def servers(self):
+        """Returns the set of servers with characters, aliases, watched channels, role notices or roles the bot made
+        stored"""
+        raise NotImplementedError
+
+    def all_users(self):
+        """Yields a (server, user) tuple for every user signed up for anything on a server"""
+        raise NotImplementedError
+
+    def purge_server(self, server, limit=None):
+        """Removes up to limit of server's characters (with their notices) and aliases, then its settings. Returns how
+        many were removed; less than limit once nothing of server is left"""
+        raise NotImplementedError
+
+    # versions, for snapshot.py
+    def name_versions(self):
+        """Returns an (epoch, versions) tuple. versions maps every server with characters, aliases or watched channels
+        to a number that changes whenever any of those do. The epoch changes whenever every server may have changed at
+        once, so a version is only comparable to one read under the same epoch"""
+        raise NotImplementedError
+
+
+class ShelveStorage(Storage):
+    """The original storage engine: a pair of 'shelves' (https://docs.python.org/3/library/shelve.html) keyed by
+    <server>\\<name>, with each character's SubscriberSet packed into bytes, plus the guild and user indexes and shelves
+    of per-server channel and role settings. Changes are held in memory by writebehind.WriteBehindShelf until flushed"""
+
+    def __init__(self, user_list_location, character_alias_location):
+        self.user_list_location = user_list_location
+        self.character_alias_location = character_alias_location
+        self._open()
+
+    def _open(self):
+        # a compaction cut short is finished (or undone) before anything reads the shelves
+        maintenance.recover_compaction(self.user_list_location, self.character_alias_location)
+        self.notify_user_list = open_shelf(self.user_list_location)
+        self.character_aliases = open_shelf(self.character_alias_location)
+        # <server> -> set of channel IDs with automatic notices on
+        self.channel_settings = open_shelf(self.user_list_location + '.channels')
+        # <server> -> True for servers with role notices on
+        self.role_settings = open_shelf(self.user_list_location + '.roles')
+        # <server> -> set of IDs of the roles the bot made there
+        self.role_ids = open_shelf(self.user_list_location + '.roleids')
+        # maps each server to the character and alias names it has, so per-server commands don't scan every key
+        self.guild_index = GuildIndex(self.user_list_location + '.index')
+        if not self.guild_index.is_built():
+            # first run with an index, or the index file went missing: build it from the shelves once
+            self.guild_index.rebuild(self.notify_user_list, self.character_aliases)
+        # maps each (server, user) pair to the characters that user follows, so per-user commands don't scan every key
+        self.user_index = UserIndex(self.user_list_location + '.users')
+        if not self.user_index.is_built():
+            # also where shelves from before user IDs were stored get their lists of mentions packed into IDs
+            self.convert_subscribers()
+            self.user_index.rebuild(self.notify_user_list)
+
+    def convert_subscribers(self):
+        """Rewrites any notice still stored as a pickled list of mention strings as a packed SubscriberSet of user IDs.
+        Returns how many notices were converted"""
+        converted = 0
+        for key in list(self.notify_user_list.keys()):
+            value = self.notify_user_list[key]
+            if not isinstance(value, (bytes, bytearray)):
+                self.notify_user_list[key] = SubscriberSet.load(value).to_bytes()
+                converted += 1
+        return converted
+
+    def _load(self, notice_key):
+        value = self.notify_user_list[notice_key]
+        self.bytes_read += len(value) if isinstance(value, (bytes, bytearray)) else 0
+        return SubscriberSet.load(value)
+
+    def _store(self, notice_key, subscribers):
+        value = subscribers.to_bytes()
+        self.bytes_written += len(value)
+        self.notify_user_list[notice_key] = value
+
+    def close(self):
+        self.flush()
+        self.notify_user_list.close()
+        self.character_aliases.close()
+        self.channel_settings.close()
+        self.role_settings.close()
+        self.role_ids.close()
+        self.guild_index.close()
+        self.user_index.close()
+
+    def sync(self):
+        self.flush()
+        for shelf in self._shelves():
+            shelf.sync()
+
+    def compact(self, drop_dangling=False):
+        # the shelves are rewritten into new files, so they are closed (and flushed) first and opened again after
+        self.close()
+        try:
+            return maintenance.compact_shelves(self.user_list_location, self.character_alias_location, drop_dangling)
+        finally:
+            self._open()
+
+    def _shelves(self):
+        # the indexes come last so a flush cut short leaves them behind the data, never ahead of it
+        return (self.notify_user_list, self.character_aliases, self.channel_settings, self.role_settings,
+                self.role_ids, self.guild_index.index, self.user_index.index)
+
+    def dirty_count(self):
+        return sum(shelf.dirty_count() for shelf in self._shelves())
+
+    def flush(self, limit=None):
+        if not self.dirty_count():
+            return 0
+        # if we die part way through a flush, the indexes no longer match the shelves and get rebuilt on the next start
+        self.guild_index.mark_built(False)
+        self.user_index.mark_built(False)
+        written = 0
+        for shelf in self._shelves():
+            written += shelf.flush(None if limit is None else limit - written)
+            if limit is not None and written >= limit:
+                break
+        if not self.dirty_count():
+            self.guild_index.mark_built(True)
+            self.user_index.mark_built(True)
+        return written
+
+    def has_character(self, server, character):
+        return make_key(server, character) in self.notify_user_list
+
+    def add_character(self, server, character):
+        notice_key = make_key(server, character)
+        if notice_key not in self.notify_user_list:
+            self._store(notice_key, SubscriberSet())
+        self.guild_index.add(GuildIndex.CHARACTERS, server, character)
+
+    def subscribers(self, server, character):
+        return self._load(make_key(server, character))
+
+    def add_subscriber(self, server, character, user):
+        notice_key = make_key(server, character)
+        created = False
+        try:
+            current_notices = self._load(notice_key)
+        except KeyError:
+            current_notices = SubscriberSet()
+            created = True
+        if not current_notices.add(user):
+            return False, False
+        self._store(notice_key, current_notices)
+        self.guild_index.add(GuildIndex.CHARACTERS, server, character)
+        self.user_index.add(server, user, character)
+        return True, created
+
+    def add_subscribers(self, server, character, users):
+        # one load and one store for the whole batch, instead of one of each per user
+        notice_key = make_key(server, character)
+        try:
+            current_notices = self._load(notice_key)
+        except KeyError:
+            current_notices = SubscriberSet()
+        added = [user for user in users if current_notices.add(user)]
+        if added or notice_key not in self.notify_user_list:
+            self._store(notice_key, current_notices)
+        self.guild_index.add(GuildIndex.CHARACTERS, server, character)
+        for user in added:
+            self.user_index.add(server, user, character)
+        return len(added)
+
+    def remove_subscriber(self, server, character, user):
+        notice_key = make_key(server, character)
+        current_notices = self._load(notice_key)
+        if not current_notices.remove(user):
+            return False
+        self._store(notice_key, current_notices)
+        self.user_index.discard(server, user, character)
+        return True
+
+    def remove_user(self, server, user):
+        # the user index tells us exactly which notice lists the user is on, so only those get rewritten
+        removed = self.user_index.drop(server, user)
+        for character in removed:
+            notice_key = make_key(server, character)
+            try:
+                current_notices = self._load(notice_key)
+            except KeyError:
+                continue
+            if current_notices.remove(user):
+                self._store(notice_key, current_notices)
+        return removed
+
+    def user_characters(self, server, user):
+        return self.user_index.characters(server, user)
+
+    def characters(self, server):
+        return self.guild_index.names(GuildIndex.CHARACTERS, server)
+
+    def remove_character(self, server, character):
+        removed_notices = SubscriberSet.load(self.notify_user_list.pop(make_key(server, character)))
+        self.guild_index.discard(GuildIndex.CHARACTERS, server, character)
+        for user in removed_notices:
+            self.user_index.discard(server, user, character)
+
+    def rename_character(self, server, character, new_name):
+        renamed_notices = SubscriberSet.load(self.notify_user_list.pop(make_key(server, character)))
+        try:
+            # renaming onto a character that exists merges the two, as the other engines do
+            merged_notices = self._load(make_key(server, new_name))
+        except KeyError:
+            merged_notices = SubscriberSet()
+        for user in renamed_notices:
+            merged_notices.add(user)
+        self._store(make_key(server, new_name), merged_notices)
+        self.guild_index.discard(GuildIndex.CHARACTERS, server, character)
+        self.guild_index.add(GuildIndex.CHARACTERS, server, new_name)
+        for user in renamed_notices:
+            self.user_index.discard(server, user, character)
+            self.user_index.add(server, user, new_name)
+
+    def drop_server_notices(self, server):
+        # only this server's keys, matched exactly instead of by substring
+        for character in self.guild_index.drop(GuildIndex.CHARACTERS, server):
+            try:
+                dropped_notices = SubscriberSet.load(self.notify_user_list.pop(make_key(server, character)))
+            except KeyError:
+                continue
+            for user in dropped_notices:
+                self.user_index.discard(server, user, character)
+
+    def clear_notices(self):
+        self.notify_user_list.clear()
+        self.guild_index.clear(GuildIndex.CHARACTERS)
+        self.user_index.clear()
+
+    def all_notices(self):
+        for key in self.notify_user_list.keys():
+            server, character = split_key(key)
+            yield server, character, self._load(key)
+
+    def get_alias(self, server, alias):
+        return self.character_aliases[make_key(server, alias)]
+
+    def set_alias(self, server, alias, character):
+        self.character_aliases[make_key(server, alias)] = character
+        self.guild_index.add(GuildIndex.ALIASES, server, alias)
+
+    def remove_alias(self, server, alias):
+        del self.character_aliases[make_key(server, alias)]
+        self.guild_index.discard(GuildIndex.ALIASES, server, alias)
+
+    def aliases(self, server):
+        server_aliases = {}
+        for alias in self.guild_index.names(GuildIndex.ALIASES, server):
+            try:
+                server_aliases[alias] = self.character_aliases[make_key(server, alias)]
+            except KeyError:
+                pass
+        return server_aliases
+
+    def drop_server_aliases(self, server):
+        for alias in self.guild_index.drop(GuildIndex.ALIASES, server):
+            try:
+                del self.character_aliases[make_key(server, alias)]
+            except KeyError:
+                pass
+
+    def clear_aliases(self):
+        self.character_aliases.clear()
+        self.guild_index.clear(GuildIndex.ALIASES)
+
+    def all_aliases(self):
+        for key in self.character_aliases.keys():
+            server, alias = split_key(key)
+            yield server, alias, self.character_aliases[key]
+
+    def watched_channels(self, server):
+        try:
+            return set(self.channel_settings[str(server)])
+        except KeyError:
+            return set()
+
+    def watch_channel(self, server, channel):
+        channels = self.watched_channels(server)
+        if channel in channels:
+            return False
+        channels.add(channel)
+        self.channel_settings[str(server)] = channels
+        self.guild_index.bump(server)
+        return True
+
+    def unwatch_channel(self, server, channel):
+        channels = self.watched_channels(server)
+        if channel not in channels:
+            return False
+        channels.discard(channel)
+        if channels:
+            self.channel_settings[str(server)] = channels
+        else:
+            del self.channel_settings[str(server)]
+        self.guild_index.bump(server)
+        return True
+
+    def all_watched_channels(self):
+        for server in self.channel_settings.keys():
+            for channel in self.channel_settings[server]:
+                yield server, channel
+
+    def role_servers(self):
+        return set(self.role_settings.keys())
+
+    def set_role_mode(self, server, enabled):
+        if (str(server) in self.role_settings) == enabled:
+            return False
+        if enabled:
+            self.role_settings[str(server)] = True
+        else:
+            del self.role_settings[str(server)]
+        return True
+
+    def bot_roles(self, server):
+        return set(self.role_ids.get(str(server), ()))
+
+    def add_bot_role(self, server, role):
+        # a new set rather than the stored one changed in place, see GuildIndex.names
+        self.role_ids[str(server)] = self.bot_roles(server) | {role}
+
+    def remove_bot_role(self, server, role):
+        roles = self.bot_roles(server)
+        if role in roles:
+            roles.discard(role)
+            if roles:
+                self.role_ids[str(server)] = roles
+            else:
+                del self.role_ids[str(server)]
+
+    def servers(self):
+        return (self.guild_index.servers() | set(self.channel_settings.keys()) | set(self.role_settings.keys()) |
+                set(self.role_ids.keys()))
+
+    def all_users(self):
+        return self.user_index.users()
+
+    def purge_server(self, server, limit=None):
+        removed = 0
+        for kind, remove in ((GuildIndex.CHARACTERS, self.remove_character), (GuildIndex.ALIASES, self.remove_alias)):
+            names = sorted(self.guild_index.names(kind, server))
+            for name in names[:None if limit is None else limit - removed]:
+                try:
+                    remove(server, name)
+                except KeyError:
+                    # in the index without a key of its own
+                    self.guild_index.discard(kind, server, name)
+                removed += 1
+            if limit is not None and removed >= limit:
+                return removed
+        if self.channel_settings.pop(str(server), None) is not None:
+            self.guild_index.bump(server)
+            removed += 1
+        if self.role_settings.pop(str(server), None) is not None:
+            removed += 1
+        # the roles went with the server
+        self.role_ids.pop(str(server), None)
+        return removed
+
+    def name_versions(self):
+        return self.guild_index.epoch(), self.guild_index.versions(self.channel_settings.keys())
+
+
+def _committed(method):
+    """Makes a SqliteStorage write method commit as soon as it returns when the database is shared, so the write lock
+    isn't held against the other processes until the next flush"""
+    @functools.wraps(method)
+    def wrapper(self, *args):
+        try:
+            return method(self, *args)
+        finally:
+            if self.shared and self.pending_writes:
+                self.flush()
+    return wrapper
+
+
+def _in_batches(values, size=500):
+    """Splits values into lists small enough for one IN (...) clause; SQLite allows 999 parameters per statement"""
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+# any change to a server's names or watched channels bumps its version, whichever process or tool made it. The
+# INSERT avoids a conflict clause of its own, since the one on the statement firing the trigger (e.g. INSERT OR REPLACE
+# in set_alias) would override it
+_VERSION_TRIGGER = """
+        CREATE TRIGGER IF NOT EXISTS {table}_{trigger}_version AFTER {event} ON {table} BEGIN
+            INSERT INTO guild_versions (guild, version) SELECT {row}.guild, 0
+                WHERE NOT EXISTS (SELECT 1 FROM guild_versions WHERE guild = {row}.guild);
+            UPDATE guild_versions SET version = version + 1 WHERE guild = {row}.guild;
+        END;
+"""
+
+
+class SqliteStorage(Storage):
+    """Storage engine backed by a SQLite database in WAL mode. Every notice is its own (server, character, user) row, so
+    signing up or stopping a notice is a single row insert or delete, and per-server and per-user listings are
+    answered by indexes instead of unpickling lists"""
+    # PRAGMA user_version of the current schema. 0: users stored as mention strings, 1: users stored as integer IDs
+    SCHEMA_VERSION = 1
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS characters (
+            guild TEXT NOT NULL,
+            character TEXT NOT NULL,
+            PRIMARY KEY (guild, character)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS notices (
+            guild TEXT NOT NULL,
+            character TEXT NOT NULL,
+            user INTEGER NOT NULL,
+            PRIMARY KEY (guild, character, user)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS notices_by_user ON notices (guild, user);
+        CREATE TABLE IF NOT EXISTS aliases (
+            guild TEXT NOT NULL,
+            alias TEXT NOT NULL,
+            character TEXT NOT NULL,
+            PRIMARY KEY (guild, alias)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS watched_channels (
+            guild TEXT NOT NULL,
+            channel INTEGER NOT NULL,
+            PRIMARY KEY (guild, channel)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS guild_versions (
+            guild TEXT NOT NULL PRIMARY KEY,
+            version INTEGER NOT NULL
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS settings (
+            name TEXT NOT NULL PRIMARY KEY,
+            value TEXT NOT NULL
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS role_guilds (
+            guild TEXT NOT NULL PRIMARY KEY
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS bot_roles (
+            guild TEXT NOT NULL,
+            role INTEGER NOT NULL,
+            PRIMARY KEY (guild, role)
+        ) WITHOUT ROWID;
+    """ + ''.join(_VERSION_TRIGGER.format(table=table, event=event, trigger=event.lower(),
+                                          row='OLD' if event == 'DELETE' else 'NEW')
+                  for table in ('characters', 'aliases', 'watched_channels')
+                  for event in ('INSERT', 'UPDATE', 'DELETE'))
+
+    # what a user ID row costs in bytes_read and bytes_written, the same as one packed into a SubscriberSet
+    USER_BYTES = SubscriberSet().ids.itemsize
+
+    def __init__(self, location, busy_timeout=5.0, shared=False):
+        self.location = location
+        self.pending_writes = 0
+        # the connection is opened here but used from the storage thread (see asyncstorage.py), one call at a time.
+        # Several bot processes can share one database (see cluster.py); busy_timeout is how many seconds a write waits
+        # for another process's transaction to commit before giving up. With shared set, every write method commits
+        # before returning instead of waiting for flush(), whatever made the call
+        self.shared = shared
+        self.connection = sqlite3.connect(location, timeout=busy_timeout, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        # WAL is safe against corruption with NORMAL; only the last transactions can be lost on power failure
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+        if version < 1 and self._table_exists("notices"):
+            self._convert_mentions()
+        self.connection.executescript(self.SCHEMA)
+        self.connection.execute("PRAGMA user_version = {0}".format(self.SCHEMA_VERSION))
+        self.connection.execute("INSERT OR IGNORE INTO settings (name, value) VALUES ('epoch', ?)", (uuid.uuid4().hex,))
+        self.connection.commit()
+
+    def _table_exists(self, table):
+        row = self.connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,))
+        return row.fetchone() is not None
+
+    def _convert_mentions(self):
+        """Moves notices stored as mention strings into the integer user ID schema"""
+        self.connection.execute("DROP INDEX IF EXISTS notices_by_user")
+        self.connection.execute("ALTER TABLE notices RENAME TO notices_mentions")
+        self.connection.executescript(self.SCHEMA)
+        rows = self.connection.execute("SELECT guild, character, user FROM notices_mentions").fetchall()
+        converted = []
+        for guild, character, user in rows:
+            user_id = parse_user(user)
+            if user_id is not None:
+                converted.append((guild, character, user_id))
+        self.connection.executemany("INSERT OR IGNORE INTO notices (guild, character, user) VALUES (?, ?, ?)", converted)
+        self.connection.execute("DROP TABLE notices_mentions")
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+    def sync(self):
+        self.flush()
+        self.connection.execute("PRAGMA wal_checkpoint(PASSIVE)")
+
+    def _write(self, sql, parameters=()):
+        # writes stay in the open transaction until flush() commits them all together, or until the method making them
+        # returns if the database is shared (see _committed)
+        self.pending_writes += 1
+        return self.connection.execute(sql, parameters)
+
+    def dirty_count(self):
+        return self.pending_writes
+
+    def flush(self, limit=None):
+        # a transaction can't be committed in part, so limit is ignored and everything pending goes in one commit
+        written = self.pending_writes
+        self.connection.commit()
+        self.pending_writes = 0
+        return written
+
+    def compact(self, drop_dangling=False):
+        report = maintenance.CompactionReport()
+        self.flush()
+        report.size_before = self._file_size()
+        report.problems = [row[0] for row in self.connection.execute("PRAGMA integrity_check") if row[0] != "ok"]
+        # aliases are resolved the way the bot does, which SQL comparing names can't do
+        characters = {}
+        for guild, character in self.connection.execute("SELECT guild, character FROM characters"):
+            characters.setdefault(guild, []).append(character)
+        aliases = {}
+        for guild, alias, character in self.connection.execute("SELECT guild, alias, character FROM aliases"):
+            aliases.setdefault(guild, {})[alias] = character
+        targets, report.dangling_aliases = maintenance.check_aliases(characters, aliases)
+        if drop_dangling and report.dangling_aliases:
+            self.connection.executemany("DELETE FROM aliases WHERE guild = ? AND alias = ?",
+                                        [(guild, alias) for guild, alias, _ in report.dangling_aliases])
+            report.dropped_aliases = len(report.dangling_aliases)
+        empty = self.connection.execute(
+            "SELECT guild, character FROM characters WHERE NOT EXISTS (SELECT 1 FROM notices "
+            "WHERE notices.guild = characters.guild AND notices.character = characters.character)").fetchall()
+        dropped = [(guild, character) for guild, character in empty if character not in targets.get(guild, ())]
+        self.connection.executemany("DELETE FROM characters WHERE guild = ? AND character = ?", dropped)
+        report.dropped_notices = len(dropped)
+        self.connection.commit()
+        # VACUUM rebuilds the database file without the free pages; the checkpoint then empties the WAL into it
+        self.connection.execute("VACUUM")
+        self.connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        report.size_after = self._file_size()
+        return report
+
+    def _file_size(self):
+        self.connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return sum(os.path.getsize(path) for path in (self.location, self.location + "-wal")
+                   if os.path.isfile(path))
+
+    def is_empty(self):
+        row = self.connection.execute("SELECT EXISTS (SELECT 1 FROM characters) OR EXISTS (SELECT 1 FROM aliases)")
+        return not row.fetchone()[0]
+
+    def has_character(self, server, character):
+        row = self.connection.execute("SELECT 1 FROM characters WHERE guild = ? AND character = ?",
+                                      (str(server), character)).fetchone()
+        return row is not None
+
+    @_committed
+    def add_character(self, server, character):
+        self._write("INSERT OR IGNORE INTO characters (guild, character) VALUES (?, ?)",
+                    (str(server), character))
+
+    def subscribers(self, server, character):
+        if not self.has_character(server, character):
+            raise KeyError(make_key(server, character))
+        rows = self.connection.execute("SELECT user FROM notices WHERE guild = ? AND character = ?",
+                                       (str(server), character))
+        subscribers = SubscriberSet(row[0] for row in rows)
+        self.bytes_read += len(subscribers) * self.USER_BYTES
+        return subscribers
+
+    @_committed
+    def add_subscriber(self, server, character, user):
+        created = self._write("INSERT OR IGNORE INTO characters (guild, character) VALUES (?, ?)",
+                              (str(server), character)).rowcount > 0
+        cursor = self._write("INSERT OR IGNORE INTO notices (guild, character, user) VALUES (?, ?, ?)",
+                             (str(server), character, user))
+        self.bytes_written += cursor.rowcount * self.USER_BYTES
+        return cursor.rowcount > 0, created
+
+    def subscribers_many(self, server, characters):
+        found = {}
+        for batch in _in_batches(set(characters)):
+            placeholders = ", ".join("?" * len(batch))
+            rows = self.connection.execute(
+                "SELECT character FROM characters WHERE guild = ? AND character IN ({0})".format(placeholders),
+                [str(server)] + batch)
+            for row in rows:
+                found[row[0]] = []
+            rows = self.connection.execute(
+                "SELECT character, user FROM notices WHERE guild = ? AND character IN ({0})".format(placeholders),
+                [str(server)] + batch)
+            for character, user in rows:
+                found[character].append(user)
+                self.bytes_read += self.USER_BYTES
+        return {character: SubscriberSet(users) for character, users in found.items()}
+
+    @_committed
+    def add_subscriber_many(self, server, characters, user):
+        characters = list(dict.fromkeys(characters))
+        already = set()
+        known = set()
+        for batch in _in_batches(characters):
+            placeholders = ", ".join("?" * len(batch))
+            rows = self.connection.execute(
+                "SELECT character FROM notices WHERE guild = ? AND user = ? AND character IN ({0})".format(
+                    placeholders), [str(server), user] + batch)
+            already.update(row[0] for row in rows)
+            rows = self.connection.execute(
+                "SELECT character FROM characters WHERE guild = ? AND character IN ({0})".format(placeholders),
+                [str(server)] + batch)
+            known.update(row[0] for row in rows)
+        added = [character for character in characters if character not in already]
+        self.pending_writes += 2 * len(added)
+        self.bytes_written += len(added) * self.USER_BYTES
+        self.connection.executemany("INSERT OR IGNORE INTO characters (guild, character) VALUES (?, ?)",
+                                    [(str(server), character) for character in added])
+        self.connection.executemany("INSERT OR IGNORE INTO notices (guild, character, user) VALUES (?, ?, ?)",
+                                    [(str(server), character, user) for character in added])
+        return ({character: character not in already for character in characters},
+                {character for character in added if character not in known})
+
+    @_committed
+    def add_subscribers(self, server, character, users):
+        self._write("INSERT OR IGNORE INTO characters (guild, character) VALUES (?, ?)",
+                    (str(server), character))
+        before = self.connection.total_changes
+        users = list(users)
+        self.pending_writes += len(users)
+        self.connection.executemany("INSERT OR IGNORE INTO notices (guild, character, user) VALUES (?, ?, ?)",
+                                    [(str(server), character, user) for user in users])
+        added = self.connection.total_changes - before
+        self.bytes_written += added * self.USER_BYTES
+        return added
+
+    @_committed
+    def remove_subscriber(self, server, character, user):
+        cursor = self._write("DELETE FROM notices WHERE guild = ? AND character = ? AND user = ?",
+                             (str(server), character, user))
+        if cursor.rowcount > 0:
+            return True
+        if not self.has_character(server, character):
+            raise KeyError(make_key(server, character))
+        return False
+
+    @_committed
+    def remove_user(self, server, user):
+        removed = self.user_characters(server, user)
+        self._write("DELETE FROM notices WHERE guild = ? AND user = ?", (str(server), user))
+        return removed
+
+    def user_characters(self, server, user):
+        rows = self.connection.execute("SELECT character FROM notices WHERE guild = ? AND user = ?", (str(server), user))
+        return {row[0] for row in rows}
+
+    def characters(self, server):
+        rows = self.connection.execute("SELECT character FROM characters WHERE guild = ?", (str(server),))
+        return {row[0] for row in rows}
+
+    @_committed
+    def remove_character(self, server, character):
+        cursor = self._write("DELETE FROM characters WHERE guild = ? AND character = ?",
+                             (str(server), character))
+        if cursor.rowcount == 0:
+            raise KeyError(make_key(server, character))
+        self._write("DELETE FROM notices WHERE guild = ? AND character = ?", (str(server), character))
+
+    @_committed
+    def rename_character(self, server, character, new_name):
+        cursor = self._write("DELETE FROM characters WHERE guild = ? AND character = ?",
+                             (str(server), character))
+        if cursor.rowcount == 0:
+            raise KeyError(make_key(server, character))
+        self._write("INSERT OR IGNORE INTO characters (guild, character) VALUES (?, ?)",
+                    (str(server), new_name))
+        # OR REPLACE so users already signed up for new_name don't make the rename fail
+        self._write("UPDATE OR REPLACE notices SET character = ? WHERE guild = ? AND character = ?",
+                    (new_name, str(server), character))
+
+    @_committed
+    def drop_server_notices(self, server):
+        self._write("DELETE FROM characters WHERE guild = ?", (str(server),))
+        self._write("DELETE FROM notices WHERE guild = ?", (str(server),))
+
+    @_committed
+    def clear_notices(self):
+        self._write("DELETE FROM characters")
+        self._write("DELETE FROM notices")
+
+    def all_notices(self):
+        # the character list is fetched up front so each subscriber query isn't run inside an open cursor
+        for server, character in self.connection.execute("SELECT guild, character FROM characters").fetchall():
+            yield server, character, self.subscribers(server, character)
+
+    def get_alias(self, server, alias):
+        row = self.connection.execute("SELECT character FROM aliases WHERE guild = ? AND alias = ?",
+                                      (str(server), alias)).fetchone()
+        if row is None:
+            raise KeyError(make_key(server, alias))
+        return row[0]
+
+    def get_aliases(self, server, aliases):
+        found = {}
+        for batch in _in_batches(set(aliases)):
+            rows = self.connection.execute(
+                "SELECT alias, character FROM aliases WHERE guild = ? AND alias IN ({0})".format(
+                    ", ".join("?" * len(batch))), [str(server)] + batch)
+            found.update(rows)
+        return found
+
+    @_committed
+    def set_alias(self, server, alias, character):
+        self._write("INSERT OR REPLACE INTO aliases (guild, alias, character) VALUES (?, ?, ?)",
+                    (str(server), alias, character))
+
+    @_committed
+    def remove_alias(self, server, alias):
+        cursor = self._write("DELETE FROM aliases WHERE guild = ? AND alias = ?", (str(server), alias))
+        if cursor.rowcount == 0:
+            raise KeyError(make_key(server, alias))
+
+    def aliases(self, server):
+        rows = self.connection.execute("SELECT alias, character FROM aliases WHERE guild = ?", (str(server),))
+        return {alias: character for alias, character in rows}
+
+    @_committed
+    def drop_server_aliases(self, server):
+        self._write("DELETE FROM aliases WHERE guild = ?", (str(server),))
+
+    @_committed
+    def clear_aliases(self):
+        self._write("DELETE FROM aliases")
+
+    def all_aliases(self):
+        yield from self.connection.execute("SELECT guild, alias, character FROM aliases").fetchall()
+
+    def watched_channels(self, server):
+        rows = self.connection.execute("SELECT channel FROM watched_channels WHERE guild = ?", (str(server),))
+        return {row[0] for row in rows}
+
+    @_committed
+    def watch_channel(self, server, channel):
+        cursor = self._write("INSERT OR IGNORE INTO watched_channels (guild, channel) VALUES (?, ?)",
+                             (str(server), channel))
+        return cursor.rowcount > 0
+
+    @_committed
+    def unwatch_channel(self, server, channel):
+        cursor = self._write("DELETE FROM watched_channels WHERE guild = ? AND channel = ?", (str(server), channel))
+        return cursor.rowcount > 0
+
+    def all_watched_channels(self):
+        yield from self.connection.execute("SELECT guild, channel FROM watched_channels").fetchall()
+
+    def role_servers(self):
+        return {row[0] for row in self.connection.execute("SELECT guild FROM role_guilds")}
+
+    @_committed
+    def set_role_mode(self, server, enabled):
+        if enabled:
+            cursor = self._write("INSERT OR IGNORE INTO role_guilds (guild) VALUES (?)", (str(server),))
+        else:
+            cursor = self._write("DELETE FROM role_guilds WHERE guild = ?", (str(server),))
+        return cursor.rowcount > 0
+
+    def bot_roles(self, server):
+        return {row[0] for row in self.connection.execute("SELECT role FROM bot_roles WHERE guild = ?", (str(server),))}
+
+    @_committed
+    def add_bot_role(self, server, role):
+        self._write("INSERT OR IGNORE INTO bot_roles (guild, role) VALUES (?, ?)", (str(server), role))
+
+    @_committed
+    def remove_bot_role(self, server, role):
+        self._write("DELETE FROM bot_roles WHERE guild = ? AND role = ?", (str(server), role))
+
+    def servers(self):
+        rows = self.connection.execute("SELECT guild FROM characters UNION SELECT guild FROM aliases UNION "
+                                       "SELECT guild FROM watched_channels UNION SELECT guild FROM role_guilds UNION "
+                                       "SELECT guild FROM bot_roles")
+        return {row[0] for row in rows}
+
+    def all_users(self):
+        yield from self.connection.execute("SELECT DISTINCT guild, user FROM notices").fetchall()
+
+    @_committed
+    def purge_server(self, server, limit=None):
+        server = str(server)
+        removed = 0
+        for table, column in (("characters", "character"), ("aliases", "alias")):
+            # LIMIT -1 is no limit at all
+            rows = self.connection.execute("SELECT {1} FROM {0} WHERE guild = ? LIMIT ?".format(table, column),
+                                           (server, -1 if limit is None else limit - removed))
+            names = [row[0] for row in rows]
+            for batch in _in_batches(names):
+                placeholders = ", ".join("?" * len(batch))
+                if table == "characters":
+                    self._write("DELETE FROM notices WHERE guild = ? AND character IN ({0})".format(placeholders),
+                                [server] + batch)
+                self._write("DELETE FROM {0} WHERE guild = ? AND {1} IN ({2})".format(table, column, placeholders),
+                            [server] + batch)
+            removed += len(names)
+            if limit is not None and removed >= limit:
+                return removed
+        # notices left behind by a character row that went missing are cleaned up without being counted
+        self._write("DELETE FROM notices WHERE guild = ?", (server,))
+        for table in ("watched_channels", "role_guilds"):
+            removed += self._write("DELETE FROM {0} WHERE guild = ?".format(table), (server,)).rowcount
+        # the roles went with the server
+        self._write("DELETE FROM bot_roles WHERE guild = ?", (server,))
+        return removed
+
+    def name_versions(self):
+        epoch = self.connection.execute("SELECT value FROM settings WHERE name = 'epoch'").fetchone()[0]
+        rows = self.connection.execute(
+            "SELECT servers.guild, coalesce(guild_versions.version, 0) FROM (SELECT guild FROM characters UNION "
+            "SELECT guild FROM aliases UNION SELECT guild FROM watched_channels) AS servers "
+            "LEFT JOIN guild_versions ON guild_versions.guild = servers.guild")
+        return epoch, dict(rows.fetchall())
+
+
+def migrate(source, destination):
+    """Copies every notice and alias in the source storage into the destination storage, e.g. from a pair of existing
+    .db shelves into a new SQLite database. Returns a (notices, aliases) tuple of how many entries were copied"""
+    notice_count = 0
+    alias_count = 0
+    for server, character, users in source.all_notices():
+        destination.add_character(server, character)
+        for user in users:
+            destination.add_subscriber(server, character, user)
+            notice_count += 1
+    for server, alias, character in source.all_aliases():
+        destination.set_alias(server, alias, character)
+        alias_count += 1
+    for server, channel in source.all_watched_channels():
+        destination.watch_channel(server, channel)
+    for server in source.role_servers():
+        destination.set_role_mode(server, True)
+    for server in source.servers():
+        for role in source.bot_roles(server):
+            destination.add_bot_role(server, role)
+    destination.sync()
+    return notice_count, alias_count
@@ -0,0 +1,86 @@
+"""
+Compact subscriber sets for WaifuHoarder notices
+
+(C) 2019-2020 by Jordan Aurora Kinsley
+
+Licensed under MIT License, see LICENSE
+"""
+
+import re
+from array import array
+from bisect import bisect_left
+
+# user mentions were stored as <@123456789012345678> or, for users with a nickname, <@!123456789012345678>
+MENTION_PATTERN = re.compile(r'<@!?(\d+)>')
+
+
+def parse_user(user):
+    """Turns a stored user (a user ID, or a mention string from before IDs were stored) into an integer user ID.
+    Returns None for anything that isn't a user, like the None placeholders very old shelves can hold"""
+    if isinstance(user, int):
+        return user
+    if isinstance(user, str):
+        match = MENTION_PATTERN.fullmatch(user.strip())
+        if match:
+            return int(match.group(1))
+        if user.isdigit():
+            return int(user)
+    return None
+
+
+class SubscriberSet:
+    """The users signed up for one character, kept as a sorted array of 64 bit Discord user IDs. Membership checks are a
+    binary search, and the whole set packs into 8 bytes per user for storage"""
+    __slots__ = ('ids',)
+
+    def __init__(self, ids=()):
+        self.ids = array('Q', sorted(set(ids)))
+
+    @classmethod
+    def from_bytes(cls, packed):
+        subscribers = cls()
+        subscribers.ids.frombytes(packed)
+        return subscribers
+
+    @classmethod
+    def load(cls, value):
+        """Builds a set from a stored value: packed bytes, or a legacy list of mention strings"""
+        if isinstance(value, (bytes, bytearray)):
+            return cls.from_bytes(value)
+        users = (parse_user(user) for user in value)
+        return cls(user for user in users if user is not None)
+
+    def to_bytes(self):
+        return self.ids.tobytes()
+
+    def __contains__(self, user_id):
+        index = bisect_left(self.ids, user_id)
+        return index < len(self.ids) and self.ids[index] == user_id
+
+    def add(self, user_id):
+        """Returns False if user_id was already in the set"""
+        index = bisect_left(self.ids, user_id)
+        if index < len(self.ids) and self.ids[index] == user_id:
+            return False
+        self.ids.insert(index, user_id)
+        return True
+
+    def remove(self, user_id):
+        """Returns False if user_id wasn't in the set"""
+        index = bisect_left(self.ids, user_id)
+        if index < len(self.ids) and self.ids[index] == user_id:
+            del self.ids[index]
+            return True
+        return False
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __bool__(self):
+        return len(self.ids) > 0
+
+    def __repr__(self):
+        return "SubscriberSet({0})".format(list(self.ids))
@@ -0,0 +1,28 @@
+import os
+import sys
+import pytest
+
+# the bot's modules sit at the top of the repository rather than in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import eventlog  # noqa: E402
+import storage  # noqa: E402
+
+ENGINES = ("shelve", "sqlite", "eventlog")
+
+
+def open_engine(kind, directory):
+    directory = str(directory)
+    if kind == "sqlite":
+        return storage.SqliteStorage(os.path.join(directory, "waifu.sqlite3"))
+    if kind == "eventlog":
+        return eventlog.EventLogStorage(os.path.join(directory, "waifu.events"))
+    return storage.ShelveStorage(os.path.join(directory, "userlist.db"), os.path.join(directory, "aliases.db"))
+
+
+@pytest.fixture(params=ENGINES)
+def engine(request, tmp_path):
+    """A fresh storage engine of every kind in turn, closed after the test"""
+    store = open_engine(request.param, tmp_path)
+    yield store
+    store.close()
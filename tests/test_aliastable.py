@@ -0,0 +1,54 @@
+from aliastable import AliasTable, normalize, strip_server
+
+
+def test_chains_resolve_to_the_character():
+    table = AliasTable.build(["Twilight Sparkle"], {"Twi": "Twilight", "Twilight": "twilight  SPARKLE"})
+    assert table.resolve("twi") == "Twilight Sparkle"
+    assert table.resolve("TWILIGHT") == "Twilight Sparkle"
+    assert table.resolve("Twilight Sparkle") == "Twilight Sparkle"
+    assert table.resolve("Rarity") is None
+
+
+def test_alias_beats_a_character_of_the_same_name():
+    table = AliasTable.build(["Rarity", "Rares"], {"Rares": "Rarity"})
+    assert table.resolve("Rares") == "Rarity"
+
+
+def test_dangling_chain_resolves_to_where_it_ends():
+    table = AliasTable.build([], {"A": "B", "B": "Nobody"})
+    assert table.resolve("A") == "Nobody"
+    assert table.character("Nobody") is None
+
+
+def test_cycles_resolve_to_nothing():
+    table = AliasTable.build(["Rarity"], {"A": "B", "B": "a", "C": "A", "D": "Rarity"})
+    assert table.cycles == {"a", "b", "c"}
+    assert table.resolve("A") is None and table.resolve("C") is None
+    assert table.resolve("D") == "Rarity"
+
+
+def test_breaking_a_cycle_resolves_the_chain_again():
+    table = AliasTable.build(["Rarity"], {"A": "B", "B": "A", "C": "A"})
+    table.set_alias("B", "Rarity")
+    assert not table.cycles
+    assert table.resolve("A") == table.resolve("C") == "Rarity"
+    table.set_alias("B", "C")
+    assert table.cycles == {"a", "b", "c"}
+
+
+def test_changes_follow_the_chain():
+    table = AliasTable.build(["Rarity"], {"Rares": "Rarity", "Rari": "Rares"})
+    table.remove_character("Rarity")
+    assert table.resolve("Rari") == "Rarity" and table.character("Rarity") is None
+    table.add_character("Rarity")
+    table.set_alias("Rares", "Applejack")
+    assert table.resolve("Rari") == "Applejack"
+    table.remove_alias("Rares")
+    assert table.resolve("Rari") == "Rares"
+    assert table.referring_aliases("rares") == ["Rari"]
+
+
+def test_helpers():
+    assert normalize("  Sunset\tSHIMMER ") == "sunset shimmer"
+    assert strip_server("123\\Rarity", 123) == "Rarity"
+    assert strip_server("456\\Rarity", 123) == "456\\Rarity"
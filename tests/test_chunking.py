@@ -0,0 +1,47 @@
+from bothelper import chunk_messages, discord_split, mention
+
+
+def test_items_fill_a_message_exactly():
+    # "aaaa, bbbb" is 10 characters
+    assert list(chunk_messages(["aaaa", "bbbb", "cccc"], limit=10)) == ["aaaa, bbbb", "cccc"]
+
+
+def test_separator_that_would_overflow_starts_a_new_message():
+    assert list(chunk_messages(["aaaa", "bbbbb"], limit=10)) == ["aaaa", "bbbbb"]
+
+
+def test_header_and_footer_count_towards_the_limit():
+    messages = list(chunk_messages(["aa", "bb"], header="Hi ", footer="!", limit=8))
+    assert messages == ["Hi aa", "bb!"]
+    assert all(len(message) <= 8 for message in messages)
+
+
+def test_footer_that_doesnt_fit_goes_on_its_own():
+    assert list(chunk_messages(["aaaa"], header="> ", footer=" <3", limit=6)) == ["> aaaa", " <3"]
+
+
+def test_only_an_oversized_item_is_cut():
+    assert list(chunk_messages(["ab", "x" * 25, "cd"], limit=10)) == ["ab", "x" * 10, "x" * 10, "xxxxx, cd"]
+
+
+def test_nothing_to_send():
+    assert list(chunk_messages([])) == []
+    assert list(chunk_messages([], header="Nobody: ")) == ["Nobody: "]
+
+
+def test_no_item_is_lost_or_split():
+    items = [mention(200000000000000000 + user) for user in range(500)]
+    messages = list(chunk_messages(items, ' ', header='Hey, ', footer=", it's Rarity"))
+    assert all(len(message) <= 2000 for message in messages)
+    joined = ' '.join(messages)
+    assert joined.startswith('Hey, ') and joined.endswith(", it's Rarity")
+    assert joined[len('Hey, '):-len(", it's Rarity")].split(' ') == items
+
+
+def test_discord_split_cuts_after_a_mention():
+    message = 'Hey,' + ''.join(' ' + mention(200000000000000000 + user) for user in range(200))
+    pieces = discord_split(message)
+    assert len(pieces) > 1
+    assert all(len(piece) <= 2000 for piece in pieces)
+    assert all(piece.endswith(">...") for piece in pieces[:-1])
+    assert ''.join(piece[:-3] for piece in pieces[:-1]) + pieces[-1] == message
@@ -0,0 +1,102 @@
+import shelve
+
+import pytest
+
+import maintenance
+from conftest import ENGINES, open_engine
+from indexes import make_key
+from storage import ShelveStorage
+
+
+def test_compact_keeps_aliases_that_resolve(engine):
+    engine.add_subscriber("1", "Twilight Sparkle", 10)
+    # a target capitalized differently from the character, and an alias of that alias
+    engine.set_alias("1", "Twi", "twilight  sparkle")
+    engine.set_alias("1", "Ts", "Twi")
+    engine.set_alias("1", "Gone", "Nobody")
+    engine.flush()
+
+    report = engine.compact(True)
+
+    assert report.dangling_aliases == [("1", "Gone", "Nobody")]
+    assert report.dropped_aliases == 1
+    assert engine.aliases("1") == {"Twi": "twilight  sparkle", "Ts": "Twi"}
+
+
+def test_compact_drops_looping_aliases(engine):
+    engine.add_subscriber("1", "Rarity", 10)
+    engine.set_alias("1", "A", "B")
+    engine.set_alias("1", "B", "A")
+    engine.set_alias("1", "C", "A")
+    engine.flush()
+
+    report = engine.compact(True)
+
+    assert sorted(alias for _, alias, _ in report.dangling_aliases) == ["A", "B", "C"]
+    assert engine.aliases("1") == {}
+
+
+def test_compact_keeps_empty_characters_an_alias_leads_to(engine):
+    engine.add_character("1", "Applejack")
+    engine.add_character("1", "Fluttershy")
+    engine.add_character("1", "Spike")
+    engine.set_alias("1", "Aj", "APPLEJACK")
+    engine.set_alias("1", "Shy", "Flutters")
+    engine.set_alias("1", "Flutters", "fluttershy")
+    engine.flush()
+
+    report = engine.compact()
+
+    assert report.dropped_notices == 1
+    assert engine.has_character("1", "Applejack")
+    assert engine.has_character("1", "Fluttershy")
+    assert not engine.has_character("1", "Spike")
+
+
+@pytest.mark.parametrize("kind", ENGINES)
+def test_compact_keeps_what_is_live(kind, tmp_path):
+    store = open_engine(kind, tmp_path)
+    store.add_subscribers("1", "Rarity", [10, 20])
+    store.add_subscriber("1", "Applejack", 10)
+    store.remove_subscriber("1", "Applejack", 10)
+    store.set_alias("1", "Rares", "Rarity")
+    store.set_alias("1", "Gone", "Nobody")
+    store.watch_channel("1", 100)
+    store.flush()
+
+    report = store.compact()
+
+    assert report.dropped_notices == 1 and report.dropped_aliases == 0
+    assert report.dangling_aliases == [("1", "Gone", "Nobody")]
+    assert not report.problems and not report.unreadable
+    assert "1 aliases point at characters that don't exist" in str(report)
+    store.close()
+
+    store = open_engine(kind, tmp_path)
+    try:
+        assert store.characters("1") == {"Rarity"}
+        assert list(store.subscribers("1", "Rarity")) == [10, 20]
+        assert store.user_characters("1", 10) == {"Rarity"}
+        assert store.aliases("1") == {"Rares": "Rarity", "Gone": "Nobody"}
+        assert store.watched_channels("1") == {100}
+    finally:
+        store.close()
+
+
+def test_compact_packs_legacy_mention_lists(tmp_path):
+    user_list = str(tmp_path / "userlist.db")
+    aliases = str(tmp_path / "aliases.db")
+    with shelve.open(user_list) as notices:
+        notices[make_key("1", "Rarity")] = ["<@20>", "<@!10>"]
+        notices[make_key("1", "Nobody")] = []
+    shelve.open(aliases).close()
+
+    report = maintenance.compact_shelves(user_list, aliases)
+
+    assert (report.converted_notices, report.dropped_notices) == (1, 1)
+    store = ShelveStorage(user_list, aliases)
+    try:
+        assert list(store.subscribers("1", "Rarity")) == [10, 20]
+        assert store.user_characters("1", 20) == {"Rarity"}
+    finally:
+        store.close()
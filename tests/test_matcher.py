@@ -0,0 +1,26 @@
+from matcher import CharacterMatcher
+
+
+def test_update_links_once_per_batch(monkeypatch):
+    matcher = CharacterMatcher.build(["Rarity"], {})
+    links = []
+    original = matcher._link
+    monkeypatch.setattr(matcher, "_link", lambda: links.append(1) or original())
+
+    matcher.update(added=[(CharacterMatcher.CHARACTER, "Twilight Sparkle", "Twilight Sparkle"),
+                          (CharacterMatcher.CHARACTER, "Twilight", "Twilight"),
+                          (CharacterMatcher.ALIAS, "Twi", "Twilight Sparkle")],
+                   removed=[(CharacterMatcher.CHARACTER, "Rarity")])
+
+    assert len(links) == 1
+    assert matcher.find("twilight sparkle and twi, not rarity or twilights") == ["Twilight Sparkle"]
+    assert matcher.find("Twilight!") == ["Twilight"]
+
+
+def test_update_that_adds_nothing_new_keeps_the_links():
+    matcher = CharacterMatcher.build(["Rarity"], {"Rares": "Rarity"})
+    matcher.update(removed=[(CharacterMatcher.ALIAS, "Rares")])
+    matcher.update(added=[(CharacterMatcher.ALIAS, "Rares", "Rarity")])
+
+    assert not matcher.stale
+    assert matcher.find("rares") == ["Rarity"]
@@ -0,0 +1,143 @@
+import asyncio
+import time
+
+import pytest
+
+pytest.importorskip("discord")
+
+from roles import ROLE_PREFIX, RoleQueue, role_name  # noqa: E402
+
+
+class FakeRoleAPI:
+    """Stands in for DiscordRoleAPI, recording a (time, call, arguments) tuple for every call"""
+
+    def __init__(self, roles=None):
+        self.roles_by_id = dict(roles or {})
+        self.holders = {}
+        self.calls = []
+        self.next_id = 1000
+
+    async def roles(self, guild):
+        return dict(self.roles_by_id)
+
+    async def role_members(self, guild, role):
+        return set(self.holders.get(role, ()))
+
+    async def create_role(self, guild, name):
+        self.next_id += 1
+        self.roles_by_id[self.next_id] = name
+        self.calls.append((time.monotonic(), "create_role", name))
+        return self.next_id
+
+    async def delete_role(self, guild, role):
+        self.calls.append((time.monotonic(), "delete_role", role))
+        return self.roles_by_id.pop(role, None) is not None
+
+    async def edit_member(self, guild, member, give, take):
+        self.calls.append((time.monotonic(), "edit_member", (member, set(give), set(take))))
+        for role in give:
+            self.holders.setdefault(role, set()).add(member)
+        for role in take:
+            self.holders.get(role, set()).discard(member)
+        return True
+
+
+class FakeStorage:
+    def __init__(self, owned=()):
+        self.owned = set(owned)
+
+    async def bot_roles(self, guild):
+        return set(self.owned)
+
+    async def add_bot_role(self, guild, role):
+        self.owned.add(role)
+
+    async def remove_bot_role(self, guild, role):
+        self.owned.discard(role)
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+async def drained(queue):
+    while any(state.worker is not None and not state.worker.done() for state in queue.guilds.values()):
+        await asyncio.gather(*(state.worker for state in queue.guilds.values() if state.worker is not None))
+
+
+def test_calls_stay_inside_the_budget():
+    async def burst():
+        api = FakeRoleAPI()
+        queue = RoleQueue(api, FakeStorage(), budget=2, window=0.2)
+        for member in (1, 2, 3):
+            queue.give(10, member, ["Rarity"])
+        await drained(queue)
+        queue.close()
+        return api.calls
+
+    calls = run(burst())
+    assert [call for _, call, _ in calls] == ["create_role", "edit_member", "edit_member", "edit_member"]
+    times = [at - calls[0][0] for at, _, _ in calls]
+    assert times[1] < 0.05
+    for earlier, later in zip(times[1:], times[2:]):
+        assert later - earlier >= 0.09
+
+
+def test_a_member_edit_costs_one_call_per_role():
+    async def several():
+        api = FakeRoleAPI({1: role_name("Rarity"), 2: role_name("Applejack"), 3: role_name("Fluttershy")})
+        queue = RoleQueue(api, FakeStorage({1, 2, 3}), budget=3, window=0.3)
+        queue.give(10, 5, ["Rarity", "Applejack", "Fluttershy"])
+        queue.give(10, 6, ["Rarity"])
+        start = time.monotonic()
+        await drained(queue)
+        queue.close()
+        return start, api.calls
+
+    start, calls = run(several())
+    assert calls[0][2] == (5, {1, 2, 3}, set())
+    # the first edit spends the whole budget, so the second waits for a token to come back
+    assert calls[0][0] - start < 0.05
+    assert calls[1][0] - start >= 0.09
+
+
+def test_changes_are_merged_per_member():
+    async def changes():
+        api = FakeRoleAPI({1: role_name("Rarity"), 2: role_name("Applejack")})
+        queue = RoleQueue(api, FakeStorage({1, 2}))
+        api.holders[2] = {5}
+        queue.give(10, 5, ["Rarity"])
+        queue.take(10, 5, ["Applejack"])
+        queue.give(10, 6, ["Rarity"])
+        queue.take(10, 6, ["Rarity"])
+        await drained(queue)
+        queue.close()
+        return queue, api.calls
+
+    queue, calls = run(changes())
+    # one edit per member, and the last change to a character wins: member 6 may have held the role already
+    assert [arguments for _, _, arguments in calls] == [(5, {1}, {2}), (6, set(), {1})]
+    assert queue.edits == 2 and queue.merged == 2
+
+
+def test_only_the_bots_own_roles_are_touched():
+    async def reconcile():
+        # role 2 is the server's own, named like one of ours
+        api = FakeRoleAPI({1: role_name("Rarity"), 2: ROLE_PREFIX + "Applejack", 3: role_name("Twilight")})
+        api.holders[1] = {5, 7}
+        storage = FakeStorage({1, 3})
+        queue = RoleQueue(api, storage)
+        result = await queue.reconcile(10, {"Rarity": {5, 6}, "Applejack": set()})
+        await drained(queue)
+        queue.close()
+        return result, api, storage
+
+    result, api, storage = run(reconcile())
+    assert result == (1, 1, 1)
+    assert sorted(api.roles_by_id) == [1, 2]
+    assert storage.owned == {1}
+    assert api.holders[1] == {5, 6}
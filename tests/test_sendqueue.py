@@ -0,0 +1,103 @@
+import asyncio
+
+from sendqueue import FakeTransport, SendQueue
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def test_token_bucket_spaces_out_a_burst():
+    async def burst():
+        transport = FakeTransport()
+        queue = SendQueue(transport, budget=2, window=0.2)
+        # different options, so none of them get merged
+        for number in range(6):
+            queue.send(1, str(number), delete_after=number)
+        await queue.join()
+        return transport.sent
+
+    sent = run(burst())
+    assert [content for _, _, content, _ in sent] == [str(number) for number in range(6)]
+    times = [at - sent[0][0] for at, _, _, _ in sent]
+    # the full budget goes out at once, then one message every window / budget seconds
+    assert times[1] < 0.05
+    for earlier, later in zip(times[1:], times[2:]):
+        assert later - earlier >= 0.09
+
+
+def test_channels_have_budgets_of_their_own():
+    async def two_channels():
+        transport = FakeTransport()
+        queue = SendQueue(transport, budget=1, window=10.0)
+        queue.send(1, "one")
+        queue.send(2, "two")
+        await asyncio.wait_for(queue.join(), 1.0)
+        return transport.sent
+
+    assert sorted(content for _, _, content, _ in run(two_channels())) == ["one", "two"]
+
+
+def test_waiting_messages_are_merged():
+    async def merged():
+        transport = FakeTransport()
+        queue = SendQueue(transport, budget=1, window=0.1, limit=12)
+        for content in ("a", "b", "c", "dddddddd", "e"):
+            queue.send(1, content)
+        await queue.join()
+        return queue, [content for _, _, content, _ in transport.sent]
+
+    queue, sent = run(merged())
+    # the worker only starts once all of them are queued, and packs them up to the limit
+    assert sent == ["a\nb\nc", "dddddddd\ne"]
+    assert queue.merged == 3 and queue.sent == 2
+
+
+def test_notices_for_the_same_key_are_coalesced():
+    rendered = []
+
+    def render(users, key):
+        rendered.append((key, users))
+        return ["{0}: {1}".format(key, ' '.join(str(user) for user in users))]
+
+    async def notices():
+        transport = FakeTransport()
+        queue = SendQueue(transport, budget=1, window=0.1, debounce=60.0)
+        queue.send(1, "busy")
+        queue.notice(1, "Rarity", [3, 1], render)
+        queue.notice(1, "Rarity", [2, 1], render)
+        queue.notice(1, "Applejack", [1], render)
+        await queue.join()
+        # within the debounce, only users not pinged yet get a repeat
+        queue.notice(1, "Rarity", [1, 2], render)
+        queue.notice(1, "Rarity", [1, 4], render)
+        await queue.join()
+        return queue, [content for _, _, content, _ in transport.sent]
+
+    queue, sent = run(notices())
+    assert sent == ["busy", "Rarity: 1 2 3", "Applejack: 1", "Rarity: 4"]
+    assert queue.coalesced == 2
+    assert rendered == [("Rarity", [1, 2, 3]), ("Applejack", [1]), ("Rarity", [4])]
+
+
+def test_a_failed_send_doesnt_stop_the_channel():
+    async def failing():
+        sent = []
+
+        async def transport(channel, content, **kwargs):
+            if content == "bad":
+                raise RuntimeError("missing permissions")
+            sent.append(content)
+
+        queue = SendQueue(transport, budget=10, window=1.0)
+        queue.send(1, "bad", delete_after=1)
+        queue.send(1, "good")
+        await queue.join()
+        return queue, sent
+
+    queue, sent = run(failing())
+    assert sent == ["good"] and queue.failed == 1 and queue.depth() == 0
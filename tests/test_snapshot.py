@@ -0,0 +1,61 @@
+import pytest
+
+import snapshot
+
+
+SAVED = {"epoch": "e1", "servers": {"1": (3, ["Rarity"], {"Rares": "Rarity"}, [10]), "2": (1, [], {}, [])}}
+
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / "names.snapshot")
+    snapshot.write(path, SAVED)
+    assert snapshot.read(path) == SAVED
+
+
+def test_corrupt_payload_is_rejected(tmp_path):
+    path = str(tmp_path / "names.snapshot")
+    snapshot.write(path, SAVED)
+    with open(path, 'r+b') as snapshot_file:
+        snapshot_file.seek(-1, 2)
+        last = snapshot_file.read(1)
+        snapshot_file.seek(-1, 2)
+        snapshot_file.write(bytes([last[0] ^ 0xFF]))
+    with pytest.raises(ValueError, match="corrupt"):
+        snapshot.read(path)
+
+
+def test_truncated_file_is_rejected(tmp_path):
+    path = str(tmp_path / "names.snapshot")
+    snapshot.write(path, SAVED)
+    with open(path, 'r+b') as snapshot_file:
+        snapshot_file.truncate(snapshot.HEADER.size + 5)
+    with pytest.raises(ValueError, match="truncated"):
+        snapshot.read(path)
+
+
+def test_other_magic_is_rejected(tmp_path):
+    path = str(tmp_path / "names.snapshot")
+    snapshot.write(path, SAVED, magic=b'WAIFUEVT')
+    with pytest.raises(ValueError):
+        snapshot.read(path)
+
+
+def test_split_keeps_only_unchanged_servers():
+    fresh, stale = snapshot.split(SAVED, "e1", {"1": 3, "2": 2, "3": 1})
+    assert fresh == {"1": (["Rarity"], {"Rares": "Rarity"}, [10])}
+    assert sorted(stale) == ["2", "3"]
+
+
+def test_split_after_a_rebuild_trusts_nothing():
+    assert snapshot.split(SAVED, "e2", {"1": 3}) == ({}, ["1"])
+    assert snapshot.split(None, "e1", {"1": 3}) == ({}, ["1"])
+
+
+def test_save_captures_the_engine(engine, tmp_path):
+    engine.add_character("1", "Rarity")
+    engine.set_alias("1", "Rares", "Rarity")
+    path = str(tmp_path / "names.snapshot")
+    (epoch, versions), _ = snapshot.save(engine, path)
+    fresh, stale = snapshot.split(snapshot.read(path), *engine.name_versions())
+    assert stale == [] and versions == engine.name_versions()[1]
+    assert fresh["1"][0] == ["Rarity"]
@@ -0,0 +1,172 @@
+import pytest
+
+from conftest import ENGINES, open_engine
+
+
+def test_rename_character_merges_into_an_existing_one(engine):
+    engine.add_subscriber("1", "Twi", 10)
+    engine.add_subscriber("1", "Twi", 20)
+    engine.add_subscriber("1", "Twilight Sparkle", 20)
+    engine.add_subscriber("1", "Twilight Sparkle", 30)
+
+    engine.rename_character("1", "Twi", "Twilight Sparkle")
+
+    assert list(engine.subscribers("1", "Twilight Sparkle")) == [10, 20, 30]
+    assert not engine.has_character("1", "Twi")
+    assert sorted(engine.characters("1")) == ["Twilight Sparkle"]
+    assert engine.user_characters("1", 10) == {"Twilight Sparkle"}
+
+
+def test_rename_unknown_character_raises(engine):
+    with pytest.raises(KeyError):
+        engine.rename_character("1", "Nobody", "Somebody")
+
+
+# the contract every engine keeps, whatever it stores things in
+
+def test_notices(engine):
+    assert engine.add_subscriber("1", "Rarity", 20) == (True, True)
+    assert engine.add_subscriber("1", "Rarity", 10) == (True, False)
+    assert engine.add_subscriber("1", "Rarity", 10) == (False, False)
+    assert list(engine.subscribers("1", "Rarity")) == [10, 20]
+    assert engine.has_character("1", "Rarity") and not engine.has_character("2", "Rarity")
+    with pytest.raises(KeyError):
+        engine.subscribers("1", "Nobody")
+
+    assert engine.remove_subscriber("1", "Rarity", 10)
+    assert not engine.remove_subscriber("1", "Rarity", 10)
+    with pytest.raises(KeyError):
+        engine.remove_subscriber("1", "Nobody", 10)
+
+    engine.add_character("1", "Applejack")
+    assert engine.characters("1") == {"Rarity", "Applejack"}
+    assert list(engine.subscribers("1", "Applejack")) == []
+    engine.remove_character("1", "Applejack")
+    with pytest.raises(KeyError):
+        engine.remove_character("1", "Applejack")
+    assert engine.characters("1") == {"Rarity"}
+
+
+def test_batches(engine):
+    added, created = engine.add_subscriber_many("1", ["Rarity", "Applejack"], 10)
+    assert created == {"Rarity", "Applejack"}
+    assert engine.add_subscribers("1", "Rarity", [10, 20, 30]) == 2
+    found = engine.subscribers_many("1", ["Rarity", "Applejack", "Nobody"])
+    assert {character: list(users) for character, users in found.items()} == {"Rarity": [10, 20, 30],
+                                                                              "Applejack": [10]}
+    assert engine.user_characters("1", 10) == {"Rarity", "Applejack"}
+    assert engine.user_characters("2", 10) == set()
+
+    assert set(engine.remove_user("1", 10)) == {"Rarity", "Applejack"}
+    assert engine.user_characters("1", 10) == set()
+    assert list(engine.subscribers("1", "Rarity")) == [20, 30]
+
+
+def test_servers_are_kept_apart(engine):
+    engine.add_subscriber("1", "Rarity", 10)
+    engine.add_subscriber("2", "Rarity", 20)
+    engine.set_alias("1", "Rares", "Rarity")
+    engine.set_alias("2", "Rari", "Rarity")
+
+    engine.drop_server_notices("1")
+    engine.drop_server_aliases("2")
+
+    assert engine.characters("1") == set() and engine.characters("2") == {"Rarity"}
+    assert engine.aliases("1") == {"Rares": "Rarity"} and engine.aliases("2") == {}
+    assert [(server, character, list(users)) for server, character, users in engine.all_notices()] == [
+        ("2", "Rarity", [20])]
+
+
+def test_aliases(engine):
+    engine.set_alias("1", "Rares", "Rarity")
+    engine.set_alias("1", "Twi", "Twilight Sparkle")
+    engine.set_alias("1", "Twi", "Twilight")
+    assert engine.get_alias("1", "Twi") == "Twilight"
+    assert engine.get_aliases("1", ["Twi", "Nope"]) == {"Twi": "Twilight"}
+    assert engine.aliases("1") == {"Rares": "Rarity", "Twi": "Twilight"}
+    assert sorted(engine.all_aliases()) == [("1", "Rares", "Rarity"), ("1", "Twi", "Twilight")]
+
+    engine.remove_alias("1", "Rares")
+    with pytest.raises(KeyError):
+        engine.remove_alias("1", "Rares")
+    with pytest.raises(KeyError):
+        engine.get_alias("1", "Rares")
+    engine.clear_aliases()
+    assert engine.aliases("1") == {}
+
+
+def test_settings(engine):
+    assert engine.watch_channel("1", 100)
+    assert not engine.watch_channel("1", 100)
+    assert engine.watched_channels("1") == {100}
+    assert sorted(engine.all_watched_channels()) == [("1", 100)]
+    assert engine.unwatch_channel("1", 100)
+    assert not engine.unwatch_channel("1", 100)
+
+    assert engine.set_role_mode("1", True)
+    assert not engine.set_role_mode("1", True)
+    assert engine.role_servers() == {"1"}
+    engine.add_bot_role("1", 500)
+    engine.add_bot_role("1", 501)
+    engine.remove_bot_role("1", 500)
+    assert engine.bot_roles("1") == {501}
+    assert engine.set_role_mode("1", False)
+    assert engine.role_servers() == set()
+
+
+def test_purge_server(engine):
+    for number in range(5):
+        engine.add_subscriber("1", "Character {0}".format(number), 10 + number)
+    engine.set_alias("1", "C", "Character 0")
+    engine.watch_channel("1", 100)
+    engine.add_subscriber("2", "Rarity", 10)
+    assert {"1", "2"} <= set(engine.servers())
+    assert ("1", 12) in set(engine.all_users())
+
+    removed = 0
+    while True:
+        step = engine.purge_server("1", 2)
+        removed += step
+        if step < 2:
+            break
+
+    assert engine.characters("1") == set() and engine.aliases("1") == {} and engine.watched_channels("1") == set()
+    assert "1" not in set(engine.servers())
+    assert engine.characters("2") == {"Rarity"}
+
+
+def test_name_versions_move_with_the_names(engine):
+    engine.add_character("1", "Rarity")
+    engine.add_character("2", "Applejack")
+    epoch, before = engine.name_versions()
+
+    engine.set_alias("1", "Rares", "Rarity")
+    engine.add_subscriber("2", "Applejack", 10)
+
+    after_epoch, after = engine.name_versions()
+    assert after_epoch == epoch
+    assert after["1"] != before["1"]
+    # signing up isn't a change of names
+    assert after["2"] == before["2"]
+
+    engine.clear_notices()
+    assert engine.characters("2") == set()
+
+
+@pytest.mark.parametrize("kind", ENGINES)
+def test_everything_survives_a_reopen(kind, tmp_path):
+    store = open_engine(kind, tmp_path)
+    store.add_subscriber("1", "Rarity", 10)
+    store.set_alias("1", "Rares", "Rarity")
+    store.watch_channel("1", 100)
+    store.set_role_mode("1", True)
+    store.close()
+
+    store = open_engine(kind, tmp_path)
+    try:
+        assert list(store.subscribers("1", "Rarity")) == [10]
+        assert store.aliases("1") == {"Rares": "Rarity"}
+        assert store.watched_channels("1") == {100}
+        assert store.role_servers() == {"1"}
+    finally:
+        store.close()
@@ -0,0 +1,39 @@
+from subscribers import SubscriberSet, parse_user
+
+
+def test_ids_stay_sorted_and_unique():
+    subscribers = SubscriberSet([30, 10, 20, 10])
+    assert list(subscribers) == [10, 20, 30]
+    assert subscribers.add(15)
+    assert not subscribers.add(20)
+    assert list(subscribers) == [10, 15, 20, 30]
+    assert subscribers.remove(10)
+    assert not subscribers.remove(10)
+    assert list(subscribers) == [15, 20, 30]
+    assert 20 in subscribers and 10 not in subscribers and 99 not in subscribers
+
+
+def test_packs_into_eight_bytes_per_user():
+    subscribers = SubscriberSet([2 ** 64 - 1, 200000000000000000, 1])
+    packed = subscribers.to_bytes()
+    assert len(packed) == 24
+    assert list(SubscriberSet.load(packed)) == [1, 200000000000000000, 2 ** 64 - 1]
+
+
+def test_empty_set():
+    subscribers = SubscriberSet.load(b'')
+    assert not subscribers and len(subscribers) == 0
+    assert 1 not in subscribers
+    assert subscribers.to_bytes() == b''
+
+
+def test_legacy_mention_lists_load():
+    subscribers = SubscriberSet.load(["<@300>", "<@!100>", None, "200", "<@300>", "nobody"])
+    assert list(subscribers) == [100, 200, 300]
+
+
+def test_parse_user():
+    assert parse_user(5) == 5
+    assert parse_user(" <@!42> ") == 42
+    assert parse_user("<@x>") is None
+    assert parse_user(None) is None
@@ -0,0 +1,91 @@
+import io
+import json
+
+import pytest
+
+import transfer
+from conftest import ENGINES, open_engine
+
+
+def dump(*records):
+    return [json.dumps(record) for record in records]
+
+
+def test_import_stores_aliases_pointing_at_the_character(engine):
+    lines = dump({"type": "notice", "guild": "1", "character": "Twilight Sparkle", "users": [10]},
+                 {"type": "alias", "guild": "1", "alias": "Twi", "character": "twilight  SPARKLE"},
+                 {"type": "alias", "guild": "1", "alias": "Ts", "character": "Twi"},
+                 {"type": "alias", "guild": "1", "alias": "Later", "character": "Not Yet Known"})
+
+    counts = transfer.import_file(engine, lines)
+
+    assert counts["alias"] == 3
+    assert engine.aliases("1") == {"Twi": "Twilight Sparkle", "Ts": "Twilight Sparkle", "Later": "Not Yet Known"}
+
+
+def test_import_leaves_an_alias_to_the_same_character_alone(engine):
+    engine.add_subscriber("1", "Twilight Sparkle", 10)
+    engine.set_alias("1", "Twi", "Twilight Sparkle")
+    engine.set_alias("1", "Ts", "Twilight Sparkle")
+
+    counts = transfer.import_file(engine, dump({"type": "alias", "guild": "1", "alias": "Ts", "character": "Twi"},
+                                               {"type": "alias", "guild": "1", "alias": "Twi", "character": "Rarity"}))
+
+    assert (counts["alias"], counts["conflict"]) == (0, 1)
+    assert engine.aliases("1") == {"Twi": "Twilight Sparkle", "Ts": "Twilight Sparkle"}
+
+
+def fill(store):
+    store.add_subscribers("1", "Rarity", [10, 20])
+    store.add_subscriber("1", "Applejäck", 30)
+    store.add_character("1", "Nobody Yet")
+    store.set_alias("1", "Rares", "Rarity")
+    store.watch_channel("1", 100)
+    store.add_subscriber("2", "Twilight Sparkle", 10)
+
+
+def contents(store, server):
+    notices = {character: list(store.subscribers(server, character)) for character in store.characters(server)}
+    return notices, store.aliases(server), store.watched_channels(server)
+
+
+@pytest.mark.parametrize("kind", ENGINES)
+def test_round_trip(engine, kind, tmp_path):
+    fill(engine)
+    output = io.StringIO()
+    written = transfer.export_file(engine, output)
+    assert written == {"notice": 4, "alias": 1, "channel": 1}
+
+    # into every other kind of engine too
+    (tmp_path / "copy").mkdir()
+    store = open_engine(kind, tmp_path / "copy")
+    try:
+        counts = transfer.import_file(store, io.StringIO(output.getvalue()))
+        assert (counts["notice"], counts["alias"], counts["channel"]) == (4, 1, 1)
+        for server in ("1", "2"):
+            assert contents(store, server) == contents(engine, server)
+
+        # importing the same dump again changes nothing
+        counts = transfer.import_file(store, io.StringIO(output.getvalue()))
+        assert (counts["notice"], counts["alias"], counts["channel"]) == (0, 0, 0)
+    finally:
+        store.close()
+
+
+def test_a_single_server_can_be_moved_to_another(engine):
+    fill(engine)
+    output = io.StringIO()
+    transfer.export_file(engine, output, "1")
+    lines = output.getvalue().splitlines()
+    assert all(json.loads(line).get("guild", "1") == "1" for line in lines)
+
+    transfer.import_file(engine, lines, "3")
+
+    assert contents(engine, "3") == contents(engine, "1")
+
+
+@pytest.mark.parametrize("line", ['{"type": "notice", "guild": "1"}', '{"type": "vote"}', 'not json',
+                                  '{"type": "header", "format": "waifuhoarder", "version": 99}'])
+def test_bad_lines_are_rejected_with_their_number(line):
+    with pytest.raises(ValueError, match="line 2"):
+        list(transfer.read_records(["", line]))
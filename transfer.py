@@ -0,0 +1,247 @@
+"""
+Import and export of WaifuHoarder notices, aliases and watched channels as JSON Lines
+
+Every line of a dump is one JSON object:
+    {"type": "header", "format": "waifuhoarder", "version": 1}
+    {"type": "notice", "guild": "<server ID>", "character": "<name>", "users": [<user ID>, ...]}
+    {"type": "alias", "guild": "<server ID>", "alias": "<alias>", "character": "<name>"}
+    {"type": "channel", "guild": "<server ID>", "channel": <channel ID>}
+
+Usage: python transfer.py export|import FILE [-g GUILD] -b shelve|sqlite|eventlog -u USERLIST -c CHARACTER -d DATABASE
+    -e EVENTLOG
+FILE can be - for stdout or stdin. Run it while the bot is stopped, unless the bot uses the sqlite backend.
+
+(C) 2019-2020 by Jordan Aurora Kinsley
+
+Licensed under MIT License, see LICENSE
+"""
+
+import argparse
+import json
+import sys
+import storage
+import eventlog
+from aliastable import AliasTable, normalize, strip_server
+
+FORMAT = "waifuhoarder"
+FORMAT_VERSION = 1
+# how many records an import applies before writing them out and, in the bot, letting other commands run
+IMPORT_BATCH = 500
+# what an import counts: new subscribers, aliases and channels, aliases left out because the server already has the
+# alias pointing somewhere else, and aliases rejected for naming a character or making a loop
+COUNTS = ("notice", "alias", "channel", "conflict", "rejected")
+
+
+def export_records(store, server=None):
+    """Yields a dump's records for server, or for every server if server is None, one at a time so that only one
+    character's subscribers are in memory at once"""
+    yield {"type": "header", "format": FORMAT, "version": FORMAT_VERSION}
+    if server is None:
+        notices = store.all_notices()
+        aliases = store.all_aliases()
+        channels = store.all_watched_channels()
+    else:
+        notices = _server_notices(store, server)
+        aliases = ((server, alias, character) for alias, character in sorted(store.aliases(server).items()))
+        channels = ((server, channel) for channel in sorted(store.watched_channels(server)))
+    for guild, character, users in notices:
+        yield {"type": "notice", "guild": str(guild), "character": character, "users": list(users)}
+    for guild, alias, character in aliases:
+        yield {"type": "alias", "guild": str(guild), "alias": alias, "character": character}
+    for guild, channel in channels:
+        yield {"type": "channel", "guild": str(guild), "channel": channel}
+
+
+def _server_notices(store, server):
+    for character in sorted(store.characters(server)):
+        try:
+            yield server, character, store.subscribers(server, character)
+        except KeyError:
+            # dropped since characters() was read
+            continue
+
+
+def write_records(records, output):
+    """Writes records to a text file as JSON Lines. Returns a dict of how many subscribers, aliases and channels were
+    written"""
+    counts = {"notice": 0, "alias": 0, "channel": 0}
+    for record in records:
+        output.write(json.dumps(record, ensure_ascii=False))
+        output.write("\n")
+        if record["type"] == "notice":
+            counts["notice"] += len(record["users"])
+        elif record["type"] in counts:
+            counts[record["type"]] += 1
+    return counts
+
+
+def export_file(store, output, server=None):
+    """Writes a dump of server (every server if None) to output. Returns the counts from write_records"""
+    return write_records(export_records(store, server), output)
+
+
+def read_records(lines):
+    """Yields the records in an iterable of JSON Lines (str or bytes), skipping blank lines and the header. Raises
+    ValueError naming the line for anything that isn't a record this version understands"""
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as error:
+            raise ValueError("line {0}: not valid JSON ({1})".format(number, error))
+        kind = record.get("type") if isinstance(record, dict) else None
+        try:
+            if kind == "header":
+                if record.get("format") != FORMAT or record.get("version", 0) > FORMAT_VERSION:
+                    raise ValueError("not a version {0} {1} dump".format(FORMAT_VERSION, FORMAT))
+                continue
+            if kind == "notice":
+                record = {"type": kind, "guild": str(record["guild"]), "character": str(record["character"]),
+                          "users": [int(user) for user in record["users"]]}
+            elif kind == "alias":
+                record = {"type": kind, "guild": str(record["guild"]), "alias": str(record["alias"]),
+                          "character": str(record["character"])}
+            elif kind == "channel":
+                record = {"type": kind, "guild": str(record["guild"]), "channel": int(record["channel"])}
+            else:
+                raise ValueError("unknown record type {0!r}".format(kind))
+        except (KeyError, TypeError, ValueError) as error:
+            raise ValueError("line {0}: {1}".format(number, error))
+        yield record
+
+
+def import_batch(store, records, server=None, size=IMPORT_BATCH, tables=None):
+    """Applies up to size records taken from the iterator records. With server, every record goes to that server
+    instead of the one it was exported from. Existing data is merged with, never replaced: subscribers are added to
+    the ones already there, and an alias the server already has keeps pointing where it did, so importing the same dump
+    twice changes nothing the second time. Aliases get the same checks as the alias command: one named like a character,
+    or one whose target leads back to it, is rejected. Like the alias command, an alias is stored pointing straight at
+    the character its target resolves to. tables is a dict of server to AliasTable used for the checks,
+    kept up to date as records are applied; pass the same one to every batch of an import to build each only once.
+    Returns a (counts, finished) tuple, counts being a dict with a count for each of COUNTS"""
+    counts = dict.fromkeys(COUNTS, 0)
+    if tables is None:
+        tables = {}
+    for _ in range(size):
+        try:
+            record = next(records)
+        except StopIteration:
+            return counts, True
+        guild = record["guild"] if server is None else str(server)
+        if record["type"] == "notice":
+            counts["notice"] += store.add_subscribers(guild, record["character"], record["users"])
+            if guild in tables:
+                tables[guild].add_character(record["character"])
+        elif record["type"] == "alias":
+            table = _alias_table(store, tables, guild)
+            kind = _check_alias(table, record["alias"], record["character"])
+            if kind == "alias":
+                # stored as the character it ends up at, the way the alias command stores it, so the alias works for
+                # every consumer, not only the ones resolving through an AliasTable
+                target = table.resolve(record["character"]) or record["character"]
+                store.set_alias(guild, record["alias"], target)
+                table.set_alias(record["alias"], target)
+            if kind is not None:
+                counts[kind] += 1
+        elif record["type"] == "channel":
+            counts["channel"] += store.watch_channel(guild, record["channel"])
+    return counts, False
+
+
+def _alias_table(store, tables, guild):
+    table = tables.get(guild)
+    if table is None:
+        aliases = {alias: strip_server(target, guild) for alias, target in store.aliases(guild).items()}
+        table = tables[guild] = AliasTable.build(store.characters(guild), aliases)
+    return table
+
+
+def _check_alias(table, alias, character):
+    """Returns which of COUNTS importing alias -> character counts as, "alias" if it should be written, or None if the
+    server already has it"""
+    existing = table.alias(alias)
+    if existing is not None:
+        same = normalize(existing[1]) == normalize(character) or \
+            (table.resolve(alias) is not None and table.resolve(alias) == table.resolve(character))
+        return None if same else "conflict"
+    if table.character(alias) is not None:
+        return "rejected"
+    # the same loop checks as Waifu.add_alias: a target that is an alias caught in a loop, or one that leads back here
+    target = table.resolve(character) or character
+    if (table.alias(character) is not None and table.resolve(character) is None) or \
+            normalize(target) == normalize(alias):
+        return "rejected"
+    return "alias"
+
+
+def import_file(store, lines, server=None, size=IMPORT_BATCH):
+    """Imports every record in lines, writing each batch out before reading the next. Returns the summed counts"""
+    records = read_records(lines)
+    totals = dict.fromkeys(COUNTS, 0)
+    tables = {}
+    finished = False
+    while not finished:
+        counts, finished = import_batch(store, records, server, size, tables)
+        for kind, count in counts.items():
+            totals[kind] += count
+        store.flush()
+    store.sync()
+    return totals
+
+
+def describe(counts):
+    described = "{0} subscribers, {1} aliases and {2} channels".format(counts["notice"], counts["alias"],
+                                                                      counts["channel"])
+    if counts.get("conflict") or counts.get("rejected"):
+        described += " ({0} aliases already pointing elsewhere left alone, {1} naming a character or making a loop " \
+                     "rejected)".format(counts.get("conflict", 0), counts.get("rejected", 0))
+    return described
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export or import WaifuHoarder notices, aliases and watched channels "
+                                                 "as JSON Lines")
+    parser.add_argument("action", choices=["export", "import"])
+    parser.add_argument("file", help="file to write or read, - for stdout or stdin")
+    parser.add_argument("-g", "--guild", help="only export this server, or import everything into this server")
+    parser.add_argument("-b", "--backend", choices=["shelve", "sqlite", "eventlog"], default="shelve")
+    parser.add_argument("-c", "--character", help="file location for character alias shelf", default='aliases.test.db')
+    parser.add_argument("-u", "--userlist", help="file location for user list shelf", default='userlist.test.db')
+    parser.add_argument("-d", "--database", help="file location for the SQLite database",
+                        default='waifu.test.sqlite3')
+    parser.add_argument("-e", "--eventlog", help="file location for the event log checkpoint",
+                        default='waifu.test.events')
+    args = parser.parse_args()
+
+    if args.backend == "sqlite":
+        store = storage.SqliteStorage(args.database)
+    elif args.backend == "eventlog":
+        store = eventlog.EventLogStorage(args.eventlog)
+    else:
+        store = storage.ShelveStorage(args.userlist, args.character)
+    try:
+        if args.action == "export":
+            if args.file == "-":
+                counts = export_file(store, sys.stdout, args.guild)
+            else:
+                with open(args.file, "w", encoding="utf-8") as output:
+                    counts = export_file(store, output, args.guild)
+            print("exported " + describe(counts), file=sys.stderr)
+        else:
+            if args.file == "-":
+                counts = import_file(store, sys.stdin, args.guild)
+            else:
+                with open(args.file, "r", encoding="utf-8") as lines:
+                    counts = import_file(store, lines, args.guild)
+            print("imported " + describe(counts), file=sys.stderr)
+    except ValueError as error:
+        print("import failed at {0}".format(error), file=sys.stderr)
+        return 1
+    finally:
+        store.close()
+    return 0
+
+
+if __name__ == '__main__':
+    quit(main())
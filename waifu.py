@@ -6,361 +6,1056 @@ The Waifu Discord.py Cog at the heart of WaifuHoarder
 Licensed under MIT License, see LICENSE
 """
 
-import shelve
+import asyncio
 import datetime
+import io
+import os
+import sqlite3
+import tempfile
+import time
+from bisect import bisect_left
+import discord
 from discord.ext import commands, tasks
 from discord.utils import escape_mentions as suppress_mentions
-from bothelper import log, discord_split
+from bothelper import log, chunk_messages, mention, cluster_mode
+from aliastable import AliasTable, normalize, strip_server
+from asyncstorage import AsyncStorage
+from cache import LRUCache
+from indexes import make_key
+from matcher import CharacterMatcher
+from metrics import Metrics
+from profiler import Profiler
+from purge import PurgeQueue
+from roles import DiscordRoleAPI, RoleQueue
+from sendqueue import SendQueue, discord_transport
+import snapshot
+import transfer
+
+# how many entries each page of knownwaifus and knownaliases shows
+LISTING_PAGE_SIZE = {CharacterMatcher.CHARACTER: 50, CharacterMatcher.ALIAS: 25}
+# how many servers a warm start builds from the snapshot before letting other commands run
+WARM_BATCH = 50
+# seconds a warm start waits between reading servers that changed since the snapshot, so the reads don't hold up the
+# storage thread for commands
+WARM_READ_INTERVAL = 0.05
+# how many stored users a departed member sweep checks before letting other commands run
+SWEEP_BATCH = 1000
+# the send queue key of a notice mentioning a character's role, next to the character. Notices mentioning users are
+# keyed by a tuple of characters alone
+ROLE_NOTICE = object()
 
 
 class Waifu(commands.Cog):
-    """Provides a Python Shelve system for persistent key:value storage of notices on a per-server basis."""
-    # TODO: implement import/export of shelve to plain text
-
-    # These two are used by the shelve module to store what is essentially a dict of IDs mapped to values
-    notify_user_list = None
-    character_aliases = None
-    user_list_location = ''
-    character_alias_location = ''
+    """Provides persistent storage of notices on a per-server basis, through one of the engines in storage.py."""
+
+    # the storage engine (see storage.py) that holds what is essentially a dict of IDs mapped to values, wrapped so its
+    # disk access happens off the event loop (see asyncstorage.py)
+    storage = None
+    # keep the 'its' hot path off the storage thread for characters that get posted over and over
+    subscriber_cache = None
+    # per-server AliasTables that resolve names to characters, loaded on first use
+    alias_tables = None
+    # per-server CharacterMatchers and watched channel sets for automatic notices, both loaded on first use
+    matchers = None
+    watched_channels = None
+    # every message the cog sends goes through here, so each channel stays inside its rate limit
+    send_queue = None
+    # command latency and error counts, plus everything else the stats command and --metrics-port report
+    metrics = None
+    # the profile command's cProfile and tracemalloc runs
+    profiler = None
+    # hands out and takes back the roles of servers with role notices on, inside Discord's rate limits
+    role_queue = None
+    # servers the bot left and members who left them, waiting to be purged from storage
+    purges = None
     args = None
 
-    def __init__(self, bot):
+    def __init__(self, bot, storage, args, transport=discord_transport, role_api=None):
         self.bot = bot
-        # when we initialize, open a pair of 'shelves' (https://docs.python.org/3/library/shelve.html)
-        # writeback is set to False to conserve memory at the expense of addition steps to add info the shelf
-        self.notify_user_list = shelve.open(self.user_list_location, flag='c', writeback=False)
-        self.character_aliases = shelve.open(self.character_alias_location, flag='c', writeback=False)
-        # starts the sync_db function so we can have it run on a regular basis
-        self.sync_db.start()
+        self.storage = AsyncStorage(storage)
+        self.args = args
+        self.subscriber_cache = LRUCache("subscribers", args.cache_size, args.cache_ttl)
+        self.alias_tables = {}
+        self.matchers = {}
+        # server -> count bumped on every character or alias change there, so a table or matcher built from a read that
+        # a change overtook is dropped. all_name_changes is bumped when every server's names are dropped at once
+        self.name_changes = {}
+        self.all_name_changes = 0
+        self.watched_channels = {}
+        # sorted per-server listings for knownwaifus and knownaliases. Entries don't expire, since every change to a
+        # server's characters or aliases drops its listing (see update_names)
+        self.listing_cache = LRUCache("listings", args.cache_size, float('inf'))
+        self.listing_cursors = LRUCache("listing cursors", args.cache_size, args.cache_ttl)
+        self.send_queue = SendQueue(transport, args.send_budget, args.send_window, args.notice_debounce, args)
+        self.role_queue = RoleQueue(role_api or DiscordRoleAPI(bot), self.storage, args.role_budget,
+                                    args.role_window, args)
+        # servers with role notices on, loaded on first use
+        self.role_servers = None
+        self.purges = PurgeQueue(args.purge_grace)
+        self.metrics = Metrics(self.storage, (self.subscriber_cache, self.listing_cache, self.listing_cursors),
+                               self.send_queue, args)
+        # when measure_loop_lag should next run if nothing is holding up the event loop
+        self.loop_lag_due = None
+        self.profiler = Profiler()
+        # where the profile command was run, for the summary, and the timer ending a profile run of some seconds
+        self.profile_ctx = None
+        self.profile_timer = None
+        # restart to ready is measured from here, the storage having been opened just before
+        self.started_at = time.monotonic()
+        # the (epoch, versions) the snapshot on disk was taken at, so an unchanged one isn't written again
+        self.snapshot_versions = None
+        self.warming = None
+        # starts the flush_db function so we can have it run on a regular basis
+        self.flush_db.change_interval(seconds=args.flush_interval)
+        self.flush_db.start()
+        self.measure_loop_lag.start()
+        if args.snapshot:
+            self.warming = asyncio.ensure_future(self.warm_start())
+            self.save_snapshot.change_interval(seconds=args.snapshot_interval)
+            self.save_snapshot.start()
 
     def cog_unload(self):
-        # if we're stopping the bot gracefully, close the shelves properly
-        self.notify_user_list.close()
-        self.character_aliases.close()
+        # if we're stopping the bot gracefully, write out whatever is still in memory and close the storage properly
+        self.flush_db.cancel()
+        self.measure_loop_lag.cancel()
+        if self.warming is not None:
+            self.warming.cancel()
+            self.save_snapshot.cancel()
+        self.reconcile_roles.cancel()
+        self.sweep_departed.cancel()
+        self.purge_departed.cancel()
+        self.metrics.close()
+        self.send_queue.close()
+        self.role_queue.close()
+        if self.profile_timer is not None:
+            self.profile_timer.cancel()
+        if self.profiler.active:
+            self.profiler.stop()
+        start = datetime.datetime.now()
+        pending = self.storage.dirty_count()
+        self.storage.close(self.final_snapshot if self.warming is not None else None)
+        log("def cog_unload: final flush of {0} changes took {1}", 'vf', self.args, pending,
+            datetime.datetime.now() - start)
+
+    async def cog_before_invoke(self, ctx):
+        ctx.invoked_at = time.perf_counter()
+        if self.profiler.active and ctx.command.name != "profile":
+            self.profiler.begin(ctx)
+
+    async def cog_after_invoke(self, ctx):
+        if self.profiler.active:
+            self.profiler.end(ctx)
+            if self.profiler.expired():
+                await self.finish_profile()
+        # runs whether or not the command raised, so failed commands count towards the latency too
+        invoked_at = getattr(ctx, 'invoked_at', None)
+        if invoked_at is not None:
+            self.metrics.observe_command(ctx.command.qualified_name, time.perf_counter() - invoked_at)
+        # a burst of changes gets written out right away instead of waiting for the next flush_db run
+        if self.storage.dirty_count() >= self.args.flush_threshold:
+            await self.flush_storage("threshold")
+
+    async def cog_command_error(self, ctx, error):
+        # called after the command's own error handler, if it has one, for every error including failed checks
+        self.metrics.count_error(ctx.command.qualified_name if ctx.command else "unknown", error)
 
     # These @tasks, @commands, @bot symbols above functions are Python decorators and help the bot do specific tasks or
     # know where to look for functions
-    @tasks.loop(minutes=15)  # ignore 'loop object not callable' message in IDE
-    async def sync_db(self):
-        # every 2.5 minutes, sync the shelves
-        self.notify_user_list.close()
-        self.notify_user_list = shelve.open(self.user_list_location, flag='c', writeback=False)
-        self.character_aliases.close()
-        self.character_aliases = shelve.open(self.character_alias_location, flag='c', writeback=False)
+    @tasks.loop(seconds=60)  # ignore 'loop object not callable' message in IDE
+    async def flush_db(self):
+        # every --flush-interval seconds, write changed keys to disk
+        await self.flush_storage("interval")
+
+    @tasks.loop(seconds=1)
+    async def measure_loop_lag(self):
+        # anything that blocks the event loop (a slow command, disk access on the loop) makes this run late
+        now = time.monotonic()
+        if self.loop_lag_due is not None:
+            self.metrics.observe_loop_lag(now - self.loop_lag_due)
+        self.loop_lag_due = now + 1
+
+    @measure_loop_lag.before_loop
+    async def start_metrics(self):
+        # the metrics endpoint is only started if --metrics-port was passed
+        port = self.args.metrics_port
+        if port:
+            try:
+                await self.metrics.serve(port)
+            except OSError as error:
+                log("def start_metrics: couldn't listen on port {0}: {1}", 'sf', self.args, port, error)
+
+    @tasks.loop(seconds=600)
+    async def save_snapshot(self):
+        # every --snapshot-interval seconds, if any server's names changed. The first run comes straight away, while
+        # warm_start is still reading the old snapshot, so it is skipped
+        if self.warming.done():
+            await self.write_snapshot()
+
+    async def write_snapshot(self):
+        """Writes a snapshot of every server's names to --snapshot, unless nothing changed since the last one"""
+        epoch, versions = await self.storage.name_versions()
+        current = (epoch, {server: version for server, version in versions.items() if self.handles_server(server)})
+        if current == self.snapshot_versions:
+            return
+        start = datetime.datetime.now()
+        try:
+            self.snapshot_versions, size = await self.storage.run(snapshot.save, self.storage.storage,
+                                                                  self.args.snapshot, self.handles_server)
+        except OSError as error:
+            log("def write_snapshot: couldn't write {0}: {1}", 'sf', self.args, self.args.snapshot, error)
+            return
+        log("def write_snapshot: wrote {0} servers ({1} bytes) to {2} in {3}", 'vf', self.args,
+            len(self.snapshot_versions[1]), size, self.args.snapshot, datetime.datetime.now() - start)
+
+    def final_snapshot(self, store):
+        """Writes the snapshot while shutting down, on the storage thread's behalf once it has stopped"""
+        epoch, versions = store.name_versions()
+        if (epoch, {server: version for server, version in versions.items()
+                    if self.handles_server(server)}) == self.snapshot_versions:
+            return
+        try:
+            snapshot.save(store, self.args.snapshot, self.handles_server)
+        except OSError as error:
+            log("def final_snapshot: couldn't write {0}: {1}", 'sf', self.args, self.args.snapshot, error)
+
+    @tasks.loop(seconds=3600)
+    async def reconcile_roles(self):
+        # roles drift from the subscribers in storage: changes still queued at shutdown are dropped, people hand roles
+        # out or take them away by hand, members leave and come back
+        for server in sorted(await self.role_mode_servers()):
+            if self.handles_server(server) and self.bot.get_guild(int(server)) is not None:
+                await self.reconcile_server(server)
+
+    async def reconcile_server(self, server):
+        """Queues the role changes that make <server>'s roles match its subscribers"""
+        characters = await self.storage.characters(server)
+        subscribers = await self.storage.subscribers_many(server, list(characters))
+        given, taken, deleted = await self.role_queue.reconcile(int(server), subscribers)
+        log("def reconcile_server: queued {0} roles to give, {1} to take and {2} to delete on {3}", 'vf', self.args,
+            given, taken, deleted, server)
+
+    async def role_mode_servers(self):
+        """Returns the set of servers with role notices on, reading it from storage on first use"""
+        if self.role_servers is None:
+            self.role_servers = await self.storage.role_servers()
+        return self.role_servers
+
+    async def role_mode(self, server):
+        return str(server) in await self.role_mode_servers()
+
+    def handles_server(self, server):
+        """False for servers whose events go to shards another process runs (see cluster.py)"""
+        shard_ids = getattr(self.bot, 'shard_ids', None)
+        if not shard_ids:
+            return True
+        return (int(server) >> 22) % self.bot.shard_count in shard_ids
+
+    async def warm_start(self):
+        """Builds the alias tables, matchers and watched channel sets of every server the snapshot is still right about,
+        then reads the servers that changed since it was taken from storage, a few at a time. Without a snapshot that is
+        still right about the storage engine's epoch nothing is read: reading every server would compete with commands
+        for the storage thread, so each server is built on first use instead. Commands don't wait for any of this:
+        until a server is done, they build what they need of it on first use, as they would without a snapshot"""
+        changes = self.all_name_changes
+        try:
+            saved = await self.storage.run(snapshot.read, self.args.snapshot)
+        except FileNotFoundError:
+            saved = None
+            log("def warm_start: no snapshot at {0}, reading every server from storage", 'sf', self.args,
+                self.args.snapshot)
+        except (OSError, ValueError) as error:
+            saved = None
+            log("def warm_start: ignoring snapshot {0}: {1}", 'sf', self.args, self.args.snapshot, error)
+        epoch, versions = await self.storage.name_versions()
+        versions = {server: version for server, version in versions.items() if self.handles_server(server)}
+        fresh, stale = snapshot.split(saved, epoch, versions)
+        if saved is not None:
+            self.snapshot_versions = (saved["epoch"], {server: entry[0] for server, entry in saved["servers"].items()})
+        if not fresh:
+            log("def warm_start: nothing usable in the snapshot, {0} servers load on first use", 'sf', self.args,
+                len(stale))
+            return
+        loaded = 0
+        fresh = list(fresh.items())
+        for position, (server, (characters, aliases, channels)) in enumerate(fresh):
+            if changes != self.all_name_changes:
+                # every server's names were dropped, so the rest come from storage
+                stale.extend(server for server, _ in fresh[position:])
+                break
+            if server in self.name_changes:
+                # changed since start up, so the snapshot may be behind on it
+                stale.append(server)
+                continue
+            self.install_names(server, characters, aliases, channels)
+            loaded += 1
+            if loaded % WARM_BATCH == 0:
+                await asyncio.sleep(0)
+        log("def warm_start: {0} servers from the snapshot in {1:.2f}s after start, {2} to read from storage", 'sf',
+            self.args, loaded, time.monotonic() - self.started_at, len(stale))
+        for server in stale:
+            if server in self.alias_tables:
+                continue
+            await asyncio.sleep(WARM_READ_INTERVAL)
+            changes = self.names_version(server)
+            characters, aliases = await self.guild_names(server)
+            channels = await self.storage.watched_channels(server)
+            if changes == self.names_version(server):
+                self.install_names(server, characters, aliases, channels)
+        log("def warm_start: every server ready {0:.2f}s after start", 'sf', self.args,
+            time.monotonic() - self.started_at)
+
+    def install_names(self, server, characters, aliases, channels):
+        """Builds <server>'s alias table, and its matcher if automatic notices are on anywhere on it, from names read
+        by warm_start. Whatever a command already built in the meantime is kept"""
+        aliases = {alias: strip_server(target, server) for alias, target in aliases.items()}
+        if server not in self.alias_tables:
+            self.alias_tables[server] = AliasTable.build(characters, aliases)
+        if channels and server not in self.matchers:
+            self.matchers[server] = CharacterMatcher.build(characters, aliases)
+        self.watched_channels.setdefault(int(server), set(channels))
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        log("def on_ready: connected {0:.2f}s after start", 'sf', self.args, time.monotonic() - self.started_at)
+        # these go by the guilds and members in the cache, so they wait for it to fill. on_ready comes again after a
+        # reconnect
+        for loop, interval in ((self.reconcile_roles, self.args.role_reconcile_interval),
+                               (self.sweep_departed, self.args.purge_sweep_interval), (self.purge_departed, 60)):
+            if loop.get_task() is None:
+                loop.change_interval(seconds=interval)
+                loop.start()
+
+    @commands.Cog.listener()
+    async def on_guild_remove(self, guild):
+        # kicked, banned or the server was deleted. What we have for it goes once the grace period is over
+        self.purges.schedule(guild.id)
+
+    @commands.Cog.listener()
+    async def on_guild_join(self, guild):
+        self.purges.cancel(guild.id)
+
+    @commands.Cog.listener()
+    async def on_member_remove(self, member):
+        self.purges.schedule(member.guild.id, member.id)
+
+    @commands.Cog.listener()
+    async def on_member_join(self, member):
+        self.purges.cancel(member.guild.id, member.id)
+
+    @tasks.loop(seconds=86400)
+    async def sweep_departed(self):
+        # catches servers and members that left while the bot was offline, or without an event telling us
+        servers = users = 0
+        for server in await self.storage.servers():
+            if self.handles_server(server) and self.bot.get_guild(int(server)) is None:
+                servers += self.purges.schedule(server)
+        for number, (server, user) in enumerate(await self.storage.all_users()):
+            guild = self.bot.get_guild(int(server))
+            # a server whose members haven't all been loaded can't tell us who left
+            if guild is not None and guild.chunked and not guild.unavailable and guild.get_member(user) is None:
+                users += self.purges.schedule(server, user)
+            if number % SWEEP_BATCH == SWEEP_BATCH - 1:
+                await asyncio.sleep(0)
+        log("def sweep_departed: {0} more servers and {1} more members gone, {2}", 'sf', self.args, servers, users,
+            self.purges.stats())
+
+    @tasks.loop(seconds=60)
+    async def purge_departed(self):
+        due = self.purges.due()
+        if not due:
+            return
+        start = datetime.datetime.now()
+        servers = entries = users = notices = 0
+        for server, user in due:
+            guild = self.bot.get_guild(int(server))
+            try:
+                if user is None:
+                    if guild is not None:
+                        continue
+                    entries += await self.purge_server(server)
+                    servers += 1
+                else:
+                    if guild is not None and guild.get_member(user) is not None:
+                        continue
+                    removed = await self.storage.remove_user(server, user)
+                    self.subscriber_cache.invalidate(*[make_key(server, character) for character in removed])
+                    # purges don't come from commands, so nothing else flushes them before the next interval. Until
+                    # then a shared SQLite database would stay locked against the other workers
+                    await self.flush_storage("purge")
+                    notices += len(removed)
+                    users += 1
+            except sqlite3.OperationalError as error:
+                # another worker holding the database for longer than the busy timeout; tried again on the next run
+                log("def purge_departed: couldn't purge {0} on {1}: {2}", 'sf', self.args, user or "everything", server,
+                    error)
+                self.purges.retry(server, user)
+            # one server or member at a time, so commands get the storage thread in between
+            await asyncio.sleep(0)
+        self.purges.record(servers, entries, users, notices)
+        log("def purge_departed: purged {0} servers ({1} characters, aliases and settings) and {2} members ({3} "
+            "notices) in {4}", 'sf', self.args, servers, entries, users, notices, datetime.datetime.now() - start)
+
+    async def purge_server(self, server):
+        """Removes everything stored for <server>, --purge-batch entries per storage call so other commands get the
+        storage thread in between. Returns how many entries were removed"""
+        removed = 0
+        while True:
+            batch = await self.storage.purge_server(server, self.args.purge_batch)
+            removed += batch
+            await self.flush_storage("purge")
+            if batch < self.args.purge_batch:
+                break
+            await asyncio.sleep(0)
+        self.subscriber_cache.invalidate_prefix(make_key(server, ''))
+        self.forget_names(server)
+        self.watched_channels.pop(int(server), None)
+        if self.role_servers is not None:
+            self.role_servers.discard(str(server))
+        return removed
+
+    async def flush_storage(self, reason):
+        """Writes the changes the storage is holding in memory to disk, in batches of --flush-batch so that other
+        commands get to run in between"""
+        pending = self.storage.dirty_count()
+        if not pending:
+            return
+        start = datetime.datetime.now()
+        written = 0
+        batches = 0
+        while written < pending and self.storage.dirty_count():
+            written += await self.storage.flush(self.args.flush_batch)
+            batches += 1
+            await asyncio.sleep(0)
+        # picks up anything changed while we were yielding and makes sure it all reaches the disk
+        await self.storage.sync()
+        log("def flush_storage: {0} flush wrote {1} changes in {2} batches of up to {3} in {4}", 'vf', self.args,
+            reason, written, batches, self.args.flush_batch, datetime.datetime.now() - start)
 
     # basic command that uses the function name as the command name
     @commands.command()
     async def its(self, ctx, *, character):
         """Pings users who've requested to be notified about <character>"""
         # takes a single argument without quotes, anything passed as the "character" gets sent as input
-        await ctx.send(self.itis(ctx, character))
+        await self.send_notices(ctx, [character])
 
     @commands.command()
     @commands.is_owner()
     async def itsnn(self, ctx, *, character):
         """Owner-only test command for sending notices for a character without pinging the user(s) signed up for the notice"""
-        no_mention = suppress_mentions(self.itis(ctx, character))
-        await ctx.send(no_mention, delete_after=300)
+        for message in await self.itis(ctx, character):
+            self.reply(ctx, suppress_mentions(message), delete_after=300)
 
-    # helper function for its() and itsm(), but not a command
-    def itis(self, ctx, character):
-        """Takes a Discord Context ctx and string character as arguments and sends notices to all users signed up for them"""
-        log("def itis: character: " + character, 'vf', self.args)
+    # helper function for itsnn(), but not a command
+    async def itis(self, ctx, character):
+        """Takes a Discord Context ctx and string character as arguments and returns the notice messages for all users
+        signed up for them, already split to fit in Discord messages"""
+        log("def itis: character: {0}", 'vf', self.args, character)
         notify_users = None
-        resolved_character = str(self.resolve_server_alias(ctx, character.title()))
-        log("def itis: resolved character: " + resolved_character, 'vf', self.args)
+        resolved_character = str(await self.resolve_server_alias(ctx, character.title()))
+        log("def itis: resolved character: {0}", 'vf', self.args, resolved_character)
         # we're only going to look for notices registered for the server where the command got called
-        user_key = str(ctx.guild.id) + "\\" + resolved_character
-        log("def itis: user_key: " + user_key, 'vf', self.args)
         try:
-            notify_users = self.notify_user_list[user_key]
-            log("def itis: notify_users: " + str(notify_users), 'vf', self.args)
+            notify_users = await self.cached_subscribers(ctx.guild.id, resolved_character)
+            log("def itis: notify_users: {0}", 'vf', self.args, notify_users)
             if not notify_users:  # if no values get returned for a <character>
                 raise KeyError
         except KeyError:
-            return str("Oops! I don't have an alert for {0}, {1}\n".format(resolved_character, ctx.author.mention))
-        to_notify = 'Hey,'
-        for user in notify_users:
-            to_notify = to_notify + ' ' + user
-        to_notify = to_notify + ', it\'s ' + resolved_character
-        to_notify += "\n"
-        return to_notify
+            return [self.no_alert_message(ctx, resolved_character)]
+        return list(self.notice_messages(notify_users, [resolved_character]))
+
+    @staticmethod
+    def no_alert_message(ctx, character):
+        return str("Oops! I don't have an alert for {0}, {1}\n".format(character, ctx.author.mention))
+
+    @staticmethod
+    def notice_messages(users, characters):
+        """Yields the messages pinging <users> that <characters> got posted, split to fit in Discord messages"""
+        # subscribers are stored as user IDs, so this is the only place their mentions get built
+        return chunk_messages((mention(user) for user in users), ' ', header='Hey, ',
+                              footer=', it\'s ' + ', '.join(characters) + "\n")
 
     @commands.command()
     async def itsm(self, ctx, *characters):
         """Pings users who have requested notices for however many characters are passed. Characters with spaces in names
         need to be enclosed in double quotes (i.e. Sunset Shimmer is not the same as "Sunset Shimmer")"""
-        notice_list = ''
+        await self.send_notices(ctx, characters)
+
+    async def send_notices(self, ctx, characters):
+        """Helper for its() and itsm() that queues the notices for every character in <characters>"""
+        log("def send_notices: characters: {0}", 'vf', self.args, characters)
+        # every alias and every subscriber list is looked up in one go instead of once per character
+        resolved_characters = list(dict.fromkeys(
+            await self.resolve_server_aliases(ctx, [character.title() for character in characters])))
+        subscribers = await self.cached_subscribers_many(ctx.guild.id, resolved_characters)
+        for character in resolved_characters:
+            if not subscribers.get(character):
+                self.reply(ctx, self.no_alert_message(ctx, character))
+        await self.queue_notices(ctx.channel, ctx.guild.id, subscribers, resolved_characters)
+
+    async def queue_notices(self, channel, server, subscribers, characters):
+        """Queues the notices about <characters> to <channel>, given a dict of character to subscribers. On servers with
+        role notices on, a character with a role gets one mention of it instead of its subscribers', plus those of the
+        subscribers still waiting to be given it"""
+        if await self.role_mode(server):
+            roles = await self.role_queue.character_roles(server, [character for character in characters
+                                                                   if subscribers.get(character)])
+            for character, role in roles.items():
+                waiting = self.role_queue.waiting(server, character).intersection(subscribers[character])
+                targets = ["<@&{0}>".format(role)] + [mention(user) for user in waiting]
+                self.send_queue.notice(channel, (ROLE_NOTICE, character), targets, self.role_notice_messages)
+            # a character whose role isn't there yet (or couldn't be made) still gets its subscribers pinged
+            characters = [character for character in characters if character not in roles]
+        for group_characters, users in self.notice_groups(subscribers, characters).items():
+            self.send_queue.notice(channel, group_characters, users, self.notice_messages)
+
+    @staticmethod
+    def role_notice_messages(targets, key):
+        """Renders a role notice queued by queue_notices: the role's mention and any user mentions that go with it"""
+        return chunk_messages(targets, ' ', header='Hey, ', footer=', it\'s ' + key[1] + "\n")
+
+    @staticmethod
+    def notice_groups(subscribers, characters):
+        """Returns a dict of tuples of posted <characters> mapped to the users to ping about them, given a dict of
+        character to subscribers. Each user gets pinged once, with every posted character they follow, so users who
+        follow the same ones share a notice"""
+        matched = {}
         for character in characters:
-            notice_list = notice_list + self.itis(ctx, character)
-        await ctx.send(notice_list)
+            for user in subscribers.get(character, ()):
+                matched.setdefault(user, []).append(character)
+        groups = {}
+        for user, user_characters in matched.items():
+            groups.setdefault(tuple(user_characters), []).append(user)
+        return groups
+
+    def reply(self, ctx, content, **kwargs):
+        """Queues a message to ctx's channel on the send queue (see sendqueue.py) instead of sending it right away"""
+        self.send_queue.send(ctx.channel, content, **kwargs)
+
+    def refuse_in_cluster(self, ctx):
+        """Helper for the owner-only commands that change every server at once. In cluster mode this process only
+        caches the servers on its own shards, and the other processes would go on serving what they cached before the
+        change, so those commands are refused. Returns True if the command was refused"""
+        if not cluster_mode(self.args):
+            return False
+        self.reply(ctx, "That changes every server at once, which can't be done while the bot runs as a cluster. Stop "
+                        "the cluster and use maintenance.py or transfer.py instead")
+        return True
+
+    @commands.Cog.listener()
+    async def on_message(self, message):
+        """Sends notices for known characters and aliases named in messages posted to channels where automatic notices
+        are turned on (see autonotify)"""
+        if message.guild is None or message.author.bot:
+            return
+        if message.channel.id not in await self.channel_watch_list(message.guild.id):
+            return
+        prefix = self.bot.command_prefix
+        if isinstance(prefix, str) and message.content.startswith(prefix):
+            # commands like its send their own notices
+            return
+        matcher = await self.guild_matcher(message.guild.id)
+        characters = matcher.find(self.message_text(message))
+        if not characters:
+            return
+        # the matcher maps an alias to its stored target, which may itself be an alias
+        table = await self.alias_table(message.guild.id)
+        characters = list(dict.fromkeys(table.resolve(character) or character for character in characters))
+        log("def on_message: found {0} in {1}", 'vf', self.args, characters, message.channel.id)
+        subscribers = await self.cached_subscribers_many(message.guild.id, characters)
+        await self.queue_notices(message.channel, message.guild.id, subscribers, characters)
+
+    @staticmethod
+    def message_text(message):
+        """Collects the text of a message worth scanning for names: its content, attachment file names and embed
+        titles, one per line"""
+        parts = [message.content]
+        for attachment in message.attachments:
+            # twilight_sparkle-by-someone.png should count as naming Twilight Sparkle
+            parts.append(os.path.splitext(attachment.filename)[0].replace('_', ' ').replace('-', ' '))
+        for embed in message.embeds:
+            if embed.title:
+                parts.append(str(embed.title))
+        return '\n'.join(parts)
+
+    async def guild_names(self, server):
+        """Returns the set of characters on <server> and a dict of its aliases to the names they point at"""
+        characters = await self.storage.characters(server)
+        aliases = await self.storage.aliases(server)
+        return characters, {alias: strip_server(target, server) for alias, target in aliases.items()}
+
+    async def guild_matcher(self, server):
+        """Returns the CharacterMatcher for every character and alias on <server>, building it on first use"""
+        server = str(server)
+        matcher = self.matchers.get(server)
+        if matcher is None:
+            changes = self.names_version(server)
+            start = datetime.datetime.now()
+            matcher = CharacterMatcher.build(*await self.guild_names(server))
+            log("def guild_matcher: built {0} names for {1} in {2}", 'vf', self.args, len(matcher), server,
+                datetime.datetime.now() - start)
+            if changes == self.names_version(server):
+                self.matchers[server] = matcher
+        return matcher
+
+    async def alias_table(self, server):
+        """Returns the AliasTable for <server>, building it on first use"""
+        server = str(server)
+        table = self.alias_tables.get(server)
+        if table is None:
+            changes = self.names_version(server)
+            table = AliasTable.build(*await self.guild_names(server))
+            if table.cycles:
+                log("def alias_table: aliases on {0} that loop: {1}", 'vf', self.args, server, sorted(table.cycles))
+            if changes == self.names_version(server):
+                self.alias_tables[server] = table
+        return table
+
+    def names_version(self, server):
+        """Returns a token that changes whenever <server>'s characters or aliases do"""
+        return self.all_name_changes, self.name_changes.get(str(server), 0)
+
+    def update_names(self, server, added=(), removed=()):
+        """Called whenever characters or aliases on <server> come or go. Drops the server's cached listings of the kinds
+        that changed and applies the changes to its matcher, if that has been built, instead of rebuilding it.
+        <added> holds (kind, name, character) tuples and <removed> holds (kind, name) tuples"""
+        self.name_changes[str(server)] = self.name_changes.get(str(server), 0) + 1
+        for kind in {change[0] for change in list(added) + list(removed)}:
+            self.listing_cache.invalidate(make_key(kind, server))
+        table = self.alias_tables.get(str(server))
+        if table is not None:
+            for kind, name in removed:
+                if kind == CharacterMatcher.ALIAS:
+                    table.remove_alias(name)
+                else:
+                    table.remove_character(name)
+            for kind, name, character in added:
+                if kind == CharacterMatcher.ALIAS:
+                    table.set_alias(name, character)
+                else:
+                    table.add_character(name)
+        matcher = self.matchers.get(str(server))
+        if matcher is not None:
+            matcher.update(added, removed)
+
+    def forget_names(self, server=None):
+        """Drops <server>'s alias table, matcher and listings, or every server's, to be rebuilt on next use. For changes
+        too big to apply one at a time"""
+        if server is None:
+            self.all_name_changes += 1
+            self.alias_tables.clear()
+            self.matchers.clear()
+            self.listing_cache.clear()
+        else:
+            self.name_changes[str(server)] = self.name_changes.get(str(server), 0) + 1
+            self.alias_tables.pop(str(server), None)
+            self.matchers.pop(str(server), None)
+            for kind in (CharacterMatcher.CHARACTER, CharacterMatcher.ALIAS):
+                self.listing_cache.invalidate(make_key(kind, server))
+
+    async def channel_watch_list(self, server):
+        try:
+            return self.watched_channels[server]
+        except KeyError:
+            channels = await self.storage.watched_channels(server)
+            self.watched_channels[server] = channels
+            return channels
+
+    @commands.command(name="autonotify")
+    @commands.has_permissions(manage_guild=True)
+    async def auto_notify(self, ctx, enabled: bool):
+        """Turns automatic notices on or off for this channel, e.g. autonotify on. While on, every message posted here
+        is checked for known characters and aliases and their notices go out without anyone using its.
+        Only usable by people with the Manage Server permission or the bot owner"""
+        channels = await self.channel_watch_list(ctx.guild.id)
+        if enabled:
+            await self.storage.watch_channel(ctx.guild.id, ctx.channel.id)
+            channels.add(ctx.channel.id)
+            self.reply(ctx, "OK, I'll send notices for characters posted in this channel from now on.")
+        else:
+            await self.storage.unwatch_channel(ctx.guild.id, ctx.channel.id)
+            channels.discard(ctx.channel.id)
+            self.reply(ctx, "OK, I'll only send notices in this channel when someone uses `{0}its`.".format(
+                ctx.bot.command_prefix))
+
+    @commands.command(name="rolenotify")
+    @commands.has_permissions(manage_guild=True)
+    @commands.bot_has_permissions(manage_roles=True)
+    async def role_notify(self, ctx, enabled: bool):
+        """Turns role notices on or off for this server, e.g. rolenotify on. While on, everyone signed up for a
+        character is given a role for it, and its pings the role once instead of every subscriber. Turning them off
+        deletes the roles again. Only usable by people with the Manage Server permission or the bot owner"""
+        servers = await self.role_mode_servers()
+        await self.storage.set_role_mode(ctx.guild.id, enabled)
+        if enabled:
+            servers.add(str(ctx.guild.id))
+            await self.reconcile_server(ctx.guild.id)
+            self.reply(ctx, "OK, everyone signed up for a character gets a role for it, and its pings the role from "
+                            "now on. Handing out the roles can take a while on a busy server.")
+        else:
+            servers.discard(str(ctx.guild.id))
+            deleted = await self.role_queue.clear(ctx.guild.id)
+            self.reply(ctx, "OK, I'll ping everyone by name again and delete the {0} roles I made.".format(deleted))
 
     # command that uses the assigned name as the command name instead of the function
-    # also uses a cooldown to prevent overuse (in this case, 1 command every 60 seconds per server)
     @commands.command(name="knownwaifus")
-    @commands.cooldown(1, 60, type=commands.BucketType.guild)
-    async def known_waifus(self, ctx):
-        """Lists the waifus known by the bot for this server. Has a cooldown of 60 seconds as this is a potentially time consuming request"""
-        start = datetime.datetime.now()
-        # running the .keys() function on shelf object is time consuming. We're going to measure the time it took
-        async with ctx.typing():
-            waifus = list(self.notify_user_list.keys())
-            waifus = sorted(waifus)
-            end = datetime.datetime.now()
-            waifu_list = 'I know of the following waifus: '
-            for waifu in waifus:
-                # split the returned value into (<server>, \, <character>)
-                waifu_t = waifu.partition("\\")
-                if waifu_t[0] != str(ctx.guild.id):
-                    # if the server doesn't match the current server for this command, skip it
-                    pass
-                else:
-                    waifu_list += waifu_t[2] + ', '
-            log("def known_waifus: time elapsed: {0}".format(end - start), 'vf', self.args)
-            results = discord_split(waifu_list)
-            for result in results:
-                await ctx.send(result, delete_after=300)
+    async def known_waifus(self, ctx, *, query=None):
+        """Lists the waifus known by the bot for this server, one page at a time.
+        knownwaifus [page] - shows that page of the list
+        knownwaifus <letters> - only shows waifus whose names start with <letters>
+        knownwaifus next/previous - moves on from the page you last looked at"""
+        await self.send_listing(ctx, CharacterMatcher.CHARACTER, query)
 
     @commands.command(name="knownaliases")
-    @commands.cooldown(1, 60, type=commands.BucketType.guild)
-    async def known_aliases(self, ctx):
-        """Returns a list of all known aliases for this server. Has a cooldown of 60 seconds as this is a potentially time consuming request"""
-        current_server = str(ctx.guild.id)
+    async def known_aliases(self, ctx, *, query=None):
+        """Lists the aliases known by the bot for this server, one page at a time.
+        knownaliases [page] - shows that page of the list
+        knownaliases <letters> - only shows aliases starting with <letters>
+        knownaliases next/previous - moves on from the page you last looked at"""
+        await self.send_listing(ctx, CharacterMatcher.ALIAS, query)
+
+    async def listing(self, server, kind):
+        """Returns the sorted listing of <server>'s characters or aliases (by <kind>, as in CharacterMatcher) as a pair of
+        lists: case folded sort keys, and the lines to show. Cached until the server's names of that kind change"""
+        listing_key = make_key(kind, server)
+        try:
+            return self.listing_cache.get(listing_key)
+        except KeyError:
+            pass
+        token = self.listing_cache.token()
         start = datetime.datetime.now()
-        async with ctx.typing():
-            aliases = list(self.character_aliases.keys())
-            aliases = sorted(aliases)
-            end = datetime.datetime.now()
-            alias_list = "I know of the following aliases: \n"
-            for alias in aliases:
-                alias_t = alias.partition('\\')  # returns a tuple of <server id>, \, and <alias>
-                if alias_t[0] != current_server:
-                    pass
-                else:
-                    alias_list += alias_t[2] + " (refers to "
-                    alias_list += str(self.character_aliases[alias]) + ")\n"
-            log("def known_aliases: time elapsed: {0}".format(end - start), 'vf', self.args)
-            results = discord_split(alias_list)
-            for result in results:
-                await ctx.send(result, delete_after=300)
+        if kind == CharacterMatcher.CHARACTER:
+            lines = {character: character for character in await self.storage.characters(server)}
+        else:
+            aliases = await self.storage.aliases(server)
+            lines = {alias: alias + " (refers to " + str(aliases[alias]) + ")" for alias in aliases}
+        ordered = sorted(lines, key=lambda name: (name.casefold(), name))
+        listing = ([name.casefold() for name in ordered], [lines[name] for name in ordered])
+        log("def listing: built {0} listing for {1} in {2}", 'vf', self.args, kind, server,
+            datetime.datetime.now() - start)
+        self.listing_cache.put(listing_key, listing, token)
+        return listing
+
+    async def send_listing(self, ctx, kind, query):
+        """Helper for known_waifus() and known_aliases() that replies with one page of the listing"""
+        # where each user last was in each listing, so next and previous work without repeating the filter
+        cursor_key = (ctx.guild.id, ctx.author.id, kind)
+        prefix, page = '', 1
+        query = (query or '').strip()
+        if query.lower() in ('next', 'previous', 'prev'):
+            try:
+                prefix, page = self.listing_cursors.get(cursor_key)
+            except KeyError:
+                prefix, page = '', 0
+            page += 1 if query.lower() == 'next' else -1
+        elif query.isdigit():
+            page = int(query)
+        else:
+            # names can have digits in them, so anything other than a lone number is taken as the start of a name
+            prefix = query.casefold()
+        keys, lines = await self.listing(ctx.guild.id, kind)
+        # the listing is sorted, so the names starting with prefix are one contiguous run found by binary search
+        first = bisect_left(keys, prefix) if prefix else 0
+        last = bisect_left(keys, prefix + '\U0010ffff') if prefix else len(keys)
+        page_size = LISTING_PAGE_SIZE[kind]
+        pages = max(1, -(-(last - first) // page_size))
+        page = min(max(page, 1), pages)
+        self.listing_cursors.put(cursor_key, (prefix, page))
+        what = "waifus" if kind == CharacterMatcher.CHARACTER else "aliases"
+        if first == last:
+            self.reply(ctx, "I don't know of any {0}{1}".format(
+                what, " starting with {0}".format(prefix) if prefix else ""), delete_after=300)
+            return
+        start = first + (page - 1) * page_size
+        header = "I know of the following {0}{1} (page {2} of {3}): \n".format(
+            what, " starting with {0}".format(prefix) if prefix else "", page, pages)
+        footer = ""
+        if page < pages:
+            footer = "\nUse `{0}known{1} next` for the next page".format(ctx.bot.command_prefix, what)
+        separator = ', ' if kind == CharacterMatcher.CHARACTER else '\n'
+        for result in chunk_messages(lines[start:min(start + page_size, last)], separator, header=header, footer=footer):
+            self.reply(ctx, result, delete_after=300)
 
     @commands.command(name="doyouknow")
     async def do_you_know(self, ctx, *, character):
         """Confirms if the bot knows of a particular <character>."""
-        sender = ctx.author.mention
-        resolved_character = str(self.resolve_server_alias(ctx, character.title()))
+        resolved_character = str(await self.resolve_server_alias(ctx, character.title()))
         # keys are entered into DB as <server>\<character> and Python strings use \ as an escape character, so a
         # literal "\" requires "\\". Other delimiters were tried, but failed
         notice_key = str(ctx.guild.id) + "\\" + resolved_character
         try:
-            if notice_key in self.notify_user_list:
-                log("def do_you_know: notice key found: {0}".format(notice_key), 'vf', self.args)
-                if sender in self.notify_user_list[notice_key]:
-                    log("def do_you_know: sender on notice list", 'vf', self.args)
-                    await ctx.send(
-                        "Yes, I know of {0} and you're all set to hear when they get posted next!".format(
-                            resolved_character))
-                else:
-                    log("def do_you_know: sender not on notice list", 'vf', self.args)
-                    await ctx.send(
-                        "Yes, I know of {0}! I don't see you signed up for notices for them. Sign up with `{1}notifyme {0}`".format(
-                            resolved_character, ctx.bot.command_prefix))
+            notify_users = await self.cached_subscribers(ctx.guild.id, resolved_character)
+            log("def do_you_know: notice key found: {0}", 'vf', self.args, notice_key)
+            if ctx.author.id in notify_users:
+                log("def do_you_know: sender on notice list", 'vf', self.args)
+                self.reply(ctx,
+                    "Yes, I know of {0} and you're all set to hear when they get posted next!".format(
+                        resolved_character))
             else:
-                await ctx.send(
-                    "No, I don't have anything on {0}! Sign up with `{1}notifyme {0}`".format(resolved_character,
-                                                                                              ctx.bot.command_prefix))
+                log("def do_you_know: sender not on notice list", 'vf', self.args)
+                self.reply(ctx,
+                    "Yes, I know of {0}! I don't see you signed up for notices for them. Sign up with `{1}notifyme {0}`".format(
+                        resolved_character, ctx.bot.command_prefix))
         except KeyError:
-            log("def do_you_know: notice key not found: {0}".format(notice_key), 'vf', self.args)
-            await ctx.send("No, I don't have anything on {0}! Sign up with `{1}notifyme {0}`".format(resolved_character,
-                                                                                                     ctx.bot.command_prefix))
+            log("def do_you_know: notice key not found: {0}", 'vf', self.args, notice_key)
+            self.reply(ctx, "No, I don't have anything on {0}! Sign up with `{1}notifyme {0}`".format(
+                resolved_character, ctx.bot.command_prefix))
 
     # no decorator because this is an internal helper function
-    def resolve_server_alias(self, ctx, character):
+    async def resolve_server_alias(self, ctx, character):
         """Internal command to help resolve an input <character> with any existing aliases.
-        If <character> matches an existing alias, returns the character the alias refers to.
-        If <character> does not match an alias, returns <character>"""
-        current_server = str(ctx.guild.id)
-        check_alias = current_server + '\\' + character
-        log("def resolve_server_alias: check_alias: " + check_alias, 'vf', self.args)
-        resolved_character = ''
+        If <character> matches an existing alias, returns the character the alias refers to, following aliases of
+        aliases. If <character> names a known character in any case, returns it as stored. Otherwise returns <character>"""
+        table = await self.alias_table(ctx.guild.id)
+        resolved_character = table.resolve(character)
+        log("def resolve_server_alias: {0} resolved to {1}", 'vf', self.args, character, resolved_character)
+        return character if resolved_character is None else resolved_character
+
+    async def resolve_server_aliases(self, ctx, characters):
+        """Batch version of resolve_server_alias. Resolves every name in <characters> and returns the results in the same
+        order"""
+        table = await self.alias_table(ctx.guild.id)
+        resolved = [table.resolve(character) for character in characters]
+        return [character if found is None else found for character, found in zip(characters, resolved)]
+
+    async def cached_subscribers(self, server, character):
+        """Internal helper that returns the users signed up for <character> on <server>, through the subscriber cache.
+        Raises KeyError if the character is unknown"""
+        notice_key = make_key(server, character)
         try:
-            # if we find that <character> refers to an alias in our character aliases, return the character referred to
-            # by that alias. If this fails, it throws a KeyError, caught below
-            full_character = self.character_aliases[check_alias]
-            log("def resolve_server_alias: full_character: {0}".format(full_character), 'vf', self.args)
-            resolved_character = full_character.replace(current_server, '')
-            log("def resolve_server_alias: resolved_character: " + resolved_character, 'vf', self.args)
+            notify_users = self.subscriber_cache.get(notice_key)
         except KeyError:
-            # if we don't find any aliases, just return the character
-            resolved_character = character
-        log("def resolve_server_alias: post character: " + character, 'vf', self.args)
-        log("def resolve_server_alias: post resolved_character: " + resolved_character, 'vf', self.args)
-        log("def resolve_server_alias: post check_alias: " + check_alias, 'vf', self.args)
-        return resolved_character
+            token = self.subscriber_cache.token()
+            try:
+                # a tuple, so nothing holding on to a cached entry can change it
+                notify_users = tuple(await self.storage.subscribers(server, character))
+            except KeyError:
+                notify_users = None  # unknown characters get cached too
+            self.subscriber_cache.put(notice_key, notify_users, token)
+        if notify_users is None:
+            raise KeyError(notice_key)
+        return notify_users
+
+    async def cached_subscribers_many(self, server, characters):
+        """Batch version of cached_subscribers. Returns a dict of each known character in <characters> mapped to its
+        users, fetching everything the cache doesn't have with a single storage call"""
+        found = {}
+        missing = []
+        for character in characters:
+            try:
+                notify_users = self.subscriber_cache.get(make_key(server, character))
+            except KeyError:
+                missing.append(character)
+                continue
+            if notify_users is not None:
+                found[character] = notify_users
+        if missing:
+            token = self.subscriber_cache.token()
+            fetched = await self.storage.subscribers_many(server, missing)
+            for character in missing:
+                notify_users = fetched.get(character)
+                if notify_users is not None:
+                    notify_users = tuple(notify_users)
+                    found[character] = notify_users
+                self.subscriber_cache.put(make_key(server, character), notify_users, token)
+        return found
 
     @commands.command(name="notifyme")
     async def notify_me(self, ctx, *, character):
         """Adds the user to the list of people to notified when <character> is posted with the 'its' command. <character> can be an alias"""
-        await ctx.send(self.notify(ctx, character))
+        self.reply(ctx, await self.notify(ctx, character))
 
     @commands.command(name="multinotify")
     async def notify_multiple(self, ctx, *characters):
         """Adds the user to the list of characters, specified as <"character 1", "character 2", ... "character n"> """
-        confirmed_notices = ''
-        for character in characters:
-            confirmed_notices = confirmed_notices + self.notify(ctx, character)
-        results = discord_split(confirmed_notices)
-        for result in results:
-            await ctx.send(result)
+        resolved_characters = list(dict.fromkeys(
+            await self.resolve_server_aliases(ctx, [character.title() for character in characters])))
+        notice_keys = [make_key(ctx.guild.id, character) for character in resolved_characters]
+        log("def notify_multiple: {0}", 'vf', self.args, notice_keys)
+        # every sign up is written in one storage call, holding the locks for all of the characters at once
+        async with self.storage.locks(*notice_keys):
+            added, created = await self.storage.add_subscriber_many(ctx.guild.id, resolved_characters, ctx.author.id)
+            self.subscriber_cache.invalidate(*notice_keys)
+        if created:
+            self.update_names(ctx.guild.id, added=[(CharacterMatcher.CHARACTER, character, character)
+                                                     for character in resolved_characters if character in created])
+        if await self.role_mode(ctx.guild.id):
+            self.role_queue.give(ctx.guild.id, ctx.author.id,
+                                 [character for character in resolved_characters if added[character]])
+        confirmed_notices = [self.notify_message(ctx, character, added[character]) for character in resolved_characters]
+        for result in chunk_messages(confirmed_notices, ''):
+            self.reply(ctx, result)
 
-    def notify(self, ctx, character):
+    async def notify(self, ctx, character):
         sender = ctx.author.mention
-        log("def notify: {0}".format(sender), 'vf', self.args)
-        log("def notify: guild: " + str(ctx.guild), 'vf', self.args)
-        log("def notify: guild id: " + str(ctx.guild.id), 'vf', self.args)
-        resolved_character = str(self.resolve_server_alias(ctx, character.title()))
+        log("def notify: {0}", 'vf', self.args, sender)
+        log("def notify: guild: {0}", 'vf', self.args, ctx.guild)
+        log("def notify: guild id: {0}", 'vf', self.args, ctx.guild.id)
+        resolved_character = str(await self.resolve_server_alias(ctx, character.title()))
         notice_key = str(ctx.guild.id) + "\\" + resolved_character
-        log("def notify: " + notice_key, 'vf', self.args)
-        current_notices = [None]
-        try:
-            current_notices = self.notify_user_list[notice_key]
-            log("def notify: key found, current notices: " + str(current_notices), 'vf', self.args)
-            if sender in current_notices:
-                return str("You've already signed up for notices for {0}, {1}\n".format(resolved_character, sender))
-            current_notices.append(sender)
-        except KeyError:
-            current_notices[0] = sender
-            log("def notify: key not found, current notices: " + str(current_notices), 'vf', self.args)
-        self.notify_user_list[notice_key] = current_notices
-        return str('Thanks {0}, you\'ve successfully been added to the notice list for {1}\n'.format(sender,
-                                                                                                     resolved_character))
+        log("def notify: {0}", 'vf', self.args, notice_key)
+        async with self.storage.locks(notice_key):
+            added, created = await self.storage.add_subscriber(ctx.guild.id, resolved_character, ctx.author.id)
+            self.subscriber_cache.invalidate(notice_key)
+        if created:
+            self.update_names(ctx.guild.id,
+                                added=[(CharacterMatcher.CHARACTER, resolved_character, resolved_character)])
+        if added and await self.role_mode(ctx.guild.id):
+            self.role_queue.give(ctx.guild.id, ctx.author.id, [resolved_character])
+        return self.notify_message(ctx, resolved_character, added)
+
+    @staticmethod
+    def notify_message(ctx, character, added):
+        sender = ctx.author.mention
+        if not added:
+            return str("You've already signed up for notices for {0}, {1}\n".format(character, sender))
+        return str('Thanks {0}, you\'ve successfully been added to the notice list for {1}\n'.format(sender, character))
 
     @commands.command(name="alias")
     async def add_alias(self, ctx, alias, character):
         """Assign an alias to a character, see notes.
         alias "<alias>" "<character>" - The "alias" is the new way to refer to "character".
         "Character" is the original notice assignment. Using quotes (") is key, otherwise the bot will not parse the characters correctly"""
-        log("def add_alias: alias: " + alias, 'vf', self.args)
-        log("def add_alias: character: " + character, 'vf', self.args)
+        log("def add_alias: alias: {0}", 'vf', self.args, alias)
+        log("def add_alias: character: {0}", 'vf', self.args, character)
         current_server = str(ctx.guild.id)
         sender = ctx.author.mention
         new_alias = current_server + '\\' + alias.title()
-        try:
-            existing_alias = self.character_aliases[new_alias]
-            if existing_alias:
-                await ctx.send("{0} is already referenced by alias {1}, {2}".format(existing_alias, new_alias, sender))
-            else:
-                raise KeyError
-        except KeyError:
-            self.character_aliases[new_alias] = character
-            await ctx.send(
-                "OK, notices for {0} will triggered if someone uses `its {1}` from now on.".format(character, alias))
+        table = await self.alias_table(current_server)
+        # holding the alias' lock between the check and the write means two people can't both claim the same alias. The
+        # table is updated before the lock is let go, so it always has what the last holder wrote
+        async with self.storage.locks(make_key('alias', normalize(alias))):
+            existing_alias = table.alias(alias)
+            existing_character = table.character(alias)
+            # stored as the character it ends up at, so the alias works however <character> was capitalized and never
+            # starts a chain. A name nothing is known by yet is stored the way notifyme would create it
+            target = table.resolve(character)
+            if target is None:
+                target = character.title()
+            # a target that is an alias caught in a loop, or that resolves back to this alias, would make a loop
+            looping = (table.alias(character) is not None and table.resolve(character) is None) or \
+                normalize(target) == normalize(alias)
+            if existing_alias is None and existing_character is None and not looping:
+                await self.storage.set_alias(current_server, alias.title(), target)
+                self.update_names(current_server, added=[(CharacterMatcher.ALIAS, alias.title(), target)])
+        if existing_alias is not None:
+            self.reply(ctx, "{0} is already referenced by alias {1}, {2}".format(existing_alias[1], existing_alias[0],
+                                                                                sender))
+        elif existing_character is not None:
+            self.reply(ctx, "{0} is already a character, so it can't be an alias too, {1}".format(existing_character,
+                                                                                                  sender))
+        elif looping:
+            self.reply(ctx, "{0} leads back to {1}, so it can't be an alias of it, {2}".format(character, alias, sender))
+        else:
+            self.reply(ctx,
+                "OK, notices for {0} will triggered if someone uses `its {1}` from now on.".format(target, alias))
 
     @commands.command(name="stopnotify")
     async def stop_notify(self, ctx, *, character):
         """Removes the user to the list of people to notified when <character> is posted with the 'its' command.
         Only removes the user from that character's notices."""
         sender = ctx.author.mention
-        notice_key = str(ctx.guild.id) + "\\" + str(self.resolve_server_alias(ctx, character.title()))
-        current_notices = [None]
+        resolved_character = str(await self.resolve_server_alias(ctx, character.title()))
+        log("def stop_notify: {0}", 'vf', self.args, resolved_character)
         try:
-            current_notices = self.notify_user_list[notice_key]
-            log("def stop_notify: {0}".format(current_notices), 'vf', self.args)
-            current_notices.remove(sender)
-            self.notify_user_list[notice_key] = current_notices
+            async with self.storage.locks(make_key(ctx.guild.id, resolved_character)):
+                removed = await self.storage.remove_subscriber(ctx.guild.id, resolved_character, ctx.author.id)
+                self.subscriber_cache.invalidate(make_key(ctx.guild.id, resolved_character))
         except KeyError:
-            await ctx.send(
+            self.reply(ctx,
                 "I don't show that anyone signed up for notices regarding {0}, {1}".format(character, sender))
             return
-        except ValueError:
-            await ctx.send(
+        if not removed:
+            self.reply(ctx,
                 "I don't show that you're signed up for notices regarding {0}, {1}".format(character, sender))
             return
-        await ctx.send(
+        if await self.role_mode(ctx.guild.id):
+            self.role_queue.take(ctx.guild.id, ctx.author.id, [resolved_character])
+        self.reply(ctx,
             "Thanks, {0}, you've successfully been removed from the notice list for {1}".format(sender, character))
 
     @commands.command(name="removealias")
     async def remove_alias(self, ctx, *, character):
         """Removes the alias referenced by <character>. Usable by any member of a server"""
-        notice_key = str(ctx.guild.id) + '\\' + character
+        table = await self.alias_table(ctx.guild.id)
         try:
-            del self.character_aliases[notice_key]
+            async with self.storage.locks(make_key('alias', normalize(character))):
+                existing_alias = table.alias(character)
+                if existing_alias is None:
+                    raise KeyError(character)
+                # removed under the name it was stored as, however it was typed here
+                await self.storage.remove_alias(ctx.guild.id, existing_alias[0])
+                self.update_names(ctx.guild.id, removed=[(CharacterMatcher.ALIAS, existing_alias[0])])
         except KeyError:
-            await ctx.send("I don't have an alias for {0}".format(character))
-        await ctx.send("The alias for {0} has been removed.".format(notice_key))
+            self.reply(ctx, "I don't have an alias for {0}".format(character))
+            return
+        self.reply(ctx, "The alias for {0} has been removed.".format(make_key(ctx.guild.id, existing_alias[0])))
 
     @commands.command(name="removewaifu")
     @commands.has_permissions(manage_guild=True)
     async def remove_waifu(self, ctx, *, character):
         """Removes the alias referenced by <character>.
         Only usable by people with the Manage Server permission or the bot owner"""
+        character = (await self.alias_table(ctx.guild.id)).character(character) or character
         notice_key = str(ctx.guild.id) + '\\' + character
         try:
-            del self.notify_user_list[notice_key]
+            async with self.storage.locks(notice_key):
+                await self.storage.remove_character(ctx.guild.id, character)
+                self.subscriber_cache.invalidate(notice_key)
+                self.update_names(ctx.guild.id, removed=[(CharacterMatcher.CHARACTER, character)])
         except KeyError:
-            await ctx.send("I don't have a character by the name of {0}".format(character))
-        await ctx.send("The character {0} has been removed.".format(notice_key))
+            self.reply(ctx, "I don't have a character by the name of {0}".format(character))
+        if await self.role_mode(ctx.guild.id):
+            await self.reconcile_server(ctx.guild.id)
+        self.reply(ctx, "The character {0} has been removed.".format(notice_key))
 
     @commands.command(name="renamewaifu")
     @commands.has_permissions(manage_guild=True)
     async def rename_waifu(self, ctx, character, new_name):
         """Renames the character referred to by <character> to <new name>.
         Only usable by people with the Manage Server permission or the bot owner"""
+        table = await self.alias_table(ctx.guild.id)
+        character = table.character(character) or character
         notice_key = str(ctx.guild.id) + '\\' + character
         new_key = str(ctx.guild.id) + '\\' + new_name
         try:
-            self.notify_user_list[new_key] = self.notify_user_list.pop(notice_key)
+            async with self.storage.locks(notice_key, new_key):
+                await self.storage.rename_character(ctx.guild.id, character, new_name)
+                self.subscriber_cache.invalidate(notice_key, new_key)
+                # aliases of the old name follow it to the new one
+                moved_aliases = table.referring_aliases(character)
+                for alias in moved_aliases:
+                    await self.storage.set_alias(ctx.guild.id, alias, new_name)
+                self.update_names(ctx.guild.id, added=[(CharacterMatcher.CHARACTER, new_name, new_name)] +
+                                  [(CharacterMatcher.ALIAS, alias, new_name) for alias in moved_aliases],
+                                  removed=[(CharacterMatcher.CHARACTER, character)])
         except KeyError:
-            await ctx.send("I don't have a character by the name of {0}".format(character))
-        await ctx.send("The character {0} has been renamed to {1}.".format(notice_key, new_key))
+            self.reply(ctx, "I don't have a character by the name of {0}".format(character))
+        if await self.role_mode(ctx.guild.id):
+            # the subscribers move to a role with the new name, and the old role goes
+            await self.reconcile_server(ctx.guild.id)
+        self.reply(ctx, "The character {0} has been renamed to {1}.".format(notice_key, new_key))
 
     @commands.command(name="stopall")
-    # only allow the command to be run once every 60 seconds on each server this bot is in
-    @commands.cooldown(1, 30, type=commands.BucketType.guild)
     async def stop_all_notices(self, ctx):
-        """Stops all notices on this server for the user. Causes the command to enter a 30 second cooldown
-        and the bot shows it is typing while running as it is a potentially slow operation"""
-        async with ctx.typing():
-            sender = ctx.author.mention
-            notify_keys = list(self.notify_user_list.keys())
-            halt_keys = []
-            log("def stop_all_notices: stop_all_notices invoked by {0}".format(sender), 'vf', self.args)
-            for key in notify_keys:
-                log("def stop_all_notices: " + str(key), 'vf', self.args)
-                if sender in self.notify_user_list[key]:
-                    log("def stop_all_notices: " + str(self.notify_user_list[key]), 'vf', self.args)
-                    current_notices = self.notify_user_list[key]
-                    log("def stop_all_notices: {0}".format(current_notices), 'vf', self.args)
-                    current_notices.remove(sender)
-                    self.notify_user_list[key] = current_notices
-                    halt_keys.append(key)
-            end_msg = "Notices ended for the following characters: \n"
-            for key in halt_keys:
-                key_ns = str(key).partition('\\')[2]
-                end_msg += key_ns + " "
-            await ctx.send(end_msg)
+        """Stops all notices on this server for the user"""
+        sender = ctx.author.mention
+        log("def stop_all_notices: stop_all_notices invoked by {0}", 'vf', self.args, sender)
+        halt_characters = sorted(await self.storage.remove_user(ctx.guild.id, ctx.author.id))
+        self.subscriber_cache.invalidate(*[make_key(ctx.guild.id, character) for character in halt_characters])
+        if await self.role_mode(ctx.guild.id):
+            self.role_queue.take(ctx.guild.id, ctx.author.id, halt_characters)
+        for end_msg in chunk_messages(halt_characters, ' ', header="Notices ended for the following characters: \n"):
+            self.reply(ctx, end_msg)
 
     @commands.command(name="mynotices")
-    @commands.cooldown(1, 30, type=commands.BucketType.guild)
     async def my_notices(self, ctx):
-        """Lists all notices on this server for the user. Causes the command to enter a 30 second cooldown
-        and the bot shows it is typing while running as it is a potentially slow operation"""
-        async with ctx.typing():
-            sender = ctx.author.mention
-            notify_keys = list(self.notify_user_list.keys())
-            all_keys = []
-            log("def my_notices: my_notices invoked by {0}".format(sender), 'vf', self.args)
-            for key in notify_keys:
-                log("def my_notices: " + str(key), 'vf', self.args)
-                if sender in self.notify_user_list[key]:
-                    log("def my_notices: " + str(self.notify_user_list[key]), 'vf', self.args)
-                    all_keys.append(key)
-            end_msg = "You are signed up for notices for the following characters: \n"
-            all_keys = sorted(all_keys)
-            for key in all_keys:
-                key_ns = str(key).partition('\\')[2]
-                end_msg += key_ns + ", "
-            await ctx.send(end_msg)
+        """Lists all notices on this server for the user"""
+        sender = ctx.author.mention
+        log("def my_notices: my_notices invoked by {0}", 'vf', self.args, sender)
+        all_characters = sorted(await self.storage.user_characters(ctx.guild.id, ctx.author.id))
+        for end_msg in chunk_messages(all_characters, ', ',
+                                      header="You are signed up for notices for the following characters: \n"):
+            self.reply(ctx, end_msg)
 
     # this command can only be run by the owner (user who owns the API token under which this bot is running)
     @commands.command(name="debugusers")
@@ -368,70 +1063,273 @@ class Waifu(commands.Cog):
     async def debug_user_list(self, ctx):
         """An owner-only debug command that lists all users and notices. Suppresses @ mentions"""
         async with ctx.typing():
-            notify_keys = list(self.notify_user_list.keys())
-            log("def debug_user_list: " + str(notify_keys), 'vf', self.args)
-            user_list = ''
-            for key in notify_keys:
-                log("def debug_user_list: ".format(key), 'vf', self.args)
-                user_list += 'key: ' + key + ' user: ' + str(self.notify_user_list[key]) + '\n'
-            log("def debug_user_list: ".format(user_list), 'vf', self.args)
-            user_list = suppress_mentions(user_list)
-            await ctx.send(user_list)
+            user_lines = []
+            for server, character, users in await self.storage.all_notices():
+                key = make_key(server, character)
+                log("def debug_user_list: {0}", 'vf', self.args, key)
+                user_lines.append('key: ' + key + ' user: ' + str(list(users)))
+            for user_list in chunk_messages(user_lines, '\n'):
+                self.reply(ctx, suppress_mentions(user_list))
+
+    @commands.command(name="cachestats")
+    @commands.is_owner()
+    async def cache_stats(self, ctx):
+        """An owner-only debug command that shows hit and miss counts for the subscriber and listing caches"""
+        self.reply(ctx, "\n".join(cache.stats() for cache in (self.subscriber_cache, self.listing_cache)))
+
+    @commands.command(name="queuestats")
+    @commands.is_owner()
+    async def queue_stats(self, ctx):
+        """An owner-only debug command that shows how many messages are waiting to be sent and how long they wait, and
+        how many role changes are waiting"""
+        self.reply(ctx, self.send_queue.stats() + "\n" + self.role_queue.stats())
+
+    @commands.command(name="purgestats")
+    @commands.is_owner()
+    async def purge_stats(self, ctx):
+        """An owner-only debug command that shows how many departed servers and members are waiting to be purged, and
+        how much has been purged so far"""
+        self.reply(ctx, self.purges.stats())
+
+    @commands.command(name="stats")
+    @commands.is_owner()
+    async def stats(self, ctx):
+        """An owner-only debug command that shows command latency and errors, storage calls, event loop lag, caches and
+        the send queue"""
+        for message in chunk_messages(self.metrics.summary().split("\n"), "\n"):
+            self.reply(ctx, message)
+
+    @commands.command(name="profile")
+    @commands.is_owner()
+    async def profile(self, ctx, limit="20"):
+        """An owner-only debug command that profiles the next 20 commands (profile 50 for the next 50, profile 60s for
+        the next minute) and sends a summary here. profile stop ends it early. The full report goes to --profile-dir"""
+        limit = limit.lower()
+        if limit in ("stop", "off"):
+            if self.profiler.active:
+                await self.finish_profile()
+            else:
+                self.reply(ctx, "I'm not profiling anything right now")
+            return
+        if self.profiler.active:
+            self.reply(ctx, "I'm already profiling, use `{0}profile stop` to end it".format(ctx.bot.command_prefix))
+            return
+        count, seconds = None, None
+        try:
+            if limit.endswith('s'):
+                seconds = float(limit[:-1])
+            else:
+                count = int(limit)
+        except ValueError:
+            pass
+        if not (count or seconds) or (count or seconds) < 0:
+            self.reply(ctx, "Try `{0}profile 20` for the next 20 commands or `{0}profile 60s` for the next minute"
+                       .format(ctx.bot.command_prefix))
+            return
+        self.profile_ctx = ctx
+        self.profiler.start(count, seconds)
+        if seconds:
+            # a quiet minute has no command to notice the time is up, so a timer ends it too
+            self.profile_timer = asyncio.get_event_loop().call_later(
+                seconds, lambda: asyncio.ensure_future(self.finish_profile()))
+            self.reply(ctx, "Profiling every command for the next {0:g} seconds".format(seconds))
+        else:
+            self.reply(ctx, "Profiling the next {0} commands".format(count))
+
+    async def finish_profile(self):
+        """Ends the profile run, writes the full report and sends the summary to where the profile command was run"""
+        if not self.profiler.active:
+            return
+        if self.profile_timer is not None:
+            self.profile_timer.cancel()
+            self.profile_timer = None
+        report = self.profiler.stop()
+        path = os.path.join(self.args.profile_dir,
+                            "waifu-profile-{0}.txt".format(datetime.datetime.now().strftime("%Y%m%d-%H%M%S")))
+        try:
+            # pstats formatting takes a while for a long run, so it happens off the event loop
+            await asyncio.get_event_loop().run_in_executor(None, report.write, path)
+            footer = "full report in {0}".format(path)
+        except OSError as error:
+            footer = "couldn't write the full report to {0}: {1}".format(path, error)
+        log("def finish_profile: {0}", 'vf', self.args, footer)
+        for message in chunk_messages((report.summary() + "\n" + footer).split("\n"), "\n"):
+            self.reply(self.profile_ctx, suppress_mentions(message))
+
+    @commands.command(name="compact")
+    @commands.is_owner()
+    async def compact(self, ctx, drop_dangling: bool = False):
+        """An owner-only maintenance command that shrinks the storage files, drops notices nobody is signed up for and
+        reports aliases that lead to no character. compact yes also drops those aliases"""
+        if self.refuse_in_cluster(ctx):
+            return
+        self.reply(ctx, "Compacting storage, commands that need it will wait until this is done")
+        # runs on the storage thread, so the bot stays connected; storage calls made meanwhile queue up behind it
+        start = datetime.datetime.now()
+        report = await self.storage.compact(drop_dangling)
+        self.subscriber_cache.clear()
+        self.watched_channels.clear()
+        self.forget_names()
+        log("def compact: compaction took {0}:\n{1}", 'vf', self.args, datetime.datetime.now() - start, report)
+        for message in chunk_messages(str(report).split("\n"), "\n"):
+            self.reply(ctx, suppress_mentions(message))
 
     @commands.command(name="dropall")
     @commands.is_owner()
     async def drop_all(self, ctx):
         """**WARNING** Drops the full list of notices and aliases. Only usable by owner."""
-        self.notify_user_list.clear()
-        self.character_aliases.clear()
-        await ctx.send("Removed all notices and aliases")
+        if self.refuse_in_cluster(ctx):
+            return
+        await self.storage.clear_notices()
+        await self.storage.clear_aliases()
+        self.subscriber_cache.clear()
+        self.forget_names()
+        self.reply(ctx, "Removed all notices and aliases")
 
     @commands.command(name="droptablenotices")
     @commands.is_owner()
     async def drop_all_notices(self, ctx):
         """**WARNING** Drops the full list of notices. Only usable by owner."""
-        self.notify_user_list.clear()
-        await ctx.send("Removed all notices")
+        if self.refuse_in_cluster(ctx):
+            return
+        await self.storage.clear_notices()
+        self.subscriber_cache.clear()
+        self.forget_names()
+        self.reply(ctx, "Removed all notices")
 
     @commands.command(name="droptablealiases")
     @commands.is_owner()
     async def drop_all_aliases(self, ctx):
         """**WARNING** Drops the full list of aliases. Only usable by owner."""
-        self.character_aliases.clear()
-        await ctx.send("Removed all aliases")
+        if self.refuse_in_cluster(ctx):
+            return
+        await self.storage.clear_aliases()
+        self.forget_names()
+        self.reply(ctx, "Removed all aliases")
 
     # only allows users who have the "Manage Server" permission to run (usually the server owner or admins/moderators)
     @commands.command(name="dropserver")
     @commands.has_permissions(manage_guild=True)
     async def drop_notices_server(self, ctx):
         """Drops all notices for this server only. Usable by the bot owner and users with the Manage Server permission."""
-        server = str(ctx.guild.id)
-        notify_keys = list(self.notify_user_list.keys())
-        for key in notify_keys:
-            if server in key:
-                del self.notify_user_list[key]
-        await ctx.send("Notices for {0} dropped".format(ctx.guild.name))
+        await self.storage.drop_server_notices(ctx.guild.id)
+        self.subscriber_cache.invalidate_prefix(make_key(ctx.guild.id, ''))
+        self.forget_names(ctx.guild.id)
+        if await self.role_mode(ctx.guild.id):
+            await self.reconcile_server(ctx.guild.id)
+        self.reply(ctx, "Notices for {0} dropped".format(ctx.guild.name))
 
     @commands.command(name="dropaliases")
     @commands.has_permissions(manage_guild=True)
     async def drop_aliases_server(self, ctx):
         """Drops all notices for this server only. Usable by the bot owner and users with the Manage Server permission."""
-        server = str(ctx.guild.id)
-        alias_keys = list(self.character_aliases.keys())
-        for key in alias_keys:
-            if server in key:
-                del self.character_aliases[key]
-        await ctx.send("Aliases for {0} dropped".format(ctx.guild.name))
+        await self.storage.drop_server_aliases(ctx.guild.id)
+        self.forget_names(ctx.guild.id)
+        self.reply(ctx, "Aliases for {0} dropped".format(ctx.guild.name))
+
+    @commands.command(name="export")
+    @commands.has_permissions(manage_guild=True)
+    async def export_server(self, ctx):
+        """Sends this server's notices, aliases and automatic notice channels as a JSON Lines file that import can load
+        again. Usable by the bot owner and users with the Manage Server permission."""
+        # written to a temporary file on the storage thread, so neither the records nor the file sit on the event loop
+        dump = tempfile.TemporaryFile()
+        text = io.TextIOWrapper(dump, encoding="utf-8")
+        counts = await self.storage.run(transfer.export_file, self.storage.storage, text, ctx.guild.id)
+        text.flush()
+        text.detach()
+        dump.seek(0)
+        self.reply(ctx, "Exported {0}".format(transfer.describe(counts)),
+                   file=discord.File(dump, "waifu-{0}.jsonl".format(ctx.guild.id)))
+
+    @commands.command(name="import")
+    @commands.has_permissions(manage_guild=True)
+    async def import_server(self, ctx):
+        """Loads an attached file made by export into this server, merging it with the notices and aliases already here.
+        Usable by the bot owner and users with the Manage Server permission."""
+        if not ctx.message.attachments:
+            self.reply(ctx, "Attach a file made by `{0}export` to import it".format(ctx.bot.command_prefix))
+            return
+        data = await ctx.message.attachments[0].read()
+        await self.import_records(ctx, io.BytesIO(data), ctx.guild.id)
+
+    @commands.command(name="exportall")
+    @commands.is_owner()
+    async def export_all(self, ctx, *, path="waifu-export.jsonl"):
+        """Writes every server's notices, aliases and automatic notice channels to a JSON Lines file on the bot's host.
+        Only usable by owner."""
+        def export_to(location):
+            with open(location, "w", encoding="utf-8") as output:
+                return transfer.export_file(self.storage.storage, output)
+        async with ctx.typing():
+            try:
+                counts = await self.storage.run(export_to, path)
+            except OSError as error:
+                self.reply(ctx, "Couldn't write {0}: {1}".format(path, error))
+                return
+        self.reply(ctx, "Exported {0} to {1}".format(transfer.describe(counts), path))
+
+    @commands.command(name="importall")
+    @commands.is_owner()
+    async def import_all(self, ctx, *, path="waifu-export.jsonl"):
+        """Loads a file made by exportall (or the offline transfer.py) from the bot's host, merging it with everything
+        already stored. Only usable by owner."""
+        if self.refuse_in_cluster(ctx):
+            return
+        try:
+            lines = open(path, "rb")
+        except OSError as error:
+            self.reply(ctx, "Couldn't read {0}: {1}".format(path, error))
+            return
+        with lines:
+            await self.import_records(ctx, lines)
+
+    async def import_records(self, ctx, lines, server=None):
+        """Imports the records in lines into server, or the servers they were exported from if None, one batch at a
+        time. Each batch is read and applied on the storage thread, and other commands get to run in between"""
+        records = transfer.read_records(lines)
+        totals = dict.fromkeys(transfer.COUNTS, 0)
+        tables = {}
+        finished = False
+        error = None
+        async with ctx.typing():
+            while not finished:
+                try:
+                    counts, finished = await self.storage.run(transfer.import_batch, self.storage.storage, records,
+                                                              server, transfer.IMPORT_BATCH, tables)
+                except ValueError as bad_record:
+                    error = bad_record
+                    finished = True
+                    counts = {}
+                for kind, count in counts.items():
+                    totals[kind] += count
+                if self.storage.dirty_count() >= self.args.flush_threshold:
+                    await self.flush_storage("import")
+                await asyncio.sleep(0)
+        # an import can touch any name, so everything cached for the servers involved gets looked up again
+        if server is None:
+            self.subscriber_cache.clear()
+            self.watched_channels.clear()
+        else:
+            self.subscriber_cache.invalidate_prefix(make_key(server, ''))
+            self.watched_channels.pop(server, None)
+        self.forget_names(server)
+        log("def import_records: imported {0} into {1}", 'vf', self.args, totals, server)
+        if error is not None:
+            # batches before the bad line are kept; importing again once it's fixed only adds what's missing
+            self.reply(ctx, "Stopped importing at {0}, after importing {1}".format(error, transfer.describe(totals)))
+        else:
+            self.reply(ctx, "Imported {0}".format(transfer.describe(totals)))
 
     # TODO: notifyall?
 
     @commands.command()
     async def wotd(self, ctx):
         """Prints the Waifu of the Day"""
-        log("def wotd: wotd invoked by " + str(ctx.author.mention), 'vf', self.args)
+        log("def wotd: wotd invoked by {0}", 'vf', self.args, ctx.author.mention)
         # TODO: implement admin/channel permissions for listing waifu on rotating schedule
 
-        await ctx.send("Astolfo, always")
+        self.reply(ctx, "Astolfo, always")
 
     """
     Below is the error handling code. Commands that generate errors won't run, and commands without error handlers
@@ -448,25 +1346,19 @@ class Waifu(commands.Cog):
     async def no_char_error(self, ctx, error):
         try:
             if isinstance(error, commands.MissingRequiredArgument):
-                await ctx.send(
+                self.reply(ctx,
                     "You need to supply a character for this command! Try `{0}help`".format(ctx.bot.command_prefix))
         except commands.errors.CommandInvokeError:
-            await ctx.send(
+            self.reply(ctx,
                 "You need to supply a character for this command! Try `{0}help`".format(ctx.bot.command_prefix))
 
-    @stop_all_notices.error
-    @known_aliases.error
-    @known_waifus.error
-    @my_notices.error
-    async def cooldown_error(self, ctx, error):
-        if await ctx.bot.is_owner(ctx.author):
-            # if the owner ran the command, ignore the cooldown and run the command again
-            await ctx.reinvoke()
-            return
-        if isinstance(error, commands.CommandOnCooldown):
-            await ctx.send("Uh oh, that command's on cooldown. Please wait a couple of minutes before trying again.")
-
     @debug_user_list.error
+    @cache_stats.error
+    @queue_stats.error
+    @purge_stats.error
+    @stats.error
+    @profile.error
+    @compact.error
     @drop_all.error
     @drop_all_aliases.error
     @drop_all_notices.error
@@ -475,6 +1367,12 @@ class Waifu(commands.Cog):
     @itsnn.error
     @remove_waifu.error
     @rename_waifu.error
+    @auto_notify.error
+    @role_notify.error
+    @export_server.error
+    @import_server.error
+    @export_all.error
+    @import_all.error
     async def perm_error(self, ctx, error):
         # we can handle two different permission errors here: a missing server permission (Manage Server) or not being
         # the bot's owner
@@ -483,13 +1381,22 @@ class Waifu(commands.Cog):
                 # if the owner ran the command, ignore the permissions and run the command again
                 await ctx.reinvoke()
                 return
-            await ctx.send("Uh oh. You need to have the {0} permission to use that command".format(error.missing_perms))
+            self.reply(ctx, "Uh oh. You need to have the {0} permission to use that command".format(error.missing_perms))
         if isinstance(error, commands.NotOwner):
-            await ctx.send("Uh on. This command is only usable by the bot's owner")  # indicate owner here?
+            self.reply(ctx, "Uh on. This command is only usable by the bot's owner")  # indicate owner here?
+        if isinstance(error, commands.BotMissingPermissions):
+            self.reply(ctx, "Uh oh. I need the {0} permission for that command".format(error.missing_perms))
 
     @add_alias.error
     async def quote_error(self, ctx, error):
         # the add_alias command requires that the character and alias be enclosed in quotes. If someone forgets, the
         # command fails.
         if isinstance(error, commands.ExpectedClosingQuoteError):
-            await ctx.send("Hey! I didn't see a closing quote for that command")
+            self.reply(ctx, "Hey! I didn't see a closing quote for that command")
+
+
+# a shared SQLite database (see cluster.py) can stay locked by another worker for longer than the busy timeout. The
+# loops go back to sleep and try again, as they do after a disconnect, instead of stopping for good
+for storage_loop in (Waifu.flush_db, Waifu.save_snapshot, Waifu.reconcile_roles, Waifu.sweep_departed,
+                     Waifu.purge_departed):
+    storage_loop.add_exception_type(sqlite3.OperationalError)
@@ -14,97 +14,199 @@ Licensed under MIT License, see LICENSE
 import argparse
 from discord.ext import commands
 import waifu
+import storage
+import eventlog
 from bothelper import log
+from bothelper import cluster_mode
+from bothelper import shutdown_logging
 from bothelper import read_token
 
-description = '''A bot that notifies users on command. Options to use roles instead of DB coming soon!(TM)'''
+description = '''A bot that notifies users on command, by mentioning them or (see rolenotify) a role'''
 default_token = None  # enter a default Discord API token here unless you want to supply one via file or argument
-discord_api_token = ''
-c_alias_loc = ''
-u_list_loc = ''
 
 parser = argparse.ArgumentParser()
 
 parser.add_argument("-f", "--file", help="load token from file")
 parser.add_argument("-t", "--token", help="specify token in arguments")
 parser.add_argument("-p", "--prefix", help="command prefix")
+parser.add_argument("-s", "--shards", help="total number of gateway shards to run (cluster mode, needs -b sqlite)",
+                    type=int)
+parser.add_argument("-n", "--processes", help="worker processes to spread the shards over (cluster mode)", type=int,
+                    default=1)
 # if -v is passed on command line, no need to add argument following
 parser.add_argument("-v", "--verbose", help="verbose mode (prints more info to terminal)", action="store_true")
 parser.add_argument("-c", "--character", help="file location for character alias shelf")
 parser.add_argument("-u", "--userlist", help="file location for user list shelf")
+parser.add_argument("-b", "--backend", help="storage engine for notices and aliases",
+                    choices=["shelve", "sqlite", "eventlog"], default="shelve")
+parser.add_argument("-d", "--database", help="file location for the SQLite database (sqlite backend only)")
+parser.add_argument("-e", "--eventlog", help="file location for the event log checkpoint, with the logs next to it "
+                                             "(eventlog backend only)")
+parser.add_argument("--compact-log-bytes", help="write an event log checkpoint and delete the logs it covers once they "
+                                                "reach this size", type=int, default=eventlog.COMPACT_BYTES)
+parser.add_argument("-m", "--migrate", help="copy the -c/-u shelves into an empty SQLite database or event log on "
+                                            "startup", action="store_true")
 parser.add_argument("-lf", "--log_file", help="file location for logging")
-args = parser.parse_args()
-
-if args.file:
-    file_token = read_token(args.file)  # try reading the supplied file token in, but if it fails, use default
-    if file_token is None:
-        if default_token:
-            discord_api_token = default_token
-            log("default token used: {0}".format(default_token), 'svf', args)
-        else:
-            print("no valid token supplied, exiting")
-            quit(1)
-    else:
-        discord_api_token = file_token
-        log("Loaded token from file: {0}".format(file_token), 'svf', args)
-elif args.token:
-    discord_api_token = args.token
-    log("using token from cli: {0}".format(args.token), 'svf', args)
-
-prefix = ''
-if args.prefix:
-    prefix = args.prefix
-else:
-    prefix = ';'
-
-if args.character:
-    c_alias_loc = args.character
-else:
-    c_alias_loc = 'aliases.test.db'
-
-if args.userlist:
-    u_list_loc = args.userlist
-else:
-    u_list_loc = 'userlist.test.db'
-
-bot = commands.Bot(command_prefix=prefix, description=description)
+parser.add_argument("--log-max-bytes", help="rotate the log file once it reaches this size", type=int,
+                    default=10 * 1024 * 1024)
+parser.add_argument("--log-backups", help="how many rotated log files to keep", type=int, default=3)
+parser.add_argument("--flush-interval", help="seconds between writing changed notices and aliases to disk", type=float,
+                    default=60)
+parser.add_argument("--flush-threshold", help="write changes to disk early once this many are waiting", type=int,
+                    default=100)
+parser.add_argument("--cache-size", help="most alias and subscriber lookups to keep cached", type=int, default=1024)
+parser.add_argument("--cache-ttl", help="seconds a cached alias or subscriber lookup stays valid", type=float,
+                    default=300)
+parser.add_argument("--flush-batch", help="how many changes to write before letting other commands run", type=int,
+                    default=50)
+parser.add_argument("--send-budget", help="most messages the bot sends to one channel per --send-window", type=int,
+                    default=5)
+parser.add_argument("--send-window", help="seconds over which --send-budget is counted", type=float, default=5.0)
+parser.add_argument("--notice-debounce", help="seconds during which a repeated notice only pings users the last one "
+                                              "didn't", type=float, default=10.0)
+parser.add_argument("--busy-timeout", help="seconds a SQLite write waits on another process before failing", type=float,
+                    default=30.0)
+parser.add_argument("--metrics-port", help="serve Prometheus metrics on http://127.0.0.1:PORT/metrics (in cluster mode, "
+                                           "worker N uses PORT+N)", type=int)
+parser.add_argument("--snapshot", help="file location for the snapshot of every server's names that makes restarts "
+                                       "fast (defaults to the user list or database location plus .snapshot)")
+parser.add_argument("--no-snapshot", help="don't read or write a snapshot", action="store_true")
+parser.add_argument("--profile-dir", help="directory the profile command writes its reports to", default=".")
+parser.add_argument("--role-budget", help="most role changes the bot makes on one server per --role-window", type=int,
+                    default=10)
+parser.add_argument("--role-window", help="seconds over which --role-budget is counted", type=float, default=10.0)
+parser.add_argument("--role-reconcile-interval", help="seconds between checking every role notice server's roles "
+                                                      "against its subscribers", type=float, default=3600.0)
+parser.add_argument("--purge-grace", help="seconds a server the bot left, or a member who left a server, keeps their "
+                                          "notices in case they come back", type=float, default=7 * 86400.0)
+parser.add_argument("--purge-batch", help="how many characters and aliases of a departed server to remove before "
+                                          "letting other commands run", type=int, default=100)
+parser.add_argument("--purge-sweep-interval", help="seconds between checking stored servers and members against the "
+                                                   "ones the bot can see", type=float, default=86400.0)
+parser.add_argument("--snapshot-interval", help="seconds between snapshots, taken only if any names changed",
+                    type=float, default=600.0)
 
 # TODO: channel config, possibly as class?
 # TODO: general documentation for contributors
 
 
-@bot.event
-async def on_ready():
-    try:
-        if args.log_file:
-            with(open(args.log_file, 'a')) as lf:
-                lf.truncate()
-    except OSError:
-        print("log file at {0} not found".format(args.log_file))
-    log('Logged in as', 'sf', args)
-    log(bot.user.name, 'sf', args)
-    log(bot.user.id, 'sf', args)
-    log('~~--~~--~~--~~', 'sf', args)
-
-
-@bot.command(name="off")
-@commands.is_owner()
-async def shutdown(ctx):
-    """**WARNING** Shuts down the bot. Only usable by owner"""
-    await ctx.send("OK, shutting down!")
-    ctx.bot.get_cog("Waifu").cog_unload()
-    await ctx.bot.close()
-    quit(0)
-
-
-@shutdown.error
-async def not_bot_owner(ctx, error):
-    if isinstance(error, commands.NotOwner):
-        await ctx.send("Uh on. This command is only usable by the bot's owner")
-
-
-bot.add_cog(waifu.Waifu(bot))
-bot.get_cog("Waifu").user_list_location = u_list_loc
-bot.get_cog("Waifu").character_alias_location = c_alias_loc
-bot.get_cog("Waifu").args = args
-bot.run(discord_api_token)
+def load_token(args):
+    """Returns the Discord API token from -f/--file, -t/--token or default_token, exiting if there is none"""
+    discord_api_token = ''
+    if args.file:
+        file_token = read_token(args.file)  # try reading the supplied file token in, but if it fails, use default
+        if file_token is None:
+            if default_token:
+                discord_api_token = default_token
+                log("default token used: {0}", 'svf', args, default_token)
+            else:
+                print("no valid token supplied, exiting")
+                quit(1)
+        else:
+            discord_api_token = file_token
+            log("Loaded token from file: {0}", 'svf', args, file_token)
+    elif args.token:
+        discord_api_token = args.token
+        log("using token from cli: {0}", 'svf', args, args.token)
+    return discord_api_token
+
+
+def resolve_locations(args):
+    """Fills in the default shelf and database locations for any the command line left out"""
+    if not args.character:
+        args.character = 'aliases.test.db'
+    if not args.userlist:
+        args.userlist = 'userlist.test.db'
+    if not args.database:
+        args.database = 'waifu.test.sqlite3'
+    if not args.eventlog:
+        args.eventlog = 'waifu.test.events'
+    if args.no_snapshot:
+        args.snapshot = None
+    elif not args.snapshot:
+        locations = {"sqlite": args.database, "eventlog": args.eventlog}
+        args.snapshot = locations.get(args.backend, args.userlist) + '.snapshot'
+
+
+def open_storage(args):
+    """Opens the storage engine chosen with -b/--backend, copying the shelves into it first if -m/--migrate was passed"""
+    if args.backend == "shelve":
+        return storage.ShelveStorage(args.userlist, args.character)
+    if args.backend == "sqlite":
+        # in cluster mode every worker process writes to the same database
+        shared = cluster_mode(args)
+        store, location = storage.SqliteStorage(args.database, args.busy_timeout, shared), args.database
+    else:
+        store, location = eventlog.EventLogStorage(args.eventlog, args.compact_log_bytes), args.eventlog
+        if store.replayed or store.discarded:
+            log("replayed {0} events from the event log, {1} bytes cut short left out", 'svf', args, store.replayed,
+                store.discarded)
+    if args.migrate:
+        if store.is_empty():
+            shelves = storage.ShelveStorage(args.userlist, args.character)
+            migrated = storage.migrate(shelves, store)
+            shelves.close()
+            log("migrated {0} notices and {1} aliases into {2}", 'svf', args, migrated[0], migrated[1], location)
+        else:
+            log("{0} already has data, skipping migration", 'svf', args, location)
+    return store
+
+
+def create_bot(args, store, shard_ids=None, shard_count=None):
+    """Builds the bot with the Waifu cog on store. With shard_count it is an AutoShardedBot running only shard_ids"""
+    prefix = args.prefix or ';'
+    if shard_count:
+        bot = commands.AutoShardedBot(command_prefix=prefix, description=description, shard_ids=shard_ids,
+                                      shard_count=shard_count)
+    else:
+        bot = commands.Bot(command_prefix=prefix, description=description)
+
+    @bot.event
+    async def on_ready():
+        try:
+            if args.log_file:
+                with(open(args.log_file, 'a')) as lf:
+                    lf.truncate()
+        except OSError:
+            print("log file at {0} not found".format(args.log_file))
+        log('Logged in as', 'sf', args)
+        log(bot.user.name, 'sf', args)
+        log(bot.user.id, 'sf', args)
+        if shard_count:
+            log("running shards {0} of {1}", 'sf', args, shard_ids, shard_count)
+        log('~~--~~--~~--~~', 'sf', args)
+
+    @bot.command(name="off")
+    @commands.is_owner()
+    async def shutdown(ctx):
+        """**WARNING** Shuts down the bot. Only usable by owner"""
+        await ctx.send("OK, shutting down!")
+        ctx.bot.get_cog("Waifu").cog_unload()
+        await ctx.bot.close()
+        shutdown_logging()
+        # in cluster mode, a worker exiting with 0 tells the supervisor to stop the others too
+        quit(0)
+
+    @shutdown.error
+    async def not_bot_owner(ctx, error):
+        if isinstance(error, commands.NotOwner):
+            await ctx.send("Uh on. This command is only usable by the bot's owner")
+
+    bot.add_cog(waifu.Waifu(bot, store, args))
+    return bot
+
+
+def main():
+    args = parser.parse_args()
+    resolve_locations(args)
+    discord_api_token = load_token(args)
+    if cluster_mode(args):
+        # only needed in cluster mode, and cluster.py imports this module in turn
+        import cluster
+        quit(cluster.run_cluster(args, discord_api_token))
+    bot = create_bot(args, open_storage(args))
+    bot.run(discord_api_token)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""
+Write-behind wrapper for the shelves used by WaifuHoarder
+
+(C) 2019-2020 by Jordan Aurora Kinsley
+
+Licensed under MIT License, see LICENSE
+"""
+
+import shelve
+from collections.abc import MutableMapping
+
+# marks a key that has been deleted in memory but not yet on disk
+_DELETED = object()
+
+
+def open_shelf(location):
+    """Opens a shelf at location behind a WriteBehindShelf"""
+    # writeback is set to False to conserve memory at the expense of addition steps to add info the shelf
+    return WriteBehindShelf(shelve.open(location, flag='c', writeback=False))
+
+
+class WriteBehindShelf(MutableMapping):
+    """Holds changed keys in memory until flush() writes them to the underlying shelf. Reads of a changed key are served
+    from the in-memory copy, everything else is read straight from the shelf"""
+
+    def __init__(self, shelf):
+        self.shelf = shelf
+        self.pending = {}
+
+    def __getitem__(self, key):
+        if key in self.pending:
+            value = self.pending[key]
+            if value is _DELETED:
+                raise KeyError(key)
+            return value
+        return self.shelf[key]
+
+    def __setitem__(self, key, value):
+        self.pending[key] = value
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self.pending[key] = _DELETED
+
+    def __contains__(self, key):
+        if key in self.pending:
+            return self.pending[key] is not _DELETED
+        return key in self.shelf
+
+    def __iter__(self):
+        for key in self.shelf.keys():
+            if key not in self.pending:
+                yield key
+        for key, value in list(self.pending.items()):
+            if value is not _DELETED:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def clear(self):
+        # clearing is rare (owner-only drops), so it goes straight to disk instead of tombstoning every key
+        self.pending.clear()
+        self.shelf.clear()
+
+    def write_through(self, key, value):
+        """Writes key straight to the shelf, skipping the write-behind queue"""
+        self.pending.pop(key, None)
+        self.shelf[key] = value
+
+    def delete_through(self, key):
+        """Deletes key straight from the shelf, skipping the write-behind queue"""
+        self.pending.pop(key, None)
+        try:
+            del self.shelf[key]
+        except KeyError:
+            pass
+
+    def dirty_count(self):
+        return len(self.pending)
+
+    def flush(self, limit=None):
+        """Writes up to limit changed keys to the shelf (all of them if limit is None) and returns how many were written"""
+        written = 0
+        for key in list(self.pending.keys()):
+            if limit is not None and written >= limit:
+                break
+            value = self.pending.pop(key)
+            if value is _DELETED:
+                try:
+                    del self.shelf[key]
+                except KeyError:
+                    pass
+            else:
+                self.shelf[key] = value
+            written += 1
+        return written
+
+    def sync(self):
+        self.shelf.sync()
+
+    def close(self):
+        self.flush()
+        self.shelf.close()